@@ -0,0 +1,305 @@
+"""
+Benchmarks for the data-path hot spots, runnable on a laptop: no GPU, no network, no competition data.
+
+Everything runs in a throwaway POLARIS_ASAP_POSES_HOME with synthetic molecules and a synthetic
+competition snapshot, and gnina is replaced by benchmarks/fake_gnina.py (via settings.gnina_bin),
+which writes realistic multi-pose SDFs after a delay.  Each benchmark is timed a few times and
+its median compared against benchmarks/baseline.json.  Baselines are only comparable on the
+machine that recorded them (see its "machine" entry), so re-record one before comparing on yours.
+Benchmarks that run several workers at once are only compared against a baseline recorded with the
+same number of cores, since with fewer cores than workers they measure oversubscription, not speedup.
+
+    python benchmarks/bench.py                    # compare against the baseline, exit 1 on regressions
+    python benchmarks/bench.py --save-baseline    # record a new baseline
+    python benchmarks/bench.py --only sdf         # just the benchmarks whose name contains "sdf"
+"""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import typer
+from typing_extensions import Annotated
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = REPO_DIR / "benchmarks"
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+
+# All of this has to happen before polaris_asap_poses is imported, since io.py reads it at import time
+BENCH_HOME = Path(tempfile.mkdtemp(prefix="polaris-asap-poses-bench-"))
+os.environ["POLARIS_ASAP_POSES_HOME"] = str(BENCH_HOME)
+os.environ["POLARIS_ASAP_POSES_OFFLINE"] = "1"
+os.environ["DYNACONF_GNINA_BIN"] = "./bin/fake-gnina"
+os.environ["DYNACONF_LOG_LEVEL"] = "WARNING"
+os.environ.setdefault("FAKE_GNINA_DELAY", "0.02")
+shutil.copy(REPO_DIR / "settings.toml", BENCH_HOME / "settings.toml")
+os.chdir(BENCH_HOME)
+
+import polars as pl  # noqa: E402
+
+from polaris_asap_poses import gnina  # noqa: E402
+from polaris_asap_poses.io import (NamedDataset, data_dir,  # noqa: E402
+                                   data_dir_gnina_out, iter_sdf, read_sdf,
+                                   serialize_rdkit_mol, write_sdf, write_sdfs)
+from polaris_asap_poses.model import PROTEINS  # noqa: E402
+from polaris_asap_poses.util import add_fake_id_col, print_info  # noqa: E402
+
+from fake_competition import (embedded_mols, synthetic_frame,  # noqa: E402
+                              write_fake_competition)
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Callable[[], Callable[[], None]]
+    repeat: int = 5
+    workers: int = 1  # Threads or processes it runs at once
+
+
+def _clear_gnina_out():
+    shutil.rmtree(data_dir_gnina_out())
+    data_dir_gnina_out().mkdir()
+
+
+####################################
+# Benchmarks
+####################################
+
+
+def bench_add_fake_id_col():
+    df = synthetic_frame(1_000_000)
+    return lambda: add_fake_id_col(df, "test_fake_id")
+
+
+def bench_print_info():
+    df = synthetic_frame(1_000_000)
+    return lambda: print_info(df)
+
+
+def _bench_round_trip(suffix: str):
+    def setup():
+        df = synthetic_frame(200_000)
+        dataset = NamedDataset(name=f"bench_{suffix}", filepath=data_dir() / f"bench.{suffix}")
+
+        def run():
+            dataset.save(df)
+            dataset.read()
+
+        return run
+
+    return setup
+
+
+def _bench_filtered_scan(suffix: str, partition_by: List[str]):
+    """
+    Pull one receptor's high scorers out of a big pose-sized table, without reading the rest.
+    """
+
+    def setup():
+        df = synthetic_frame(200_000).with_row_index("test_fake_id")
+        dataset = NamedDataset(
+            name=f"bench_scan_{suffix}", filepath=data_dir() / f"bench_scan.{suffix}", partition_by=partition_by
+        )
+        dataset.save(df)
+        return lambda: (
+            dataset.scan()
+            .filter((pl.col("protein_label") == PROTEINS[0].data_label) & (pl.col("score") > 2))
+            .select("test_fake_id", "score")
+            .collect()
+        )
+
+    return setup
+
+
+def bench_named_dataset_mols():
+    mols = embedded_mols(2_000)
+    df = pl.DataFrame({"test_fake_id": range(len(mols)), "mol": pl.Series(mols, dtype=pl.Object)})
+    dataset = NamedDataset(name="bench_mols", filepath=data_dir() / "bench_mols.parquet", mol_columns=["mol"])
+
+    def run():
+        dataset.save(df)
+        dataset.read(decode_mols=True)
+
+    return run
+
+
+def bench_write_read_sdf():
+    mols = embedded_mols(500)
+    sdf_dir = data_dir() / "bench_sdf"
+    sdf_dir.mkdir(parents=True, exist_ok=True)
+
+    def run():
+        for i, mol in enumerate(mols):
+            write_sdf(mol, sdf_dir / f"{i}.sdf")
+        for i in range(len(mols)):
+            read_sdf(sdf_dir / f"{i}.sdf")
+
+    return run
+
+
+def _bench_iter_sdf(**kwargs):
+    """
+    Stream one big SDF, the way we read concatenated gnina outputs.
+    """
+
+    def setup():
+        path = data_dir() / "bench_big.sdf"
+        write_sdfs(embedded_mols(20_000), path)
+
+        def run():
+            for _ in iter_sdf(path, **kwargs):
+                pass
+
+        return run
+
+    return setup
+
+
+def bench_serialize_rdkit_mol():
+    mols = embedded_mols(5_000)
+    return lambda: [serialize_rdkit_mol(x) for x in mols]
+
+
+def _bench_run(n_test: int, **run_kwargs):
+    def setup():
+        write_fake_competition(n_test)
+
+        def run():
+            _clear_gnina_out()
+            gnina.run(use_cache=False, **run_kwargs)
+
+        return run
+
+    return setup
+
+
+def bench_run_cached():
+    """
+    Everything already docked, so this is all cache checks.
+    """
+    write_fake_competition(64)
+    _clear_gnina_out()
+    gnina.run(jobs=8, seed=0, use_cache=True)
+    return lambda: gnina.run(jobs=8, seed=0, use_cache=True)
+
+
+BENCHMARKS = [
+    Benchmark("add_fake_id_col_1m", bench_add_fake_id_col),
+    Benchmark("print_info_1m", bench_print_info),
+    Benchmark("named_dataset_csv_200k", _bench_round_trip("csv")),
+    Benchmark("named_dataset_parquet_200k", _bench_round_trip("parquet")),
+    Benchmark("named_dataset_arrow_200k", _bench_round_trip("arrow")),
+    Benchmark("named_dataset_parquet_mols_2k", bench_named_dataset_mols),
+    Benchmark("scan_parquet_200k", _bench_filtered_scan("parquet", [])),
+    Benchmark("scan_parquet_partitioned_200k", _bench_filtered_scan("parquet", ["protein_label"])),
+    Benchmark("scan_arrow_partitioned_200k", _bench_filtered_scan("arrow", ["protein_label"])),
+    Benchmark("write_read_sdf_500", bench_write_read_sdf),
+    Benchmark("iter_sdf_20k", _bench_iter_sdf()),
+    Benchmark("iter_sdf_threads4_20k", _bench_iter_sdf(num_threads=4), workers=4),
+    Benchmark("iter_sdf_where_20k", _bench_iter_sdf(where=lambda props: props["test_fake_id"] % 10 == 0)),
+    Benchmark("serialize_rdkit_mol_5k", bench_serialize_rdkit_mol),
+    Benchmark("run_serial_16", _bench_run(16, jobs=1), repeat=3),
+    Benchmark("run_jobs8_64", _bench_run(64, jobs=8), repeat=3, workers=8),
+    Benchmark("run_jobs4_chunk8_64", _bench_run(64, jobs=4, chunk_size=8), repeat=3, workers=4),
+    # Catches regressions in adaptive's own overhead, nothing more: the fake's hit rate and decoys are made up to
+    # behave the way assess_convergence assumes.  Whether adaptive pays off is for `polaris-asap-poses evaluate`.
+    Benchmark("run_adaptive_jobs8_64", _bench_run(64, jobs=8, adaptive=True), repeat=3, workers=8),
+    # Same for two-stage: the fake's CNN_FREE_COST decides what the search saves, so this can't show that it does.
+    Benchmark("run_two_stage_jobs8_64", _bench_run(64, jobs=8, two_stage=True), repeat=3, workers=8),
+    Benchmark("run_cached_64", bench_run_cached, repeat=3),
+]
+
+
+####################################
+# Harness
+####################################
+
+
+def time_benchmark(benchmark: Benchmark, repeat: int | None = None) -> Dict[str, float]:
+    fn = benchmark.setup()
+    fn()  # warm up
+    times = []
+    for _ in range(repeat or benchmark.repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "repeat": len(times),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def machine_info() -> Dict[str, str | int | None]:
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "fake_gnina_delay": float(os.environ["FAKE_GNINA_DELAY"]),
+    }
+
+
+def main(
+    save_baseline: Annotated[bool, typer.Option(help="Write the results to the baseline file.")] = False,
+    baseline: Path = BASELINE_PATH,
+    only: Annotated[Optional[str], typer.Option(help="Only run benchmarks whose name contains this.")] = None,
+    repeat: Annotated[Optional[int], typer.Option(help="Override each benchmark's repeat count.")] = None,
+    tolerance: Annotated[float, typer.Option(help="Flag a regression above baseline * (1 + tolerance).")] = 0.5,
+    min_delta: Annotated[float, typer.Option(help="...and at least this many seconds slower, to ignore noise.")] = 0.01,
+):
+    """
+    Run the benchmarks and compare them against (or save them as) the baseline.
+    """
+    saved = json.loads(baseline.read_text()) if baseline.exists() else {"results": {}}
+    results = {}
+    regressions = []
+    typer.echo(f"{'benchmark':<32}{'median':>10}{'baseline':>10}{'ratio':>8}")
+    cpu_count = os.cpu_count() or 1
+    try:
+        for benchmark in BENCHMARKS:
+            if only and only not in benchmark.name:
+                continue
+            result = time_benchmark(benchmark, repeat)
+            results[benchmark.name] = result
+            previous = saved["results"].get(benchmark.name)
+            if previous is None:
+                typer.echo(f"{benchmark.name:<32}{result['median_s']:>9.3f}s{'-':>10}{'-':>8}")
+                continue
+            ratio = result["median_s"] / previous["median_s"]
+            # Older baselines only have the machine's core count
+            previous_cpu_count = previous.get("cpu_count", saved.get("machine", {}).get("cpu_count"))
+            flag = ""
+            if benchmark.workers > 1 and previous_cpu_count != cpu_count:
+                flag = f"  skipped, baseline has {previous_cpu_count} cores, this machine {cpu_count}"
+            elif ratio > 1 + tolerance and result["median_s"] - previous["median_s"] > min_delta:
+                regressions.append(benchmark.name)
+                flag = "  REGRESSION"
+            if benchmark.workers > cpu_count:
+                flag += f"  ({benchmark.workers} workers on {cpu_count} cores)"
+            typer.echo(f"{benchmark.name:<32}{result['median_s']:>9.3f}s{previous['median_s']:>9.3f}s{ratio:>8.2f}{flag}")
+    finally:
+        shutil.rmtree(BENCH_HOME, ignore_errors=True)
+
+    if save_baseline:
+        saved = {"machine": machine_info(), "results": {**saved["results"], **results}}
+        baseline.write_text(json.dumps(saved, indent=2) + "\n")
+        typer.echo(f"Saved baseline to {baseline}.")
+        oversubscribed = [x.name for x in BENCHMARKS if x.name in results and x.workers > cpu_count]
+        if oversubscribed:
+            typer.echo(
+                f"{oversubscribed} ran more workers than this machine's {cpu_count} cores, so their baselines "
+                "measure oversubscription.  Record them on a machine with enough cores."
+            )
+    elif regressions:
+        typer.echo(f"{len(regressions)} regression(s): {regressions}")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,122 @@
+"""
+Synthetic competition data for the benchmarks and tests: 3D ligands, a snapshot of the
+train/test split, reference structures and ./bin/fake-gnina.
+
+POLARIS_ASAP_POSES_HOME has to point at a throwaway directory (and be the working directory)
+before this is imported, since polaris_asap_poses.io reads it at import time.  See bench.py.
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import polars as pl
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from polaris_asap_poses.cache import sha256_bytes, sha256_file
+from polaris_asap_poses.io import asap_test_raw, asap_train_raw, write_sdf
+from polaris_asap_poses.model import PROTEINS
+from polaris_asap_poses.snapshot import snapshot_manifest_path
+from polaris_asap_poses.util import add_fake_id_col
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+# Drug-ish ligands of the sizes we see in the competition; the synthetic sets cycle through these
+SMILES = [
+    "CC(=O)Nc1ccc(O)cc1",
+    "O=C(Nc1cccnc1)c1ccc(Cl)cc1",
+    "Cc1ccc(S(=O)(=O)N2CCN(C(=O)c3ccco3)CC2)cc1",
+    "O=C(Cc1cccc(Cl)c1)Nc1cncc2ccccc12",
+    "CN1CCN(c2ccc(NC(=O)c3ccc(F)cc3)cn2)CC1",
+    "O=C1c2ccccc2C(=O)N1CCc1ccncc1",
+    "COc1cc2ncnc(Nc3ccc(F)c(Cl)c3)c2cc1OC",
+    "O=C(NC1CC1)c1cc(-c2ccccc2)n[nH]1",
+    "N#Cc1ccc(CN2CCC(C(=O)N3CCOCC3)CC2)cc1",
+    "O=C(Nc1ccc2[nH]ncc2c1)C1CCN(c2ncccn2)CC1",
+    "Cc1cc(C)n(-c2ccc(C(=O)NCc3ccccn3)cc2)n1",
+    "O=S(=O)(Nc1cccc(-c2nccs2)c1)c1ccc(F)cc1",
+]
+
+
+def install_fake_gnina():
+    """
+    ./bin/fake-gnina in the current directory, i.e. what settings.gnina_bin points at once
+    DYNACONF_GNINA_BIN=./bin/fake-gnina.
+    """
+    bin_dir = Path("bin")
+    bin_dir.mkdir(exist_ok=True)
+    fake_gnina = bin_dir / "fake-gnina"
+    fake_gnina.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{BENCH_DIR / "fake_gnina.py"}" "$@"\n')
+    fake_gnina.chmod(0o755)
+
+
+def embedded_mols(n: int, seed: int = 0) -> List[Chem.Mol]:
+    """
+    n 3D molecules with hydrogens, cycling through SMILES, each with a few props set.
+    """
+    templates = []
+    for i, smi in enumerate(SMILES):
+        mol = Chem.AddHs(Chem.MolFromSmiles(smi))
+        AllChem.EmbedMolecule(mol, randomSeed=seed + i)
+        templates.append(mol)
+    mols = []
+    for i in range(n):
+        mol = Chem.Mol(templates[i % len(templates)])
+        mol.SetProp("_Name", f"test_{i}")
+        mol.SetIntProp("test_fake_id", i)
+        mol.SetDoubleProp("minimizedAffinity", -7.0 - (i % 5) * 0.1)
+        mols.append(mol)
+    return mols
+
+
+def synthetic_frame(n_rows: int) -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    return pl.DataFrame(
+        {
+            "protein_label": rng.choice([x.data_label for x in PROTEINS], n_rows),
+            "CXSMILES": [SMILES[i % len(SMILES)] for i in range(n_rows)],
+            "chain_a_sequence": ["SGFRKMAFPSGKVEGCMVQVTCGTTTLNGLWLDDVVYCPRHVICTSEDMLNPNYEDLLIRKSNHNFLVQAGNVQLRVIGHSMQNCVLKLKVDTANPKTPKYKFVRIQPGQTFSVLACYNGSPSGVYQCAMRPNFTIKGSFLNGSCGSVGFNIDYDCVSFCYMHHMELPTGVHAGTDLEGNFYGPFVDRQTAQAAGTDTTITVNVLAWLYAAVINGDRWFLNRFTTTLNDFNLVAMKYNYEPLTQDHVDILGPLSAQTGIAVLDMCASLKELLQNGMNGRTILGSALLEDEFTPFDVVRQCSGVTFQ"] * n_rows,
+            "chain_b_sequence": [None] * n_rows,
+            "score": rng.normal(size=n_rows),
+        }
+    )
+
+
+def write_snapshot_manifest():
+    """
+    A manifest for the snapshot as it is, e.g. after replacing the test set.
+    """
+    files = {"train": sha256_file(asap_train_raw.path), "test": sha256_file(asap_test_raw.path)}
+    snapshot_manifest_path().write_text(
+        json.dumps({"competition": "benchmark", "files": files, "fingerprint": sha256_bytes(json.dumps(files).encode())})
+    )
+
+
+def write_fake_competition(n_test: int):
+    """
+    Reference structures, a snapshot with n_test test ligands split across both proteins,
+    and a prepared ligand SDF for each, i.e. everything gnina.run() expects to find.
+    """
+    install_fake_gnina()
+
+    reference = embedded_mols(1, seed=100)[0]
+    for protein in PROTEINS:
+        protein.ref_dir.mkdir(parents=True, exist_ok=True)
+        write_sdf(reference, protein.ref_ligand_sdf_path)
+        protein.ref_pdb_path.write_text(
+            "ATOM      1  CA  GLY A   1       0.000   0.000   0.000  1.00  0.00           C\nEND\n"
+        )
+
+    df_test = add_fake_id_col(synthetic_frame(n_test).drop("score"), "test_fake_id")
+    asap_test_raw.save(df_test)
+    df_train = synthetic_frame(10).drop("score").with_columns(pl.Series("ligand_pose", embedded_mols(10), dtype=pl.Object))
+    asap_train_raw.save(add_fake_id_col(df_train, "train_fake_id"))
+    write_snapshot_manifest()
+
+    mols = embedded_mols(n_test)
+    for row, mol in zip(df_test.iter_rows(named=True), mols):
+        protein = next(x for x in PROTEINS if x.data_label == row["protein_label"])
+        write_sdf(mol, protein.test_ligand_sdf_path(row["test_fake_id"]))
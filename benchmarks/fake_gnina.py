@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Stand-in for gnina, for benchmarking the orchestration without a GPU or the real binary.
+
+Takes gnina's command line (the bits we use), sleeps for a configurable time per ligand, and writes
+num_modes poses per input ligand: the input conformer, rotated and dropped onto the autobox
+ligand's centroid, with minimizedAffinity/CNNscore/CNNaffinity set like gnina does.  Poses for each
+ligand come out consecutively, best first, with the input's name, same as the real thing.
+
+Like a real search, each pose finds the ligand's "true" binding mode (a fixed rotation per ligand name,
+scoring best) with a probability that goes up with exhaustiveness, and is a random, worse-scoring
+pose otherwise.  A quarter of the ligands, picked by name, are hard: they find the true mode less
+often and also have a decoy mode scoring nearly as well, so it takes more search to tell them apart.
+That's the behavior adaptive docking is designed around, so benchmarks on this fake only time its
+orchestration: they can't show that it saves anything on real gnina.
+The delay scales with exhaustiveness too, as gnina's run time does, and as on a CPU, most of it is
+CNN scoring: --cnn_scoring none cuts it to a quarter, and leaves out the CNN properties.
+
+With --minimize there's no search: each input pose comes back as is, in input order, with a slightly
+better minimizedAffinity and CNN scores that favor the better affinities, at a small cost per pose.
+
+    FAKE_GNINA_DELAY     seconds per ligand at exhaustiveness 16 (default 0.05)
+    FAKE_GNINA_FAIL      exit non-zero for any ligand whose name contains this string
+    FAKE_GNINA_SKIP      write no poses for any ligand whose name contains this string, like gnina
+                         does for ligands it can't place
+    FAKE_GNINA_ARGV_LOG  append each run's command line to this file, as a line of JSON
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import rdMolTransforms
+
+FAKE_VERSION = "gnina v1.3 fake (polaris-asap-poses benchmarks)"
+
+# Fractions of the per-ligand delay: a search with the CNN off, and minimizing + scoring one pose.
+# Made up, not measured, so two-stage docking saves whatever these say it does here.
+CNN_FREE_COST = 0.25
+MINIMIZE_COST = 0.02
+
+
+def random_rotation(rng: np.random.Generator) -> np.ndarray:
+    q = rng.normal(size=4)
+    a, b, c, d = q / np.linalg.norm(q)
+    return np.array(
+        [
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d],
+        ]
+    )
+
+
+def make_poses(
+    mol: Chem.Mol,
+    center: np.ndarray,
+    num_modes: int,
+    exhaustiveness: int,
+    name: str,
+    rng: np.random.Generator,
+    cnn: bool = True,
+):
+    conf = mol.GetConformer()
+    centroid = rdMolTransforms.ComputeCentroid(conf)
+    coords = conf.GetPositions() - np.array([centroid.x, centroid.y, centroid.z])
+    name_rng = np.random.default_rng(zlib.crc32(name.encode()))
+    modes = [random_rotation(name_rng), random_rotation(name_rng)]
+    hard = zlib.crc32(name.encode()) % 4 == 0
+    p_true = exhaustiveness / (exhaustiveness + (40 if hard else 2))
+    # 0 = true mode, 1 = decoy mode (hard ligands only), 2 = anywhere else
+    mode = np.where(rng.random(num_modes) < p_true, 0, np.where(hard & (rng.random(num_modes) < 0.5), 1, 2))
+    affinities = np.choose(
+        mode, [rng.normal(-9.2, 0.2, num_modes), rng.normal(-8.6, 0.3, num_modes), rng.uniform(-7.5, -4.0, num_modes)]
+    )
+    order = np.argsort(affinities)
+    mode, affinities = mode[order], affinities[order]
+    cnn_scores = np.sort(rng.uniform(0.1, 0.99, num_modes))[::-1]
+    for rank in range(num_modes):
+        pose = Chem.Mol(mol)
+        if mode[rank] < 2:
+            new_coords = coords @ modes[mode[rank]].T + center + rng.normal(scale=0.2, size=3)
+        else:
+            new_coords = coords @ random_rotation(rng).T + center + rng.normal(scale=0.5, size=3)
+        pose_conf = pose.GetConformer()
+        for i, xyz in enumerate(new_coords):
+            pose_conf.SetAtomPosition(i, xyz.tolist())
+        pose.SetProp("minimizedAffinity", f"{affinities[rank]:.5f}")
+        if cnn:
+            pose.SetProp("CNNscore", f"{cnn_scores[rank]:.5f}")
+            pose.SetProp("CNNaffinity", f"{-affinities[rank] * 0.8:.5f}")
+        yield pose
+
+
+def minimize_pose(mol: Chem.Mol, rng: np.random.Generator, cnn: bool = True) -> Chem.Mol:
+    pose = Chem.Mol(mol)
+    affinity = float(pose.GetProp("minimizedAffinity")) if pose.HasProp("minimizedAffinity") else -5.0
+    affinity += rng.normal(-0.2, 0.1)
+    pose.SetProp("minimizedAffinity", f"{affinity:.5f}")
+    if cnn:
+        cnn_score = np.clip(1 / (1 + np.exp(affinity + 7)) + rng.normal(scale=0.05), 0.01, 0.99)
+        pose.SetProp("CNNscore", f"{cnn_score:.5f}")
+        pose.SetProp("CNNaffinity", f"{-affinity * 0.8:.5f}")
+    return pose
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--version", action="store_true")
+    parser.add_argument("-r", "--receptor")
+    parser.add_argument("-l", "--ligand")
+    parser.add_argument("--autobox_ligand")
+    parser.add_argument("-o", "--out")
+    parser.add_argument("--log")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--exhaustiveness", type=int, default=8)
+    parser.add_argument("--num_modes", type=int, default=9)
+    parser.add_argument("--cpu", type=int)
+    parser.add_argument("--cnn_scoring", default="rescore")
+    parser.add_argument("--minimize", action="store_true")
+    args, _ = parser.parse_known_args(argv)
+    if args.version:
+        print(FAKE_VERSION)
+        return 0
+    argv_log = os.environ.get("FAKE_GNINA_ARGV_LOG")
+    if argv_log:
+        with open(argv_log, "a") as fd:
+            fd.write(json.dumps(sys.argv[1:] if argv is None else list(argv)) + "\n")
+
+    delay = float(os.environ.get("FAKE_GNINA_DELAY", "0.05"))
+    fail = os.environ.get("FAKE_GNINA_FAIL")
+    skip = os.environ.get("FAKE_GNINA_SKIP")
+    cnn = args.cnn_scoring != "none"
+    rng = np.random.default_rng(args.seed if args.seed >= 0 else None)
+    box = Chem.MolFromMolFile(args.autobox_ligand)
+    center = box.GetConformer().GetPositions().mean(axis=0)
+    ligands = [x for x in Chem.SDMolSupplier(args.ligand, removeHs=False) if x is not None]
+
+    with Chem.SDWriter(args.out) as writer, open(args.log, "w") as log:
+        log.write(f"{FAKE_VERSION}\n")
+        for mol in ligands:
+            name = mol.GetProp("_Name") if mol.HasProp("_Name") else ""
+            if fail and fail in name:
+                print(f"Failing on purpose for {name}", file=sys.stderr)
+                return 1
+            if skip and skip in name:
+                log.write(f"Skipped {name}\n")
+                continue
+            if args.minimize:
+                time.sleep(delay * MINIMIZE_COST)
+                writer.write(minimize_pose(mol, rng, cnn=cnn))
+                log.write(f"Minimized {name}\n")
+                continue
+            time.sleep(delay * args.exhaustiveness / 16 * (1.0 if cnn else CNN_FREE_COST))
+            for pose in make_poses(mol, center, args.num_modes, args.exhaustiveness, name, rng, cnn=cnn):
+                writer.write(pose)
+            log.write(f"Docked {name}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+CLI cold-start benchmark: how long `polaris-asap-poses <command>` takes before doing any work.
+
+Each case runs in a fresh interpreter, a few times, and its median wall time has to come in under
+the budget.  Also checks that importing the CLI doesn't drag in the heavy dependencies, which is
+what keeps it fast: those belong inside the commands that need them.  And that the library imports
+without POLARIS_ASAP_POSES_HOME or a settings.toml, since neither should be read until they're used.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --budget 0.3 --repeat 10
+"""
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import typer
+from typing_extensions import Annotated
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Shouldn't be imported just to parse the command line
+HEAVY_MODULES = ["rdkit", "polars", "numpy", "nbformat", "pydantic", "dynaconf", "python_on_whales", "typeguard", "loguru"]
+
+CASES = {
+    "import": "import polaris_asap_poses.cmd.root",
+    "help": "import sys; from polaris_asap_poses.cmd.root import main; sys.argv = ['polaris-asap-poses', '--help']; main()",
+    "version": "import sys; from polaris_asap_poses.cmd.root import main; sys.argv = ['polaris-asap-poses', 'version']; main()",
+}
+
+CHECK_MODULES = (
+    "import sys, polaris_asap_poses.cmd.root; "
+    f"print(' '.join(x for x in {HEAVY_MODULES!r} if x in sys.modules))"
+)
+
+# Have to import without POLARIS_ASAP_POSES_HOME or settings.toml: paths and settings are read on first use
+LIBRARY_MODULES = [
+    "polaris_asap_poses.io",
+    "polaris_asap_poses.gnina",
+    "polaris_asap_poses.metrics",
+    "polaris_asap_poses.pipeline",
+]
+
+
+def run_python(code: str, home: Path) -> float:
+    start = time.perf_counter()
+    # typer exits via SystemExit(0) after --help, so only a nonzero code is a failure
+    subprocess.run([sys.executable, "-c", code], cwd=home, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def main(
+    budget: Annotated[float, typer.Option(help="Max median seconds per case.")] = 0.5,
+    repeat: int = 5,
+):
+    home = Path(tempfile.mkdtemp(prefix="polaris-asap-poses-startup-"))
+    os.environ["POLARIS_ASAP_POSES_HOME"] = str(home)
+    shutil.copy(REPO_DIR / "settings.toml", home / "settings.toml")
+    failures: List[str] = []
+    try:
+        loaded = subprocess.run(
+            [sys.executable, "-c", CHECK_MODULES], cwd=home, check=True, capture_output=True, text=True
+        ).stdout.split()
+        if loaded:
+            failures.append(f"importing the CLI loads {', '.join(loaded)}")
+
+        bare = Path(tempfile.mkdtemp(prefix="polaris-asap-poses-bare-", dir=home))
+        env = {k: v for k, v in os.environ.items() if k != "POLARIS_ASAP_POSES_HOME"}
+        for module in LIBRARY_MODULES:
+            result = subprocess.run(
+                [sys.executable, "-c", f"import {module}"], cwd=bare, env=env, capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                error = result.stderr.strip().splitlines()[-1]
+                failures.append(f"importing {module} without POLARIS_ASAP_POSES_HOME failed: {error}")
+        if list(bare.iterdir()):
+            failures.append(f"importing the library wrote to {bare}: {sorted(x.name for x in bare.iterdir())}")
+        shutil.rmtree(bare)
+
+        # One untimed run first, so we measure a warm .pyc cache rather than compilation
+        run_python(CASES["import"], home)
+        for name, code in CASES.items():
+            times = [run_python(code, home) for _ in range(repeat)]
+            median = statistics.median(times)
+            ok = median <= budget
+            typer.echo(f"{name:<10} median {median * 1000:7.1f} ms  min {min(times) * 1000:7.1f} ms  {'ok' if ok else 'OVER BUDGET'}")
+            if not ok:
+                failures.append(f"{name} took {median:.3f}s, budget is {budget:.3f}s")
+        if list(home.iterdir()) != [home / "settings.toml"]:
+            failures.append(f"startup wrote to {home}: {sorted(x.name for x in home.iterdir())}")
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    for failure in failures:
+        typer.echo(f"FAIL: {failure}", err=True)
+    raise typer.Exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    typer.run(main)
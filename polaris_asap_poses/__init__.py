@@ -1,6 +1,12 @@
-from importlib.metadata import version
 from pathlib import Path
 
-__version__ = version(__package__)
-
 module_root = Path(__file__).parent
+
+
+def __getattr__(name: str):
+    # Looking up the installed version costs tens of ms, so do it only when someone asks
+    if name == "__version__":
+        from importlib.metadata import version
+
+        return version(__package__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,241 @@
+"""
+Adaptive multi-fidelity docking: a cheap pass for every ligand, more search only where it's needed.
+
+Each ligand is docked at the lowest fidelity first (low exhaustiveness, a few seeds) and the poses
+from all its runs are pooled.  It has converged if its top poses agree with each other (max pairwise
+RMSD within rmsd_cutoff), or if its best pose beats the best pose in any other binding mode by at
+least score_gap kcal/mol of minimizedAffinity.  Converged ligands are done; the rest are docked
+again at the next fidelity, keeping their earlier poses in the pool.  Whatever's still unconverged
+at the last fidelity gets what it has.  So does a ligand with a gnina run that failed: the
+failure would most likely repeat at the next fidelity, so it isn't sent on, and it's recorded as
+unconverged, along with its number of failed runs.
+
+The pooled poses, best first, go where gnina's output normally would (docking_result_path), tagged
+with the fidelity that settled them, and the adaptive_fidelity table records which fidelity each
+ligand needed, and why.
+"""
+
+import dataclasses
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import polars as pl
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.cache import DockingCache
+from polaris_asap_poses.container_pool import ContainerPool
+from polaris_asap_poses.gnina import (DEFAULT_EXHAUSTIVENESS, GninaJob,
+                                      gnina_pose_order, log_dir_gnina,
+                                      pose_affinity, run_gnina_jobs)
+from polaris_asap_poses.io import (NamedDataset, data_dir_gnina_out, iter_sdf,
+                                   write_sdfs)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.rmsd import pairwise_pose_rmsd, pose_rmsd
+
+
+def data_dir_gnina_out_adaptive() -> Path:
+    return data_dir_gnina_out() / "adaptive"
+
+
+DEFAULT_RMSD_CUTOFF = 2.0
+DEFAULT_SCORE_GAP = 1.0
+DEFAULT_TOP_N = 3
+# What gnina writes per run by default (--num_modes), and how many pooled poses we keep
+N_POSES = 9
+
+adaptive_fidelity = NamedDataset(
+    name="adaptive_fidelity",
+    filepath="combined/adaptive_fidelity.parquet",
+)
+
+
+@dataclass(frozen=True)
+class Fidelity:
+    """
+    One level of docking effort: n_seeds independent gnina runs at this exhaustiveness.
+    """
+
+    exhaustiveness: int
+    n_seeds: int = 1
+
+    def __str__(self) -> str:
+        return f"exhaustiveness {self.exhaustiveness} x {self.n_seeds} seed(s)"
+
+
+DEFAULT_FIDELITIES = [Fidelity(exhaustiveness=4, n_seeds=2), Fidelity(exhaustiveness=DEFAULT_EXHAUSTIVENESS)]
+
+
+@dataclass
+class Convergence:
+    converged: bool
+    n_poses: int
+    rmsd_spread: float | None  # Max pairwise RMSD among the top poses
+    score_gap: float | None  # Best other binding mode's affinity minus the best pose's; None if there's no other mode
+
+
+@typechecked
+def assess_convergence(
+    poses: List[Chem.Mol],
+    top_n: int = DEFAULT_TOP_N,
+    rmsd_cutoff: float = DEFAULT_RMSD_CUTOFF,
+    score_gap: float = DEFAULT_SCORE_GAP,
+) -> Convergence:
+    """
+    Has the search settled on one answer for this ligand?  Poses can be in any order,
+    from any number of runs, but have to share an atom order.
+    """
+    if not poses:
+        return Convergence(converged=False, n_poses=0, rmsd_spread=None, score_gap=None)
+    poses = sorted(poses, key=pose_affinity)
+    top = poses[:top_n]
+    spread = float(pairwise_pose_rmsd(top).max())
+    from_best = pose_rmsd(poses[0], poses)
+    # poses are sorted, so the first one far enough from the best is the best other mode
+    other = next((pose for pose, rmsd in zip(poses, from_best) if rmsd > rmsd_cutoff), None)
+    gap = None if other is None else pose_affinity(other) - pose_affinity(poses[0])
+    return Convergence(
+        converged=spread <= rmsd_cutoff or gap is None or gap >= score_gap,
+        n_poses=len(poses),
+        rmsd_spread=spread,
+        score_gap=gap,
+    )
+
+
+def fidelity_jobs(job: GninaJob, fidelity: Fidelity) -> List[GninaJob]:
+    """
+    A job's runs at one fidelity, each with its own seed and output file.
+    Seeds count up from the job's seed (0 if it's random), so reruns hit the docking cache.
+    """
+    base_seed = max(job.seed, 0)
+    jobs = []
+    for seed in range(base_seed, base_seed + fidelity.n_seeds):
+        name = f"{job.output_sdf.stem}_ex{fidelity.exhaustiveness}_seed{seed}"
+        jobs.append(
+            dataclasses.replace(
+                job,
+                output_sdf=data_dir_gnina_out_adaptive() / f"{name}.sdf",
+                log_file=log_dir_gnina() / f"{name}.log",
+                seed=seed,
+                exhaustiveness=fidelity.exhaustiveness,
+            )
+        )
+    return jobs
+
+
+def _read_poses(path: Path) -> List[Chem.Mol]:
+    return list(iter_sdf(path))
+
+
+def _write_result(job: GninaJob, poses: List[Chem.Mol], fidelity: Fidelity, convergence: Convergence):
+    poses = sorted(poses, key=gnina_pose_order)[:N_POSES]
+    for pose in poses:
+        pose.SetIntProp("adaptive_exhaustiveness", fidelity.exhaustiveness)
+        pose.SetIntProp("adaptive_n_seeds", fidelity.n_seeds)
+        pose.SetBoolProp("adaptive_converged", convergence.converged)
+    write_sdfs(mols=poses, path=job.output_sdf)
+
+
+@typechecked
+def run_adaptive(
+    jobs: List[GninaJob],
+    fidelities: List[Fidelity] = DEFAULT_FIDELITIES,
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+    top_n: int = DEFAULT_TOP_N,
+    rmsd_cutoff: float = DEFAULT_RMSD_CUTOFF,
+    score_gap: float = DEFAULT_SCORE_GAP,
+    save: bool = True,
+) -> pl.DataFrame:
+    """
+    Dock jobs at each fidelity in turn, only sending on the ligands that haven't converged.
+    Each job's exhaustiveness and seed are replaced by the fidelities'.
+    Returns (and with save, saves as adaptive_fidelity) one row per ligand: the fidelity it finished at,
+    its convergence and how many of its runs failed.
+    Failed runs don't stop the others.  If a ligand ends up with no poses because of them, that's raised
+    as a RuntimeError at the end, once the table is saved.
+    """
+    logger.info("Start.")
+    data_dir_gnina_out_adaptive().mkdir(parents=True, exist_ok=True)
+    pooled: Dict[int, List[Chem.Mol]] = {id(job): [] for job in jobs}
+    n_failed: Dict[int, int] = {id(job): 0 for job in jobs}
+    pending = list(jobs)
+    rows = []
+    for level, fidelity in enumerate(fidelities):
+        last = level == len(fidelities) - 1
+        runs = {id(job): fidelity_jobs(job, fidelity) for job in pending}
+        logger.info(f"Docking {len(pending)} ligands at {fidelity}...")
+        with timed("adaptive_level", level=level, exhaustiveness=fidelity.exhaustiveness, n_ligands=len(pending)):
+            failed = run_gnina_jobs(
+                [run for job in pending for run in runs[id(job)]],
+                n_workers=n_workers,
+                backend=backend,
+                cache=cache,
+                pool=pool,
+                raise_failed=False,
+            )
+        failed_ids = {id(run) for run in failed}
+        unconverged = []
+        for job in pending:
+            for run in runs[id(job)]:
+                if id(run) in failed_ids:
+                    # Whatever's in its output is from some earlier run
+                    n_failed[id(job)] += 1
+                else:
+                    pooled[id(job)] += _read_poses(run.output_sdf)
+            convergence = assess_convergence(pooled[id(job)], top_n=top_n, rmsd_cutoff=rmsd_cutoff, score_gap=score_gap)
+            has_failed = any(id(run) in failed_ids for run in runs[id(job)])
+            if has_failed:
+                convergence.converged = False
+            elif not (convergence.converged or last):
+                unconverged.append(job)
+                continue
+            if convergence.n_poses:
+                _write_result(job, pooled[id(job)], fidelity, convergence)
+            else:
+                logger.warning(f"No poses at all for test_fake_id {job.test_fake_id} ({job.protein.name})")
+            rows.append(
+                {
+                    "test_fake_id": job.test_fake_id,
+                    "protein_label": job.protein.data_label,
+                    "level": level,
+                    **dataclasses.asdict(fidelity),
+                    **dataclasses.asdict(convergence),
+                    "failed_runs": n_failed[id(job)],
+                }
+            )
+        if failed:
+            logger.warning(f"{len(failed)} gnina runs failed at {fidelity}, their ligands go no further.")
+        logger.info(f"{len(pending) - len(unconverged)} of {len(pending)} ligands settled at {fidelity}.")
+        pending = unconverged
+        if not pending:
+            break
+
+    df = pl.DataFrame(
+        rows,
+        schema={
+            "test_fake_id": pl.Int64,
+            "protein_label": pl.String,
+            "level": pl.Int32,
+            "exhaustiveness": pl.Int32,
+            "n_seeds": pl.Int32,
+            "converged": pl.Boolean,
+            "n_poses": pl.Int32,
+            "rmsd_spread": pl.Float64,
+            "score_gap": pl.Float64,
+            "failed_runs": pl.Int32,
+        },
+    )
+    if save:
+        adaptive_fidelity.save(df)
+    logger.info(f"Done. Ligands per fidelity: {dict(df['level'].value_counts().sort('level').iter_rows())}")
+    lost = df.filter((pl.col("failed_runs") > 0) & (pl.col("n_poses") == 0))
+    if len(lost):
+        raise RuntimeError(
+            f"No poses for {len(lost)} ligands whose gnina runs failed, test_fake_ids: {lost['test_fake_id'].to_list()}"
+        )
+    return df
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict
+
+from typeguard import typechecked
+
+from polaris_asap_poses.io import data_dir_gnina_out
+from polaris_asap_poses.logger import logger
+
+
+def cache_manifest_path() -> Path:
+    return data_dir_gnina_out() / "manifest.json"
+
+
+# Rewriting the whole manifest after every job is quadratic over a run, so write it every so often
+DEFAULT_FLUSH_EVERY = 100
+DEFAULT_FLUSH_INTERVAL_S = 30.0
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: Path | str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while chunk := fd.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DockingCache:
+    """
+    Content-addressed cache of docking results.
+
+    Each entry maps an output file to the key it was produced from, where the key is a hash of
+    the input file contents (receptor, ligand, autobox ligand) plus the docking parameters
+    (gnina version, exhaustiveness, seed, ...).  An output is only reused if its key still matches
+    and the file on disk still has the checksum we recorded.  New entries are written out every
+    flush_every jobs or flush_interval_s seconds, whichever comes first, and on flush(), so an
+    interrupted run only redoes the jobs since the last write.
+    """
+
+    def __init__(
+        self,
+        manifest_path: Path | str | None = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        flush_interval_s: float = DEFAULT_FLUSH_INTERVAL_S,
+    ):
+        manifest_path = cache_manifest_path() if manifest_path is None else manifest_path
+        self.manifest_path = Path(manifest_path)
+        self.flush_every = flush_every
+        self.flush_interval_s = flush_interval_s
+        self._lock = threading.Lock()
+        self._file_hashes: Dict[tuple, str] = {}
+        self._n_unflushed = 0
+        self._last_flush = time.monotonic()
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as fd:
+                self.entries: Dict[str, Dict[str, Any]] = json.load(fd)
+        else:
+            self.entries = {}
+
+    def _hash_input(self, path: Path) -> str:
+        # The receptor and autobox ligand are shared by thousands of jobs, so memoize on (path, mtime, size)
+        stat = os.stat(path)
+        memo_key = (str(path), stat.st_mtime_ns, stat.st_size)
+        if memo_key not in self._file_hashes:
+            self._file_hashes[memo_key] = sha256_file(path)
+        return self._file_hashes[memo_key]
+
+    @typechecked
+    def key(self, inputs: Dict[str, Path], params: Dict[str, Any]) -> str:
+        """
+        Hash named input files and parameters into a cache key.
+        """
+        payload = {
+            "inputs": {name: self._hash_input(path) for name, path in sorted(inputs.items())},
+            "params": params,
+        }
+        return sha256_bytes(json.dumps(payload, sort_keys=True, default=str).encode())
+
+    def is_valid(self, output_path: Path, key: str) -> bool:
+        entry = self.entries.get(str(output_path))
+        if entry is None or entry["key"] != key:
+            return False
+        if not output_path.exists():
+            return False
+        return sha256_file(output_path) == entry["output_sha256"]
+
+    def record(self, output_path: Path, key: str):
+        entry = {
+            "key": key,
+            "output_sha256": sha256_file(output_path),
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            self.entries[str(output_path)] = entry
+            self._n_unflushed += 1
+            if self._n_unflushed >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval_s:
+                self._write()
+
+    def flush(self):
+        """
+        Write out any entries recorded since the last write.
+        """
+        with self._lock:
+            if self._n_unflushed:
+                self._write()
+
+    def invalidate(self, output_path: Path):
+        with self._lock:
+            if self.entries.pop(str(output_path), None) is not None:
+                self._write()
+
+    def _write(self):
+        # Write-then-rename, so a crash never leaves a half-written manifest behind
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as fd:
+            json.dump(self.entries, fd, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+        self._n_unflushed = 0
+        self._last_flush = time.monotonic()
+        logger.debug(f"Wrote {len(self.entries)} entries to {self.manifest_path}")
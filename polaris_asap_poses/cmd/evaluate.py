@@ -0,0 +1,21 @@
+import typer
+from typing_extensions import Annotated
+
+
+def evaluate(
+    mode: Annotated[str, typer.Argument(help="Docking mode to evaluate: adaptive or two_stage.")],
+    ligands: Annotated[int, typer.Option(help="How many test ligands to sample.")] = 48,
+    seed: int = 0,
+    jobs: int = 1,
+    backend: str = "prebuilt",
+):
+    """
+    Dock a sample of test ligands with a docking mode, plainly, and at reference effort, and report the
+    CPU time the mode saves and how often it keeps the reference's top pose.
+    """
+    from polaris_asap_poses.evaluate import (MODES, evaluate_mode,
+                                             evaluation_report)
+
+    if mode not in MODES:
+        raise typer.BadParameter(f"No mode {mode}, expected one of {list(MODES)}", param_hint="MODE")
+    typer.echo(evaluation_report(evaluate_mode(mode, n_ligands=ligands, seed=seed, n_workers=jobs, backend=backend)))
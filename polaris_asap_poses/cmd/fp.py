@@ -0,0 +1,52 @@
+from pathlib import Path
+from typing import List, Optional
+
+import typer
+from typing_extensions import Annotated
+
+app = typer.Typer(add_completion=False, no_args_is_help=True)
+
+
+@app.command()
+def build():
+    """
+    Build the fingerprint index from the train and test sets, adding anything new.
+    """
+    from polaris_asap_poses.fpindex import build_fp_index
+
+    index = build_fp_index()
+    typer.echo(f"{len(index)} fingerprints in {index.path}.")
+
+
+@app.command()
+def query(
+    smiles: Annotated[List[str], typer.Argument()],
+    k: int = 5,
+    split: Annotated[Optional[str], typer.Option(help="Only search train or test.")] = None,
+):
+    """
+    Show the k most similar indexed ligands for each SMILES.
+    """
+    from polaris_asap_poses.fpindex import FingerprintIndex
+
+    typer.echo(FingerprintIndex().query(smiles, k=k, split=split))
+
+
+@app.command()
+def nearest(
+    k: int = 1,
+    query_split: str = "test",
+    target_split: str = "train",
+    out: Annotated[Optional[Path], typer.Option(help="Write the neighbors to this CSV instead.")] = None,
+):
+    """
+    Find the k nearest target_split neighbors of every query_split ligand.
+    """
+    from polaris_asap_poses.fpindex import FingerprintIndex
+
+    df = FingerprintIndex().nearest(query_split=query_split, target_split=target_split, k=k)
+    if out is None:
+        typer.echo(df)
+    else:
+        df.write_csv(out)
+        typer.echo(f"Wrote {len(df)} neighbors to {out}.")
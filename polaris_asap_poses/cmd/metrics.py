@@ -0,0 +1,25 @@
+import json
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+app = typer.Typer(add_completion=False, no_args_is_help=True)
+
+
+@app.command()
+def report(
+    run_id: Annotated[Optional[str], typer.Option(help="Defaults to the most recent run.")] = None,
+    top: int = 10,
+    as_json: Annotated[bool, typer.Option("--json", help="Print the summary as JSON.")] = False,
+):
+    """
+    Summarize a run's metrics: time per stage, per-ligand dock time, throughput, slowest ligands.
+    """
+    from polaris_asap_poses.metrics import report as metrics_report
+    from polaris_asap_poses.metrics import summarize_metrics
+
+    if as_json:
+        typer.echo(json.dumps(summarize_metrics(run_id=run_id, top=top), indent=2, default=str))
+    else:
+        typer.echo(metrics_report(run_id=run_id, top=top))
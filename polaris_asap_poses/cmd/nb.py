@@ -6,20 +6,22 @@ from enum import Enum
 from pathlib import Path
 from typing import List, NamedTuple, Optional
 
-import nbformat as nbf
 import typer
 from typing_extensions import Annotated
 
-from polaris_asap_poses.settings import get_settings
+app = typer.Typer(add_completion=False, no_args_is_help=True)
 
-settings = get_settings()
 
-POLARIS_ASAP_POSES_HOME = os.environ["POLARIS_ASAP_POSES_HOME"]
-NB_DIR = Path(POLARIS_ASAP_POSES_HOME) / "notebooks"
-# ugh ok moving on
-NB_DIR.mkdir(parents=True, exist_ok=True)
-NB_PORT = settings.notebook_port
-app = typer.Typer(add_completion=False, no_args_is_help=True)
+# Everything below is resolved when a command runs, not at import, so the rest of the CLI
+# doesn't pay for settings validation (or need POLARIS_ASAP_POSES_HOME) just to start up
+def get_nb_dir() -> Path:
+    return Path(os.environ["POLARIS_ASAP_POSES_HOME"]) / "notebooks"
+
+
+def get_nb_port() -> int:
+    from polaris_asap_poses.settings import get_settings
+
+    return get_settings().notebook_port
 
 
 @app.command()
@@ -27,7 +29,7 @@ def up():
     """
     Start Jupyter.
     """
-    cmd = f"jupyter notebook --allow-root --ip=0.0.0.0 --port={NB_PORT} --no-browser --notebook-dir=./notebooks --NotebookApp.token=''".split(
+    cmd = f"jupyter notebook --allow-root --ip=0.0.0.0 --port={get_nb_port()} --no-browser --notebook-dir=./notebooks --NotebookApp.token=''".split(
         " "
     )
     subprocess.run(cmd, check=True)
@@ -38,7 +40,7 @@ def open():
     """
     Open a browser, pointing to the Jupyter web interface.
     """
-    webbrowser.open_new_tab(f"http://localhost:{NB_PORT}/")
+    webbrowser.open_new_tab(f"http://localhost:{get_nb_port()}/")
 
 
 @app.command()
@@ -48,7 +50,7 @@ def new(name: Annotated[Optional[str], typer.Argument()] = None):
     """
     nb_name = write_default_notebook(name)
     typer.echo(f"Created notebook '{nb_name}'.")
-    webbrowser.open_new_tab(f"http://localhost:{NB_PORT}/notebooks/{nb_name}")
+    webbrowser.open_new_tab(f"http://localhost:{get_nb_port()}/notebooks/{nb_name}")
 
 
 class CellType(Enum):
@@ -161,7 +163,9 @@ from pathlib import Path\
     return nb_cells
 
 
-def get_default_notebook() -> nbf.notebooknode.NotebookNode:
+def get_default_notebook() -> "nbf.notebooknode.NotebookNode":
+    import nbformat as nbf
+
     nb = nbf.v4.new_notebook()
     for i in get_default_notebook_cells():
         if i.type == CellType.CODE:
@@ -177,10 +181,14 @@ def get_default_notebook() -> nbf.notebooknode.NotebookNode:
 
 
 def write_default_notebook(name: str = None) -> str:
+    import nbformat as nbf
+
     if name is None:
         now = datetime.now().strftime("%Y%m%d_%H%M%S")
         name = f"default_{now}"
     nb = get_default_notebook()
-    notebook_filepath = NB_DIR / f"{name}.ipynb"
+    nb_dir = get_nb_dir()
+    nb_dir.mkdir(parents=True, exist_ok=True)
+    notebook_filepath = nb_dir / f"{name}.ipynb"
     nbf.write(nb, notebook_filepath)
     return name
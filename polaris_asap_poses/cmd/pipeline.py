@@ -0,0 +1,52 @@
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+
+def pipeline(
+    until: Annotated[Optional[str], typer.Option(help="Stop after this stage, running only what it needs.")] = None,
+    dry_run: Annotated[bool, typer.Option(help="Show what would run, and why, without running it.")] = False,
+    force: Annotated[bool, typer.Option(help="Rerun stages even if they're up to date. Docking still uses its cache.")] = False,
+    jobs: int = 1,
+    cpus_per_job: Optional[int] = None,
+    backend: str = "prebuilt",
+    chunk_size: int = 0,
+    seed: int = 0,
+    prep: bool = True,
+    n_confs: int = 10,
+    template_threshold: Optional[float] = None,
+    adaptive: Annotated[bool, typer.Option(help="Dock cheaply first, escalating only unconverged ligands.")] = False,
+    two_stage: Annotated[bool, typer.Option(help="Dock without the CNN, then CNN-rescore the best poses.")] = False,
+    select_by: Annotated[
+        str, typer.Option(help="Pose table column to pick each ligand's pose by, or vina_score to rescore them.")
+    ] = "cnn_score",
+):
+    """
+    Run snapshot + structures -> prep -> dock -> poses -> select -> submit, skipping whatever's up to date.
+    """
+    from polaris_asap_poses.pipeline import Pipeline, PipelineConfig
+
+    runner = Pipeline(
+        PipelineConfig(
+            jobs=jobs,
+            cpus_per_job=cpus_per_job,
+            backend=backend,
+            chunk_size=chunk_size,
+            seed=seed,
+            prep=prep,
+            n_confs=n_confs,
+            template_threshold=template_threshold,
+            adaptive=adaptive,
+            two_stage=two_stage,
+            select_by=select_by,
+        )
+    )
+    if until is not None and until not in runner.stages:
+        raise typer.BadParameter(f"No stage {until}, expected one of {list(runner.stages)}", param_hint="--until")
+    if dry_run:
+        for name, status in runner.plan(until=until, force=force):
+            typer.echo(f"{name:<12} {status}")
+        return
+    ran = runner.run(until=until, force=force)
+    typer.echo(f"Ran {', '.join(ran)}." if ran else "Everything is up to date.")
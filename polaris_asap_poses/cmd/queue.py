@@ -0,0 +1,61 @@
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+app = typer.Typer(add_completion=False, no_args_is_help=True)
+
+
+@app.command()
+def init():
+    """
+    Queue a docking job for every test ligand that isn't queued yet.
+    """
+    from polaris_asap_poses.workqueue import populate_queue
+
+    typer.echo(populate_queue().counts())
+
+
+@app.command()
+def work(
+    workers: Annotated[int, typer.Option(help="Local worker processes to start.")] = 1,
+    backend: str = "prebuilt",
+    cpus: Annotated[Optional[int], typer.Option(help="gnina --cpu for each job.")] = None,
+    seed: int = 0,
+    lease: Annotated[float, typer.Option(help="Seconds before a silent worker's job is re-queued.")] = 600.0,
+):
+    """
+    Dock queued jobs until the queue is drained.  Run this on as many hosts as you like.
+    """
+    from polaris_asap_poses.workqueue import run_worker, run_workers
+
+    kwargs = dict(backend=backend, cpus=cpus, seed=seed, lease_s=lease)
+    if workers == 1:
+        run_worker(**kwargs)
+    else:
+        run_workers(workers, **kwargs)
+
+
+@app.command()
+def status(
+    show_jobs: Annotated[bool, typer.Option("--jobs", help="List every job, not just the counts.")] = False,
+):
+    """
+    Show how many jobs are queued, running, done and failed.
+    """
+    from polaris_asap_poses.workqueue import WorkQueue
+
+    queue = WorkQueue()
+    typer.echo(queue.counts())
+    if show_jobs:
+        typer.echo(queue.jobs())
+
+
+@app.command()
+def retry():
+    """
+    Put failed jobs back in the queue.
+    """
+    from polaris_asap_poses.workqueue import WorkQueue
+
+    typer.echo(f"Re-queued {WorkQueue().retry_failed()} failed jobs.")
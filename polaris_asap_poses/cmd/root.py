@@ -1,11 +1,22 @@
+import os
+
 import typer
 
-from polaris_asap_poses import __version__
+from polaris_asap_poses.cmd.evaluate import evaluate
+from polaris_asap_poses.cmd.fp import app as fp_app
+from polaris_asap_poses.cmd.metrics import app as metrics_app
 from polaris_asap_poses.cmd.nb import app as nb_app
+from polaris_asap_poses.cmd.pipeline import pipeline
+from polaris_asap_poses.cmd.queue import app as queue_app
 
 # typer autocompletion does weird crap to your shell, so we're turning it off
 app = typer.Typer(add_completion=False, no_args_is_help=True)
 app.add_typer(nb_app, name="nb", help="Manage local Jupyter instance.")
+app.add_typer(fp_app, name="fp", help="Fingerprint similarity index over the train and test ligands.")
+app.add_typer(metrics_app, name="metrics", help="Stage timing and resource metrics.")
+app.add_typer(queue_app, name="queue", help="Shared docking work queue, for spreading a run over several hosts.")
+app.command()(pipeline)
+app.command()(evaluate)
 
 
 @app.command()
@@ -13,8 +24,13 @@ def version():
     """
     Show the version and exit.
     """
+    from polaris_asap_poses import __version__
+
     typer.echo(f"polaris-asap-poses {__version__}")
 
 
 def main():
+    # What pl.Config(tbl_rows=500, fmt_str_lengths=500) sets, without importing polars just to start up
+    os.environ.setdefault("POLARS_FMT_MAX_ROWS", "500")
+    os.environ.setdefault("POLARS_FMT_STR_LEN", "500")
     app()
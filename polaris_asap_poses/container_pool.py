@@ -0,0 +1,209 @@
+import itertools
+import queue
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Protocol
+
+from polaris_asap_poses.io import home_dir
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import run_measured
+from polaris_asap_poses.settings import get_settings
+
+CONTAINER_MOUNT = "/scr"
+
+
+def get_docker():
+    """
+    python_on_whales' docker client.  It takes a few hundred ms to import,
+    so only pay for that when Docker is actually used.
+    """
+    from python_on_whales import docker
+
+    return docker
+
+
+class ContainerBackend(Protocol):
+    """
+    The handful of operations the pool needs from a container runtime.
+    """
+
+    def start(self) -> Any: ...
+
+    def exec(self, handle: Any, command: List[str]) -> str: ...
+
+    def is_healthy(self, handle: Any) -> bool: ...
+
+    def stop(self, handle: Any) -> None: ...
+
+
+class DockerBackend:
+    """
+    Long-lived gnina containers, idling on `sleep infinity` with POLARIS_ASAP_POSES_HOME mounted at /scr.
+    """
+
+    def __init__(self, image: str = "gnina/gnina"):
+        self.image = image
+
+    def start(self) -> Any:
+        return get_docker().run(
+            image=self.image,
+            command=["sleep", "infinity"],
+            volumes=[(home_dir(), CONTAINER_MOUNT)],
+            detach=True,
+            remove=True,
+        )
+
+    def exec(self, handle: Any, command: List[str]) -> str:
+        return get_docker().execute(handle, command)
+
+    def is_healthy(self, handle: Any) -> bool:
+        try:
+            return get_docker().container.inspect(handle.id).state.running
+        except Exception:
+            return False
+
+    def stop(self, handle: Any) -> None:
+        get_docker().container.remove(handle, force=True)
+
+
+@dataclass
+class LocalContainer:
+    id: int
+    alive: bool = True
+
+
+class SubprocessBackend:
+    """
+    Local stand-in for DockerBackend, so the pool can be exercised without Docker.
+    A "container" is just a handle, and exec runs the command as a local subprocess,
+    with /scr/... paths mapped back onto POLARIS_ASAP_POSES_HOME and executables remapped,
+    e.g. {"gnina": "./bin/gnina"}, which is the default (settings.gnina_bin).
+    """
+
+    def __init__(
+        self,
+        root: Path | str | None = None,
+        executables: Dict[str, str] | None = None,
+    ):
+        root = home_dir() if root is None else root
+        self.root = str(root)
+        self.executables = executables or {"gnina": get_settings().gnina_bin}
+        self._ids = itertools.count()
+
+    def start(self) -> LocalContainer:
+        return LocalContainer(id=next(self._ids))
+
+    def _map_arg(self, arg: str) -> str:
+        if arg.startswith(f"{CONTAINER_MOUNT}/"):
+            return self.root + arg[len(CONTAINER_MOUNT) :]
+        return arg
+
+    def exec(self, handle: LocalContainer, command: List[str]) -> str:
+        if not handle.alive:
+            raise RuntimeError(f"Local container {handle.id} is stopped")
+        command = [self.executables.get(command[0], command[0])] + [self._map_arg(x) for x in command[1:]]
+        result = run_measured(command, check=True, capture_output=True, text=True, cwd=self.root)
+        return result.stdout
+
+    def is_healthy(self, handle: LocalContainer) -> bool:
+        return handle.alive
+
+    def stop(self, handle: LocalContainer) -> None:
+        handle.alive = False
+
+
+POOL_BACKENDS = {
+    "docker": DockerBackend,
+    "subprocess": SubprocessBackend,
+}
+
+
+@dataclass
+class PooledContainer:
+    handle: Any
+    n_jobs: int = 0
+
+
+class ContainerPool:
+    """
+    A fixed-size pool of long-lived containers that docking jobs are exec'd into,
+    so each job pays for gnina itself rather than container create/start/teardown.
+
+    Containers are health-checked before each job, and recycled (stopped and replaced)
+    when they are unhealthy, when a job fails in them, or after max_jobs_per_container jobs.
+    """
+
+    def __init__(self, size: int, backend: ContainerBackend, max_jobs_per_container: int = 500):
+        self.size = size
+        self.backend = backend
+        self.max_jobs_per_container = max_jobs_per_container
+        self._idle: queue.Queue[PooledContainer] = queue.Queue()
+        self._started = False
+
+    def start(self):
+        logger.info(f"Starting {self.size} containers...")
+        for _ in range(self.size):
+            self._idle.put(PooledContainer(handle=self.backend.start()))
+        self._started = True
+        logger.info("Done.")
+
+    def _recycle(self, container: PooledContainer, reason: str) -> PooledContainer:
+        logger.info(f"Recycling container {container.handle}: {reason}")
+        try:
+            self.backend.stop(container.handle)
+        except Exception as e:
+            logger.warning(f"Couldn't stop container {container.handle}: {e!r}")
+        # Empty the slot before starting the replacement, so if that fails, the stopped container
+        # isn't handed out again.  The next acquire() tries to fill the slot.
+        container.handle = None
+        container.n_jobs = 0
+        return PooledContainer(handle=self.backend.start())
+
+    @contextmanager
+    def acquire(self):
+        """
+        Check out a healthy container for the duration of the block.
+        """
+        if not self._started:
+            raise RuntimeError("ContainerPool.start() hasn't been called")
+        container = self._idle.get()
+        try:
+            if container.handle is None:
+                container = PooledContainer(handle=self.backend.start())
+            elif not self.backend.is_healthy(container.handle):
+                container = self._recycle(container, "failed health check")
+            try:
+                yield container.handle
+            except Exception:
+                container = self._recycle(container, "job failed")
+                raise
+            container.n_jobs += 1
+            if container.n_jobs >= self.max_jobs_per_container:
+                container = self._recycle(container, f"ran {container.n_jobs} jobs")
+        finally:
+            self._idle.put(container)
+
+    def exec(self, command: List[str]) -> str:
+        with self.acquire() as handle:
+            return self.backend.exec(handle, command)
+
+    def close(self):
+        logger.info("Stopping containers...")
+        while not self._idle.empty():
+            container = self._idle.get_nowait()
+            if container.handle is None:
+                continue
+            try:
+                self.backend.stop(container.handle)
+            except Exception as e:
+                logger.warning(f"Couldn't stop container {container.handle}: {e!r}")
+        self._started = False
+        logger.info("Done.")
+
+    def __enter__(self) -> "ContainerPool":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,13 +1,141 @@
-from polaris_asap_poses.download import load_comp, get_df_train_for_comp, get_df_test_for_comp
-from polaris_asap_poses.io import DATA_DIR_LIGAND_SDF, write_sdf, DATA_DIR_GNINA_OUT
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict
+
+from polaris_asap_poses.io import data_dir, write_sdf
 from polaris_asap_poses.model import SARS, MERS
 from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.snapshot import get_df_test
+import polars as pl
+import rdkit
 from rdkit import Chem
+from rdkit.Chem import AllChem
+from typeguard import typechecked
+
+
+def data_dir_ligprep_cache() -> Path:
+    return data_dir() / "ligprep_cache"
+
+
+def canonical_smiles(smiles: str) -> str:
+    """
+    Canonical CXSMILES, so the same ligand always maps to the same key no matter how it was written.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError(f"Couldn't parse SMILES {smiles}")
+    return Chem.MolToCXSmiles(mol)
+
+
+@typechecked
+def prepare_ligand(smiles: str, n_confs: int = 10, seed: int = 0, optimize: bool = True) -> Chem.Mol:
+    """
+    Add hydrogens, embed n_confs ETKDG conformers, MMFF-optimize them,
+    and return the molecule with only its lowest-energy conformer.
+    """
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    params = AllChem.ETKDGv3()
+    params.randomSeed = seed
+    conf_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=n_confs, params=params))
+    if not conf_ids:
+        # Random coordinates get some awkward (e.g. macrocyclic) ligands embedded at all
+        params.useRandomCoords = True
+        conf_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=n_confs, params=params))
+    if not conf_ids:
+        raise ValueError(f"Couldn't embed {smiles}")
+
+    if optimize and AllChem.MMFFHasAllMoleculeParams(mol):
+        # list of (not_converged, energy), one per conformer
+        results = AllChem.MMFFOptimizeMoleculeConfs(mol, maxIters=2000)
+        energies = [energy for _, energy in results]
+    elif optimize:
+        logger.warning(f"No MMFF parameters for {smiles}, using UFF")
+        results = AllChem.UFFOptimizeMoleculeConfs(mol, maxIters=2000)
+        energies = [energy for _, energy in results]
+    else:
+        energies = [0.0] * len(conf_ids)
+
+    best_conf_id = conf_ids[min(range(len(conf_ids)), key=lambda i: energies[i])]
+    best = Chem.Mol(mol, confId=best_conf_id)
+    best.SetDoubleProp("prep_energy", energies[conf_ids.index(best_conf_id)])
+    return best
 
-def write_test_ligand_sdfs():
+
+def _ligprep_cache_path(smiles: str, n_confs: int, seed: int, optimize: bool):
+    # Embedding and force fields change between RDKit releases, so an upgrade starts a fresh cache
+    key = hashlib.sha256(f"{smiles}|{n_confs}|{seed}|{optimize}|{rdkit.__version__}".encode()).hexdigest()
+    return data_dir_ligprep_cache() / f"{key}.bin"
+
+
+def _prepare_ligand_cached(smiles: str, n_confs: int, seed: int, optimize: bool) -> bytes:
+    """
+    prepare_ligand, returning RDKit binary, with results cached on disk by canonical SMILES, params
+    and RDKit version.
+    Runs in worker processes, so it returns bytes rather than a Mol.
+    """
+    cache_path = _ligprep_cache_path(smiles, n_confs, seed, optimize)
+    if cache_path.exists():
+        return cache_path.read_bytes()
+    mol = prepare_ligand(smiles, n_confs=n_confs, seed=seed, optimize=optimize)
+    mol_bytes = mol.ToBinary(Chem.PropertyPickleOptions.AllProps)
+    tmp_path = cache_path.with_suffix(".tmp")
+    tmp_path.write_bytes(mol_bytes)
+    tmp_path.replace(cache_path)
+    return mol_bytes
+
+
+@typechecked
+def prepare_ligands(
+    smiles: list[str],
+    n_confs: int = 10,
+    seed: int = 0,
+    optimize: bool = True,
+    processes: int | None = None,
+) -> Dict[str, Chem.Mol]:
+    """
+    Prepare every ligand in a process pool, doing each unique canonical SMILES only once.
+    Returns a dict from canonical SMILES to prepared molecule.
+    """
+    data_dir_ligprep_cache().mkdir(parents=True, exist_ok=True)
+    unique = sorted({canonical_smiles(x) for x in smiles})
+    logger.info(f"Preparing {len(unique)} unique ligands ({len(smiles)} total) with {processes or 'all'} processes...")
+    prepared = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            _prepare_ligand_cached,
+            unique,
+            [n_confs] * len(unique),
+            [seed] * len(unique),
+            [optimize] * len(unique),
+            chunksize=max(1, len(unique) // (8 * (processes or 8))),
+        )
+        for smi, mol_bytes in zip(unique, results):
+            prepared[smi] = Chem.Mol(mol_bytes)
+    logger.info("Done.")
+    return prepared
+
+
+@timed("write_test_ligand_sdfs")
+def write_test_ligand_sdfs(
+    prep: bool = True,
+    n_confs: int = 10,
+    seed: int = 0,
+    processes: int | None = None,
+    df_test: pl.DataFrame | None = None,
+):
+    """
+    Write one ligand SDF per test row, for every row of df_test (default: the whole test set).
+    With prep, ligands get hydrogens and an MMFF-optimized 3D conformer (see prepare_ligands),
+    otherwise they're written straight from CXSMILES.
+    """
     logger.info("Start.")
-    comp = load_comp()
-    df_test = get_df_test_for_comp(comp)
+    df_test = get_df_test() if df_test is None else df_test
+    if prep:
+        prepared = prepare_ligands(
+            df_test["CXSMILES"].to_list(), n_confs=n_confs, seed=seed, processes=processes
+        )
     for row in df_test.iter_rows(named=True):
         logger.info(f"Processing id {row['test_fake_id']}, protein {row['protein_label']}, CXSMILES {row['CXSMILES']}...")
 
@@ -19,11 +147,15 @@ def write_test_ligand_sdfs():
             case _:
                 raise ValueError(f"Invalid protein_label {row['protein_label']} for test_fake_id {row['test_fake_id']}")
 
-        ligand_sdf_path = DATA_DIR_LIGAND_SDF / f"test_{row['test_fake_id']}_{this_protein.path_segment}.sdf"
-        docking_result_path = DATA_DIR_GNINA_OUT / f"docked_test_{row['test_fake_id']}_{this_protein.path_segment}.sdf"
-        mol = Chem.MolFromSmiles(row["CXSMILES"])
+        ligand_sdf_path = this_protein.test_ligand_sdf_path(row["test_fake_id"])
+        if prep:
+            mol = Chem.Mol(prepared[canonical_smiles(row["CXSMILES"])])
+        else:
+            mol = Chem.MolFromSmiles(row["CXSMILES"])
+        mol.SetProp("_Name", f"test_{row['test_fake_id']}")
         write_sdf(mol=mol, path=ligand_sdf_path)
     logger.info("Done.")
 
+
 if __name__ == "__main__":
     write_test_ligand_sdfs()
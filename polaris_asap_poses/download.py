@@ -1,16 +1,21 @@
-import zipfile
 from pathlib import Path
 
-import fsspec
 import polaris as po
 import polars as pl
 from polaris.competition import CompetitionSpecification
 from typeguard import typechecked
 
-from polaris_asap_poses.io import (DATA_DIR_RAW_PACKAGES,
-                                   DATA_DIR_RAW_REF_STRUCTURES)
+from polaris_asap_poses.fetch import Artifact, fetch_and_extract, fetch_artifact
+from polaris_asap_poses.io import (asap_test_raw, asap_train_raw,
+                                   data_dir_raw_packages,
+                                   data_dir_raw_ref_structures)
 from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.snapshot import (get_df_test, get_df_train,
+                                          read_snapshot_manifest,
+                                          snapshot_problem, write_snapshot)
 from polaris_asap_poses.util import add_fake_id_col, print_info
+from polaris_asap_poses.zipindex import ZipIndex
 
 CHALLENGE = "antiviral-ligand-poses-2025"
 
@@ -19,6 +24,7 @@ CHALLENGE = "antiviral-ligand-poses-2025"
 ####################################
 
 
+@timed("load_comp")
 @typechecked
 def load_comp(challenge: str = CHALLENGE) -> CompetitionSpecification:
     """
@@ -36,27 +42,53 @@ def load_comp(challenge: str = CHALLENGE) -> CompetitionSpecification:
     return competition
 
 
+def raw_data_package_artifact(
+    raw_data_package_dir: str | Path | None = None,
+) -> Artifact:
+    raw_data_package_dir = data_dir_raw_packages() if raw_data_package_dir is None else raw_data_package_dir
+    return Artifact(
+        name="raw_data_package",
+        url="https://fs.polarishub.io/2025-01-asap-discovery/raw_data_package.zip",
+        extract_dir=Path(raw_data_package_dir),
+    )
+
+
+def reference_structures_artifact(
+    reference_structures_dir: str | Path | None = None,
+) -> Artifact:
+    if reference_structures_dir is None:
+        reference_structures_dir = data_dir_raw_ref_structures()
+    return Artifact(
+        name="reference_structures",
+        url="https://fs.polarishub.io/2025-01-asap-discovery/ligand_poses_reference_structures.zip",
+        extract_dir=Path(reference_structures_dir),
+    )
+
+
 def download_raw_data_packages(
-    raw_data_package_dir: str | Path = DATA_DIR_RAW_PACKAGES,
+    raw_data_package_dir: str | Path | None = None,
+    extract: bool = True,
 ):
+    """
+    With extract=False, just download the zip and index it; see zipindex.ZipIndex for reading members on demand.
+    """
+    raw_data_package_dir = data_dir_raw_packages() if raw_data_package_dir is None else raw_data_package_dir
     logger.info(f"Downloading raw-data package to {raw_data_package_dir}")
-    with fsspec.open(
-        "https://fs.polarishub.io/2025-01-asap-discovery/raw_data_package.zip"
-    ) as fd:
-        with zipfile.ZipFile(fd, "a") as zip_ref:
-            zip_ref.extractall(raw_data_package_dir)
+    artifact = raw_data_package_artifact(raw_data_package_dir)
+    if extract:
+        fetch_and_extract([artifact])
+    else:
+        ZipIndex.open(fetch_artifact(artifact))
 
 
 def download_reference_structures(
-    reference_structures_dir: str | Path = DATA_DIR_RAW_REF_STRUCTURES,
+    reference_structures_dir: str | Path | None = None,
 ):
+    if reference_structures_dir is None:
+        reference_structures_dir = data_dir_raw_ref_structures()
     logger.info(f"Downloading reference structures to {reference_structures_dir}")
     reference_structures_dir = Path(reference_structures_dir)
-    with fsspec.open(
-        "https://fs.polarishub.io/2025-01-asap-discovery/ligand_poses_reference_structures.zip"
-    ) as fd:
-        with zipfile.ZipFile(fd, "a") as zip_ref:
-            zip_ref.extractall(reference_structures_dir)
+    fetch_and_extract([reference_structures_artifact(reference_structures_dir)])
     logger.info("Done.")
     logger.info(f"Contents:  {list(reference_structures_dir.iterdir())}")
     # We provide more information than just the protein structure
@@ -64,56 +96,25 @@ def download_reference_structures(
     logger.info(f"More stuff: {more_stuff}")
 
 
-@typechecked
-def get_df_train_for_comp_BUSTED(
-    comp: CompetitionSpecification, save: bool = False
-) -> pl.DataFrame:
-    """
-    Load training data as polars DataFrame
-    Polaris has some dumbass bug where converting a competition subset to a dataframe fails, because polaris keeps adding duplicate columns to the DF?
-    It doesn't make sense, I didn't dig into it, but this is the magic incantation that keeps that bug from manifesting.
-
-    ...BUT WAIT, it gets worse
-    polars chokes on rdkit.mol objects and the schema_overrides option doesn't do jack
-    so let's leave this here for posterity, what the heck
-    """
-    logger.info(f"Loading training dataframe for comp {comp.name}...")
-    df_train = pl.from_pandas(
-        comp.get_train_test_split()[0].as_dataframe(),
-        schema_overrides={"Ligand Pose": pl.Object},
-    )
-    print_info(df_train)
-    if save:
-        logger.info("Saving...")
-        logger.info(
-            "NOOOPE we're not saving anything until we're smarter about persisting rdkit mol objects"
-        )
-        # asap_train_raw.save(df_train)
-    return df_train
+RENAME_COLUMNS = {
+    "Chain B Sequence": "chain_b_sequence",
+    "Protein Label": "protein_label",
+    "Chain A Sequence": "chain_a_sequence",
+}
 
 
-@typechecked
-def get_df_train_for_comp(
-    comp: CompetitionSpecification, save: bool = False
-) -> pl.DataFrame:
+def _df_train_from_subset(train_subset) -> pl.DataFrame:
     """
-    Load training data as polars DataFrame
+    Build the training DataFrame from the train half of a Polaris train/test split,
+    converting to pandas exactly once.
     """
-    logger.info(f"Loading training dataframe for comp {comp.name}...")
-    df_train_no_poses = pl.from_pandas(
-        comp.get_train_test_split()[0].as_dataframe().drop(["Ligand Pose"], axis=1)
-    )
-    just_poses = comp.get_train_test_split()[0].as_dataframe()["Ligand Pose"].to_list()
+    df_pandas = train_subset.as_dataframe()
+    just_poses = df_pandas["Ligand Pose"].to_list()
+    df_train_no_poses = pl.from_pandas(df_pandas.drop(["Ligand Pose"], axis=1))
     df_train = df_train_no_poses.with_columns(
         pl.Series(name="ligand_pose", values=just_poses, dtype=pl.Object)
     )
-    df_train = df_train.rename(
-        {
-            "Chain B Sequence": "chain_b_sequence",
-            "Protein Label": "protein_label",
-            "Chain A Sequence": "chain_a_sequence",
-        }
-    ).select(
+    df_train = df_train.rename(RENAME_COLUMNS).select(
         [
             "protein_label",
             "CXSMILES",
@@ -124,37 +125,74 @@ def get_df_train_for_comp(
     )
     df_train = add_fake_id_col(df_train, "train_fake_id")
     print_info(df_train)
-    if save:
-        logger.info("Saving...")
-        logger.info(
-            "NOOOPE we're not saving anything until we're smarter about persisting rdkit mol objects"
-        )
-        # asap_train_raw.save(df_train)
     return df_train
 
 
-@typechecked
-def get_df_test_for_comp(
-    comp: CompetitionSpecification, save: bool = False
-) -> pl.DataFrame:
+def _df_test_from_subset(test_subset) -> pl.DataFrame:
     """
-    Load test data as polars DataFrame
+    Build the test DataFrame from the test half of a Polaris train/test split.
     """
-    logger.info(f"Loading training dataframe for comp {comp.name}...")
-    df_test = pl.from_pandas(comp.get_train_test_split()[1].as_dataframe())
-    df_test = df_test.rename(
-        {
-            "Chain B Sequence": "chain_b_sequence",
-            "Protein Label": "protein_label",
-            "Chain A Sequence": "chain_a_sequence",
-        }
-    ).select(["protein_label", "CXSMILES", "chain_a_sequence", "chain_b_sequence"])
+    df_test = pl.from_pandas(test_subset.as_dataframe())
+    df_test = df_test.rename(RENAME_COLUMNS).select(
+        ["protein_label", "CXSMILES", "chain_a_sequence", "chain_b_sequence"]
+    )
     df_test = add_fake_id_col(df_test, "test_fake_id")
     print_info(df_test)
     return df_test
 
 
+def _snapshot_for_comp(comp: CompetitionSpecification):
+    """
+    Make sure the local snapshot is of comp and intact, writing it from Polaris if not.
+    """
+    manifest = read_snapshot_manifest()
+    if manifest is None or manifest.get("competition") != comp.name or snapshot_problem(manifest) is not None:
+        write_snapshot(comp)
+
+
+@timed("get_df_train_for_comp")
+@typechecked
+def get_df_train_for_comp(comp: CompetitionSpecification, decode_mols: bool = True) -> pl.DataFrame:
+    """
+    Load training data as polars DataFrame, from the local snapshot of comp.
+    ligand_pose holds RDKit mols unless not decode_mols, see snapshot.get_df_train.
+    """
+    logger.info(f"Loading training dataframe for comp {comp.name}...")
+    _snapshot_for_comp(comp)
+    return get_df_train(decode_mols=decode_mols, offline=True)
+
+
+@timed("get_df_test_for_comp")
+@typechecked
+def get_df_test_for_comp(comp: CompetitionSpecification) -> pl.DataFrame:
+    """
+    Load test data as polars DataFrame, from the local snapshot of comp.
+    """
+    logger.info(f"Loading test dataframe for comp {comp.name}...")
+    _snapshot_for_comp(comp)
+    return get_df_test(offline=True)
+
+
+@timed("get_dfs_for_comp")
+@typechecked
+def get_dfs_for_comp(
+    comp: CompetitionSpecification, save: bool = False
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Load both training and test data, splitting the competition only once.
+    """
+    logger.info(f"Loading train and test dataframes for comp {comp.name}...")
+    train_subset, test_subset = comp.get_train_test_split()
+    df_train = _df_train_from_subset(train_subset)
+    df_test = _df_test_from_subset(test_subset)
+    if save:
+        asap_train_raw.save(df_train)
+        asap_test_raw.save(df_test)
+    return df_train, df_test
+
+
 def download_comp_data():
     comp = load_comp()
-    download_raw_data_packages()
-    download_reference_structures()
+    write_snapshot(comp)
+    # Both zips download concurrently, and resume if interrupted
+    fetch_and_extract([raw_data_package_artifact(), reference_structures_artifact()])
@@ -0,0 +1,217 @@
+"""
+Does a docking mode that's meant to save time keep the answers?  Measured against a fixed reference.
+
+A sample of test ligands is docked three ways, with no cache, each into its own files:
+
+    reference  REFERENCE_FIDELITY: more search than anything we'd run for real, pooled over several seeds
+    default    what the pipeline does without any mode flags: one run at DEFAULT_EXHAUSTIVENESS
+    <mode>     the mode being evaluated: adaptive or two_stage
+
+For default and the mode, we record the CPU time gnina used (the child processes this one reaped, so
+use the prebuilt or pool backend with pool_backend="subprocess": docker's CPU time happens in the daemon),
+and per ligand, the RMSD of the top pose to the reference's top pose.  A mode is worth having if it
+saves CPU without keeping the reference's top pose for fewer ligands than default does.
+
+Per-ligand results go to data/combined/evaluation_<mode>.parquet, and the summary to evaluation_<mode>.json.
+The benchmarks in benchmarks/ can't answer this: their fake gnina is built to behave the way the modes assume.
+"""
+
+import dataclasses
+import json
+import resource
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import polars as pl
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.adaptive import DEFAULT_RMSD_CUTOFF, Fidelity, run_adaptive
+from polaris_asap_poses.gnina import (DEFAULT_EXHAUSTIVENESS, GninaJob,
+                                      get_gnina_jobs, gnina_pose_order,
+                                      log_dir_gnina, pose_affinity,
+                                      run_gnina_jobs, run_two_stage)
+from polaris_asap_poses.io import (NamedDataset, data_dir_combined,
+                                   data_dir_gnina_out, iter_sdf)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.rmsd import pose_rmsd
+from polaris_asap_poses.snapshot import get_df_test
+
+
+def data_dir_gnina_out_evaluation() -> Path:
+    return data_dir_gnina_out() / "evaluation"
+
+
+REFERENCE_FIDELITY = Fidelity(exhaustiveness=2 * DEFAULT_EXHAUSTIVENESS, n_seeds=4)
+# Reference seeds start here, so none of its runs repeat one of the other arms'
+REFERENCE_SEED_OFFSET = 1000
+MODES = ("adaptive", "two_stage")
+
+
+def mode_evaluation(mode: str) -> NamedDataset:
+    return NamedDataset(
+        name=f"evaluation_{mode}",
+        filepath=data_dir_combined() / f"evaluation_{mode}.parquet",
+    )
+
+
+def evaluation_summary_path(mode: str) -> Path:
+    return data_dir_combined() / f"evaluation_{mode}.json"
+
+
+def arm_job(job: GninaJob, arm: str, seed: int | None = None) -> GninaJob:
+    """
+    The same job, writing to the evaluation dir under a name of its own.
+    """
+    name = f"{arm}_{job.output_sdf.stem}" if seed is None else f"{arm}_{job.output_sdf.stem}_seed{seed}"
+    return dataclasses.replace(
+        job,
+        output_sdf=data_dir_gnina_out_evaluation() / f"{name}.sdf",
+        log_file=log_dir_gnina() / f"evaluation_{name}.log",
+        seed=job.seed if seed is None else seed,
+    )
+
+
+def _children_cpu_s() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _top_pose(paths: List[Path]) -> Chem.Mol | None:
+    poses = [pose for path in paths if path.exists() for pose in iter_sdf(path)]
+    return min(poses, key=gnina_pose_order) if poses else None
+
+
+def _run_arm(arm: str, jobs: List[GninaJob], n_workers: int, backend: str) -> Dict[int, List[Path]]:
+    """
+    Dock jobs the way arm says to, without a cache.  Returns each job's output files, by test_fake_id.
+    """
+    if arm == "reference":
+        reference = REFERENCE_FIDELITY
+        runs = {
+            job.test_fake_id: [
+                dataclasses.replace(arm_job(job, arm, seed=job.seed + offset), exhaustiveness=reference.exhaustiveness)
+                for offset in range(REFERENCE_SEED_OFFSET, REFERENCE_SEED_OFFSET + reference.n_seeds)
+            ]
+            for job in jobs
+        }
+        run_gnina_jobs([run for x in runs.values() for run in x], n_workers=n_workers, backend=backend)
+        return {test_fake_id: [run.output_sdf for run in x] for test_fake_id, x in runs.items()}
+    arm_jobs = [arm_job(job, arm) for job in jobs]
+    if arm == "default":
+        run_gnina_jobs(arm_jobs, n_workers=n_workers, backend=backend)
+    elif arm == "adaptive":
+        run_adaptive(arm_jobs, n_workers=n_workers, backend=backend, save=False)
+    elif arm == "two_stage":
+        run_two_stage(arm_jobs, n_workers=n_workers, backend=backend, prefix="evaluation_rescore")
+    else:
+        raise ValueError(f"Unknown mode {arm}, expected one of {MODES}")
+    return {job.test_fake_id: [job.output_sdf] for job in arm_jobs}
+
+
+@typechecked
+def evaluate_mode(
+    mode: str,
+    n_ligands: int = 48,
+    seed: int = 0,
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    rmsd_cutoff: float = DEFAULT_RMSD_CUTOFF,
+) -> Dict[str, Any]:
+    """
+    Dock a sample of n_ligands test ligands (picked by seed) as the reference, default and mode arms,
+    and compare default and mode against the reference.  Returns the summary, and saves it and the
+    per-ligand results (see the module docstring).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+    if seed < 0:
+        raise ValueError("evaluate_mode needs a fixed seed (>= 0) to be reproducible")
+    logger.info("Start.")
+    data_dir_gnina_out_evaluation().mkdir(parents=True, exist_ok=True)
+    df_test = get_df_test()
+    df_sample = df_test.sample(n=min(n_ligands, len(df_test)), seed=seed).sort("test_fake_id")
+    jobs = get_gnina_jobs(df_sample, seed=seed, cpus_per_job=1)
+
+    outputs = {}
+    arms = {}
+    for arm in ["reference", "default", mode]:
+        logger.info(f"Docking {len(jobs)} ligands for the {arm} arm...")
+        cpu_start, wall_start = _children_cpu_s(), time.perf_counter()
+        with timed("evaluate_arm", mode=mode, arm=arm, n_ligands=len(jobs)):
+            outputs[arm] = _run_arm(arm, jobs, n_workers=n_workers, backend=backend)
+        arms[arm] = {"cpu_s": _children_cpu_s() - cpu_start, "wall_s": time.perf_counter() - wall_start}
+
+    rows = []
+    for job in jobs:
+        reference = _top_pose(outputs["reference"][job.test_fake_id])
+        for arm in ["default", mode]:
+            top = _top_pose(outputs[arm][job.test_fake_id])
+            rmsd = None if reference is None or top is None else float(pose_rmsd(reference, [top])[0])
+            rows.append(
+                {
+                    "test_fake_id": job.test_fake_id,
+                    "protein_label": job.protein.data_label,
+                    "arm": arm,
+                    "rmsd_to_reference": rmsd,
+                    "affinity": None if top is None else pose_affinity(top),
+                    "reference_affinity": None if reference is None else pose_affinity(reference),
+                }
+            )
+    df = pl.DataFrame(
+        rows,
+        schema={
+            "test_fake_id": pl.Int64,
+            "protein_label": pl.String,
+            "arm": pl.String,
+            "rmsd_to_reference": pl.Float64,
+            "affinity": pl.Float64,
+            "reference_affinity": pl.Float64,
+        },
+    )
+    mode_evaluation(mode).save(df)
+
+    for arm in ["default", mode]:
+        rmsds = df.filter(pl.col("arm") == arm)["rmsd_to_reference"].drop_nulls().to_numpy()
+        arms[arm] |= {
+            "n_top_pose_kept": int((rmsds <= rmsd_cutoff).sum()),
+            "median_rmsd_to_reference": float(np.median(rmsds)) if len(rmsds) else None,
+        }
+    summary = {
+        "mode": mode,
+        "n_ligands": len(jobs),
+        "seed": seed,
+        "backend": backend,
+        "rmsd_cutoff": rmsd_cutoff,
+        "reference": dataclasses.asdict(REFERENCE_FIDELITY),
+        "arms": arms,
+        "cpu_saved_s": arms["default"]["cpu_s"] - arms[mode]["cpu_s"],
+    }
+    evaluation_summary_path(mode).write_text(json.dumps(summary, indent=2))
+    logger.info(f"Done. {json.dumps(summary)}")
+    return summary
+
+
+def evaluation_report(summary: Dict[str, Any]) -> str:
+    """
+    A few lines on how the mode did against default, for the terminal.
+    """
+    mode, arms = summary["mode"], summary["arms"]
+    lines = [
+        f"{summary['n_ligands']} ligands, seed {summary['seed']}, reference {Fidelity(**summary['reference'])}, "
+        f"top pose kept if within {summary['rmsd_cutoff']} A of the reference's."
+    ]
+    for arm in ["default", mode]:
+        median = arms[arm]["median_rmsd_to_reference"]
+        lines.append(
+            f"{arm:<10} CPU {arms[arm]['cpu_s']:8.1f}s  wall {arms[arm]['wall_s']:7.1f}s  "
+            f"top pose kept {arms[arm]['n_top_pose_kept']}/{summary['n_ligands']}  "
+            f"median RMSD {'-' if median is None else f'{median:.2f}'}"
+        )
+    default_cpu = arms["default"]["cpu_s"]
+    saved = f" ({summary['cpu_saved_s'] / default_cpu:.0%})" if default_cpu > 0 else ""
+    lines.append(f"{mode} saved {summary['cpu_saved_s']:.1f}s CPU against default{saved}.")
+    return "\n".join(lines)
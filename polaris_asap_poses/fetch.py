@@ -0,0 +1,208 @@
+"""
+Download engine for the competition's zip artifacts.
+
+Artifacts are fetched concurrently into data/raw/downloads.  Each download streams into a `.part` file
+and resumes from where it stopped with an HTTP Range request, falling back to a full download if the
+server ignores ranges.  A download only counts as finished once it has as many bytes as the server said
+it would (urllib doesn't complain when a connection drops mid-body), and then it's checked against the
+artifact's pinned sha256, if it has one.  The checksum is kept next to it in a `.sha256` file, so an
+artifact that's already there and still matches is skipped.  Zips are then extracted with their members
+spread over a process pool.
+
+Nothing here is specific to Polaris; any HTTP server works, including `python -m http.server`.
+"""
+
+import multiprocessing
+import os
+import re
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+from urllib.parse import urlparse
+
+from polaris_asap_poses.cache import sha256_file
+from polaris_asap_poses.io import data_dir_raw
+from polaris_asap_poses.logger import logger
+
+
+def data_dir_downloads() -> Path:
+    return data_dir_raw() / "downloads"
+
+
+@dataclass
+class Artifact:
+    name: str
+    url: str
+    extract_dir: Path
+    sha256: str | None = None  # If we know it up front; otherwise we record our own after the first download
+
+    def download_path(self, download_dir: Path | None = None) -> Path:
+        download_dir = data_dir_downloads() if download_dir is None else download_dir
+        return download_dir / Path(urlparse(self.url).path).name
+
+
+def _checksum_path(path: Path) -> Path:
+    return path.with_name(path.name + ".sha256")
+
+
+def _expected_checksum(artifact: Artifact, dest: Path) -> str | None:
+    if artifact.sha256 is not None:
+        return artifact.sha256
+    if _checksum_path(dest).exists():
+        return _checksum_path(dest).read_text().strip()
+    return None
+
+
+def _content_range(header: str | None) -> tuple[int | None, int | None]:
+    """
+    Start and total size from a Content-Range header, e.g. "bytes 100-199/1000" or "bytes */1000".
+    """
+    match = re.fullmatch(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", (header or "").strip())
+    if match is None:
+        return None, None
+    start, total = match.groups()
+    return (None if start is None else int(start)), (None if total == "*" else int(total))
+
+
+def _download_to_part(url: str, part: Path, chunk_size: int, timeout: float):
+    """
+    Stream url into part, resuming from part's current size when the server supports ranges.
+    Raises ConnectionError if the body ends before the size the server announced.
+    """
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        _, total = _content_range(e.headers.get("Content-Range"))
+        if e.code == 416 and offset and total == offset:
+            # Range starts at the end of the file, so there's nothing left to fetch
+            return
+        raise
+    with response:
+        start, total = _content_range(response.headers.get("Content-Range"))
+        if offset and (response.status != 206 or start != offset):
+            logger.info(f"Server ignored the range request for {url}, starting over")
+            offset = 0
+        elif offset:
+            logger.info(f"Resuming {url} at byte {offset}")
+        if response.status != 206:
+            length = response.headers.get("Content-Length")
+            total = None if length is None else int(length)
+        with open(part, "ab" if offset else "wb") as fd:
+            while chunk := response.read(chunk_size):
+                fd.write(chunk)
+    size = part.stat().st_size
+    if total is None:
+        logger.warning(f"{url} didn't say how big it is, so there's no telling whether all {size} bytes arrived")
+    elif size != total:
+        raise ConnectionError(f"Got {size} of {total} bytes from {url}")
+
+
+def fetch_artifact(
+    artifact: Artifact,
+    download_dir: Path | None = None,
+    retries: int = 5,
+    chunk_size: int = 1 << 20,
+    timeout: float = 60.0,
+) -> Path:
+    """
+    Download one artifact, unless a copy with a matching checksum is already there.
+    """
+    download_dir = data_dir_downloads() if download_dir is None else download_dir
+    download_dir.mkdir(parents=True, exist_ok=True)
+    dest = artifact.download_path(download_dir)
+    expected = _expected_checksum(artifact, dest)
+    if dest.exists():
+        actual = sha256_file(dest)
+        if actual == expected:
+            logger.info(f"{artifact.name} is already at {dest}, skipping download")
+            _checksum_path(dest).write_text(actual)
+            return dest
+        if expected is None:
+            # Not ours (we write the checksum as soon as a download completes), so nothing vouches for it
+            logger.warning(f"No checksum to check {dest} against, downloading it again")
+        else:
+            logger.warning(f"Checksum mismatch for {dest}, downloading it again")
+        dest.unlink()
+
+    part = dest.with_name(dest.name + ".part")
+    for attempt in range(1, retries + 1):
+        try:
+            logger.info(f"Downloading {artifact.name} from {artifact.url} (attempt {attempt})...")
+            _download_to_part(artifact.url, part, chunk_size=chunk_size, timeout=timeout)
+            break
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Download of {artifact.name} interrupted: {e!r}")
+            if attempt == retries:
+                raise
+
+    actual = sha256_file(part)
+    if artifact.sha256 is None:
+        logger.warning(f"No pinned sha256 for {artifact.name}, so trusting this download: {actual}")
+    elif actual != artifact.sha256:
+        part.unlink()
+        raise ValueError(f"Checksum mismatch for {artifact.name}: expected {artifact.sha256}, got {actual}")
+    _checksum_path(dest).write_text(actual)
+    part.replace(dest)
+    logger.info(f"Downloaded {artifact.name} to {dest}.")
+    return dest
+
+
+def _member_dir(extract_dir: Path, member: str) -> Path:
+    """
+    The directory ZipFile.extract puts a member in, which drops empty, "." and ".." path components.
+    """
+    parts = [x for x in member.split("/") if x not in ("", ".", "..")]
+    return extract_dir.joinpath(*parts[:-1])
+
+
+def _extract_members(zip_path: Path, members: List[str], extract_dir: Path):
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        for member in members:
+            zip_ref.extract(member, extract_dir)
+
+
+def extract_zip(zip_path: Path, extract_dir: Path, processes: int | None = None):
+    """
+    Extract a zip with its members spread over a process pool.
+    Skipped if this exact zip (by checksum) was already extracted to extract_dir.
+    """
+    marker = extract_dir / f".extracted-{zip_path.name}.sha256"
+    checksum = _checksum_path(zip_path).read_text().strip() if _checksum_path(zip_path).exists() else sha256_file(zip_path)
+    if marker.exists() and marker.read_text().strip() == checksum:
+        logger.info(f"{zip_path} is already extracted to {extract_dir}, skipping")
+        return
+    extract_dir.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        infos = [x for x in zip_ref.infolist() if not x.is_dir()]
+    # Deal the biggest members out first, round-robin, so the workers get similar amounts of work
+    infos.sort(key=lambda x: x.file_size, reverse=True)
+    n_groups = max(1, min(processes or 8, len(infos)))
+    groups = [[x.filename for x in infos[i::n_groups]] for i in range(n_groups)]
+    # ZipFile.extract creates missing parent dirs without exist_ok, so workers sharing a dir would race to create it
+    for member_dir in {_member_dir(extract_dir, x.filename) for x in infos}:
+        os.makedirs(member_dir, exist_ok=True)
+    logger.info(f"Extracting {len(infos)} files from {zip_path} to {extract_dir}...")
+    # Spawn, since forking a process that has other threads running (e.g. a caller's downloads) can deadlock
+    with ProcessPoolExecutor(max_workers=n_groups, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for future in [executor.submit(_extract_members, zip_path, group, extract_dir) for group in groups]:
+            future.result()
+    marker.write_text(checksum)
+    logger.info("Done.")
+
+
+def fetch_and_extract(artifacts: List[Artifact], download_dir: Path | None = None, processes: int | None = None):
+    """
+    Download all artifacts concurrently, then extract each of them.
+    """
+    download_dir = data_dir_downloads() if download_dir is None else download_dir
+    with ThreadPoolExecutor(max_workers=len(artifacts) or 1) as executor:
+        paths = list(executor.map(lambda x: fetch_artifact(x, download_dir=download_dir), artifacts))
+    for artifact, path in zip(artifacts, paths):
+        extract_zip(path, artifact.extract_dir, processes=processes)
@@ -0,0 +1,905 @@
+import dataclasses
+import functools
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import polars as pl
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.cache import DockingCache
+from polaris_asap_poses.container_pool import (CONTAINER_MOUNT, POOL_BACKENDS,
+                                               ContainerPool, get_docker)
+from polaris_asap_poses.io import (data_dir_gnina_out, data_dir_ligand_sdf,
+                                   ensure_data_dirs, home_dir, iter_sdf,
+                                   write_sdfs)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import run_measured, timed
+from polaris_asap_poses.model import PROTEINS, Protein, get_protein
+from polaris_asap_poses.settings import get_settings
+from polaris_asap_poses.snapshot import get_df_test, get_df_train
+from polaris_asap_poses.template import template_pose_path, write_template_poses
+
+
+def log_dir() -> Path:
+    return home_dir() / "log"
+
+
+def log_dir_gnina() -> Path:
+    return log_dir() / "gnina"
+
+
+def data_dir_ligand_sdf_chunks() -> Path:
+    return data_dir_ligand_sdf() / "chunks"
+
+
+def data_dir_gnina_out_chunks() -> Path:
+    return data_dir_gnina_out() / "chunks"
+
+
+def data_dir_gnina_out_candidates() -> Path:
+    return data_dir_gnina_out() / "candidates"
+
+
+DEFAULT_EXHAUSTIVENESS = 16
+
+# Two-stage mode: how many poses to ask for from the CNN-free search, and how many per ligand to rescore
+DEFAULT_N_CANDIDATES = 20
+DEFAULT_RESCORE_TOP_N = 9
+
+
+@functools.cache
+def gnina_bin() -> str:
+    """
+    settings.gnina_bin, read on first use.  Relative to POLARIS_ASAP_POSES_HOME, which is where gnina gets run from.
+    """
+    return get_settings().gnina_bin
+
+
+@dataclass
+class GninaJob:
+    """
+    Everything needed to dock one test ligand against one receptor.
+    """
+
+    test_fake_id: int
+    protein: Protein
+    ligand_sdf: Path
+    output_sdf: Path
+    log_file: Path
+    seed: int = 0
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS
+    cpu: int | None = None
+    cnn_scoring: str | None = None  # gnina's --cnn_scoring, None for its default (rescore)
+    num_modes: int | None = None  # gnina's --num_modes, None for its default (9)
+
+
+def pose_affinity(mol: Chem.Mol) -> float:
+    return mol.GetDoubleProp("minimizedAffinity") if mol.HasProp("minimizedAffinity") else math.inf
+
+
+def gnina_pose_order(mol: Chem.Mol):
+    """
+    Sort key that ranks poses like gnina does: by CNNscore when it has one, and by affinity when CNN scoring is off.
+    """
+    cnn_score = mol.GetDoubleProp("CNNscore") if mol.HasProp("CNNscore") else 0.0
+    return -cnn_score, pose_affinity(mol)
+
+
+def _gnina_args(
+    protein_pdb: Path,
+    ligand_sdf: Path,
+    autobox_ligand_sdf: Path,
+    output_sdf: Path,
+    log_file: Path,
+    seed: int,
+    exhaustiveness: int,
+    cpu: int | None,
+    cnn_scoring: str | None = None,
+    num_modes: int | None = None,
+    minimize: bool = False,
+    prefix: str = "",
+) -> List[str]:
+    """
+    Build gnina's command-line args, with every path relative to POLARIS_ASAP_POSES_HOME.
+    Use prefix="/scr/" when running inside the container.
+    With minimize, gnina doesn't search: it minimizes and scores the input poses as they are.
+    """
+
+    def rel(path: Path) -> str:
+        return f"{prefix}{Path(path).relative_to(home_dir())}"
+
+    args = [
+        "-r", rel(protein_pdb),
+        "-l", rel(ligand_sdf),
+        "--autobox_ligand", rel(autobox_ligand_sdf),
+        "-o", rel(output_sdf),
+        "--log", rel(log_file),
+        "--exhaustiveness", str(exhaustiveness),
+    ]  # fmt: skip
+    if seed >= 0:
+        args += ["--seed", str(seed)]
+    if cpu is not None:
+        args += ["--cpu", str(cpu)]
+    if cnn_scoring is not None:
+        args += ["--cnn_scoring", cnn_scoring]
+    if num_modes is not None:
+        args += ["--num_modes", str(num_modes)]
+    if minimize:
+        args += ["--minimize"]
+    return args
+
+
+def run_gnina_docker(
+    protein_pdb: Path | str,
+    ligand_sdf: Path | str,
+    autobox_ligand_sdf: Path | str,
+    output_sdf: Path | str,
+    seed: int = 0,
+    log_file: Path | str | None = None,
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS,
+    cpu: int | None = None,
+    cnn_scoring: str | None = None,
+    num_modes: int | None = None,
+    minimize: bool = False,
+):
+    log_file = log_dir() / "gnina.log" if log_file is None else log_file
+    logger.info("Running gnina via docker...")
+
+    cmd = ["gnina"] + _gnina_args(
+        protein_pdb=protein_pdb,
+        ligand_sdf=ligand_sdf,
+        autobox_ligand_sdf=autobox_ligand_sdf,
+        output_sdf=output_sdf,
+        log_file=log_file,
+        seed=seed,
+        exhaustiveness=exhaustiveness,
+        cpu=cpu,
+        cnn_scoring=cnn_scoring,
+        num_modes=num_modes,
+        minimize=minimize,
+        prefix="/scr/",
+    )
+
+    logger.info(f"Command: {' '.join(cmd)}")
+
+    result = get_docker().run(
+        image="gnina/gnina",
+        command=cmd,
+        volumes=[(home_dir(), "/scr")],
+        remove=True,
+    )
+    logger.info(result)
+    logger.info("Done.")
+
+
+def run_gnina_prebuilt(
+    protein_pdb: Path | str,
+    ligand_sdf: Path | str,
+    autobox_ligand_sdf: Path | str,
+    output_sdf: Path | str,
+    seed: int = 0,
+    log_file: Path | str | None = None,
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS,
+    cpu: int | None = None,
+    cnn_scoring: str | None = None,
+    num_modes: int | None = None,
+    minimize: bool = False,
+):
+    log_file = log_dir() / "gnina.log" if log_file is None else log_file
+    logger.info("Running gnina (prebuilt)...")
+
+    cmd = [gnina_bin()] + _gnina_args(
+        protein_pdb=protein_pdb,
+        ligand_sdf=ligand_sdf,
+        autobox_ligand_sdf=autobox_ligand_sdf,
+        output_sdf=output_sdf,
+        log_file=log_file,
+        seed=seed,
+        exhaustiveness=exhaustiveness,
+        cpu=cpu,
+        cnn_scoring=cnn_scoring,
+        num_modes=num_modes,
+        minimize=minimize,
+    )
+
+    logger.info(f"Command: {' '.join(cmd)}")
+
+    result = run_measured(cmd, check=True)
+
+    logger.info(result)
+    logger.info("Done.")
+
+
+def run_gnina_pool(
+    protein_pdb: Path | str,
+    ligand_sdf: Path | str,
+    autobox_ligand_sdf: Path | str,
+    output_sdf: Path | str,
+    pool: ContainerPool,
+    seed: int = 0,
+    log_file: Path | str | None = None,
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS,
+    cpu: int | None = None,
+    cnn_scoring: str | None = None,
+    num_modes: int | None = None,
+    minimize: bool = False,
+):
+    log_file = log_dir() / "gnina.log" if log_file is None else log_file
+    logger.info("Running gnina in a pooled container...")
+
+    cmd = ["gnina"] + _gnina_args(
+        protein_pdb=protein_pdb,
+        ligand_sdf=ligand_sdf,
+        autobox_ligand_sdf=autobox_ligand_sdf,
+        output_sdf=output_sdf,
+        log_file=log_file,
+        seed=seed,
+        exhaustiveness=exhaustiveness,
+        cpu=cpu,
+        cnn_scoring=cnn_scoring,
+        num_modes=num_modes,
+        minimize=minimize,
+        prefix=f"{CONTAINER_MOUNT}/",
+    )
+
+    logger.info(f"Command: {' '.join(cmd)}")
+
+    result = pool.exec(cmd)
+    logger.info(result)
+    logger.info("Done.")
+
+
+GNINA_BACKENDS: Dict[str, Callable] = {
+    "prebuilt": run_gnina_prebuilt,
+    "docker": run_gnina_docker,
+    "pool": run_gnina_pool,
+}
+
+
+def _get_runner(backend: str, pool: ContainerPool | None = None) -> Callable:
+    if backend not in GNINA_BACKENDS:
+        raise ValueError(f"Unsupported gnina backend: {backend}")
+    if backend == "pool":
+        if pool is None:
+            raise ValueError("The pool backend needs a ContainerPool")
+        return functools.partial(run_gnina_pool, pool=pool)
+    return GNINA_BACKENDS[backend]
+
+
+@functools.cache
+def get_gnina_version(backend: str = "prebuilt", pool: ContainerPool | None = None) -> str:
+    """
+    Ask gnina for its version string, since a different gnina means different results.
+    """
+    if backend == "pool":
+        output = pool.exec(["gnina", "--version"])
+    elif backend == "docker":
+        output = get_docker().run(image="gnina/gnina", command=["gnina", "--version"], remove=True)
+    else:
+        output = run_measured([gnina_bin(), "--version"], check=True, capture_output=True, text=True).stdout
+    return str(output).strip()
+
+
+def get_cache_key(cache: DockingCache, job: GninaJob, gnina_version: str) -> str:
+    """
+    Cache key for a job.  Leaves out cpu and log_file, which don't change the poses.
+    """
+    inputs = {
+        "receptor": job.protein.ref_pdb_path,
+        "ligand": job.ligand_sdf,
+        "autobox_ligand": job.protein.ref_ligand_sdf_path,
+    }
+    params: Dict[str, Any] = {
+        "gnina_version": gnina_version,
+        "exhaustiveness": job.exhaustiveness,
+        "seed": job.seed,
+    }
+    # Only when set, so results docked before these were options keep their keys
+    if job.cnn_scoring is not None:
+        params["cnn_scoring"] = job.cnn_scoring
+    if job.num_modes is not None:
+        params["num_modes"] = job.num_modes
+    return cache.key(inputs, params)
+
+
+@typechecked
+def get_gnina_jobs(
+    df_test: pl.DataFrame,
+    seed: int = 0,
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS,
+    cpus_per_job: int | None = None,
+) -> List[GninaJob]:
+    """
+    Turn each row of df_test into a GninaJob, each with its own log file.
+    """
+    jobs = []
+    for row in df_test.iter_rows(named=True):
+        try:
+            this_protein = get_protein(row["protein_label"])
+        except ValueError:
+            raise ValueError(
+                f"Invalid protein_label {row['protein_label']} for test_fake_id {row['test_fake_id']}"
+            )
+        output_sdf = this_protein.docking_result_path(row["test_fake_id"])
+        jobs.append(
+            GninaJob(
+                test_fake_id=row["test_fake_id"],
+                protein=this_protein,
+                ligand_sdf=this_protein.test_ligand_sdf_path(row["test_fake_id"]),
+                output_sdf=output_sdf,
+                log_file=log_dir_gnina() / f"{output_sdf.stem}.log",
+                seed=seed,
+                exhaustiveness=exhaustiveness,
+                cpu=cpus_per_job,
+            )
+        )
+    return jobs
+
+
+def run_gnina_job(job: GninaJob, backend: str = "prebuilt", pool: ContainerPool | None = None):
+    """
+    Dock a single GninaJob with the given backend.
+    """
+    with timed("gnina_job", test_fake_id=job.test_fake_id, protein=job.protein.name, backend=backend):
+        _get_runner(backend, pool)(
+            protein_pdb=job.protein.ref_pdb_path,
+            ligand_sdf=job.ligand_sdf,
+            autobox_ligand_sdf=job.protein.ref_ligand_sdf_path,
+            output_sdf=job.output_sdf,
+            seed=job.seed,
+            log_file=job.log_file,
+            exhaustiveness=job.exhaustiveness,
+            cpu=job.cpu,
+            cnn_scoring=job.cnn_scoring,
+            num_modes=job.num_modes,
+        )
+
+
+@dataclass
+class GninaBatch:
+    """
+    A chunk of GninaJobs against the same receptor, docked by a single gnina process.
+    The receptor, autobox grid and CNN models are loaded once for the whole chunk.
+    With minimize, ligand_sdf holds poses to rescore rather than ligands to dock.
+    """
+
+    name: str
+    protein: Protein
+    jobs: List[GninaJob]
+    ligand_sdf: Path
+    output_sdf: Path
+    log_file: Path
+    minimize: bool = False
+
+
+def _timed(fn: Callable, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _fan_out(
+    tasks: List[Any],
+    fn: Callable,
+    n_workers: int,
+    describe: Callable[[Any], str],
+    on_success: Callable[[Any], None] | None = None,
+) -> List[Any]:
+    """
+    Run fn(task) for every task on a pool of n_workers threads, logging progress as tasks finish.
+    Returns the tasks that failed.
+    """
+    n_total = len(tasks)
+    n_done = 0
+    failed = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_timed, fn, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            n_done += 1
+            try:
+                elapsed = future.result()
+                if on_success is not None:
+                    on_success(task)
+                logger.info(
+                    f"[{n_done}/{n_total}] Docked {describe(task)} in {elapsed:.1f}s, "
+                    f"{time.perf_counter() - start:.0f}s elapsed overall."
+                )
+            except Exception as e:
+                failed.append(task)
+                logger.error(f"[{n_done}/{n_total}] Failed {describe(task)}: {e!r}. See {task.log_file}")
+    return failed
+
+
+def _filter_cached(
+    jobs: List[GninaJob], backend: str, cache: DockingCache | None, pool: ContainerPool | None = None
+) -> Tuple[List[GninaJob], Dict[int, str]]:
+    """
+    Drop jobs whose outputs are already in the cache, and return the cache keys for the rest.
+    Jobs with a random seed (seed < 0) aren't reproducible, so they get no key and always run.
+    """
+    if cache is None:
+        return jobs, {}
+    gnina_version = get_gnina_version(backend, pool)
+    keys = {id(job): get_cache_key(cache, job, gnina_version) for job in jobs if job.seed >= 0}
+    if len(keys) < len(jobs):
+        logger.info(f"Not caching {len(jobs) - len(keys)} jobs with a random seed, set a seed >= 0 to cache them.")
+    todo = [job for job in jobs if id(job) not in keys or not cache.is_valid(job.output_sdf, keys[id(job)])]
+    logger.info(f"Found {len(jobs) - len(todo)} of {len(jobs)} docking results in the cache.")
+    return todo, keys
+
+
+def _describe_job(job: GninaJob) -> str:
+    return f"test_fake_id {job.test_fake_id} ({job.protein.name})"
+
+
+def run_gnina_jobs(
+    jobs: List[GninaJob],
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+    raise_failed: bool = True,
+) -> List[GninaJob]:
+    """
+    Fan a list of GninaJobs out over a pool of n_workers.
+    The actual work happens in gnina subprocesses/containers, so threads are plenty here.
+    Failed jobs are logged as they happen and reported together at the end, in a RuntimeError,
+    or without raise_failed, returned for the caller to deal with.
+    With a cache, jobs whose outputs are still valid are skipped, and finished jobs are recorded.
+    """
+    _get_runner(backend, pool)
+    log_dir_gnina().mkdir(parents=True, exist_ok=True)
+    ensure_data_dirs()
+    jobs, keys = _filter_cached(jobs, backend, cache, pool)
+
+    def on_success(job: GninaJob):
+        if cache is not None and id(job) in keys:
+            cache.record(job.output_sdf, keys[id(job)])
+
+    try:
+        failed = _fan_out(
+            jobs,
+            lambda job: run_gnina_job(job, backend=backend, pool=pool),
+            n_workers=n_workers,
+            describe=_describe_job,
+            on_success=on_success,
+        )
+    finally:
+        if cache is not None:
+            cache.flush()
+    if failed and raise_failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(jobs)} gnina jobs failed, test_fake_ids: {[job.test_fake_id for job in failed]}"
+        )
+    return failed
+
+
+def _batch_mol_name(test_fake_id: int) -> str:
+    return f"test_{test_fake_id}"
+
+
+@typechecked
+def make_gnina_batches(jobs: List[GninaJob], chunk_size: int) -> List[GninaBatch]:
+    """
+    Group jobs by receptor and write each chunk of ligands into a single multi-molecule SDF.
+    Each molecule is named after its test_fake_id, which gnina carries through to its output.
+    """
+    data_dir_ligand_sdf_chunks().mkdir(parents=True, exist_ok=True)
+    data_dir_gnina_out_chunks().mkdir(parents=True, exist_ok=True)
+    batches = []
+    for protein in PROTEINS:
+        protein_jobs = [job for job in jobs if job.protein == protein]
+        for i in range(0, len(protein_jobs), chunk_size):
+            chunk = protein_jobs[i : i + chunk_size]
+            name = f"chunk_{protein.path_segment}_{i // chunk_size:04d}"
+            mols = []
+            for job in chunk:
+                mol = next(iter_sdf(job.ligand_sdf), None)
+                if mol is None:
+                    raise ValueError(f"Couldn't read ligand for test_fake_id {job.test_fake_id} from {job.ligand_sdf}")
+                mol.SetProp("_Name", _batch_mol_name(job.test_fake_id))
+                mol.SetIntProp("test_fake_id", job.test_fake_id)
+                mols.append(mol)
+            ligand_sdf = data_dir_ligand_sdf_chunks() / f"{name}.sdf"
+            write_sdfs(mols=mols, path=ligand_sdf)
+            batches.append(
+                GninaBatch(
+                    name=name,
+                    protein=protein,
+                    jobs=chunk,
+                    ligand_sdf=ligand_sdf,
+                    output_sdf=data_dir_gnina_out_chunks() / f"docked_{name}.sdf",
+                    log_file=log_dir_gnina() / f"docked_{name}.log",
+                )
+            )
+    return batches
+
+
+def split_gnina_batch_output(
+    batch: GninaBatch, sort_key: Callable[[Chem.Mol], Any] | None = None
+) -> List[GninaJob]:
+    """
+    Split a chunk's multi-ligand gnina output back into one pose file per test_fake_id.
+    Docked poses for each ligand come out consecutively, best first.  Minimized ones come out in
+    input order, so pass a sort_key (e.g. gnina_pose_order) to rank them.
+    Writes the ligands that have poses and returns the jobs that don't.
+    """
+    poses: Dict[str, List[Chem.Mol]] = {_batch_mol_name(job.test_fake_id): [] for job in batch.jobs}
+    for mol in iter_sdf(batch.output_sdf):
+        name = mol.GetProp("_Name")
+        if name not in poses and mol.HasProp("test_fake_id"):
+            name = _batch_mol_name(mol.GetIntProp("test_fake_id"))
+        if name not in poses:
+            logger.warning(f"Unexpected molecule {name} in {batch.output_sdf}")
+            continue
+        poses[name].append(mol)
+    missing = [job for job in batch.jobs if not poses[_batch_mol_name(job.test_fake_id)]]
+    if missing:
+        logger.warning(f"No poses for test_fake_ids {[job.test_fake_id for job in missing]} in {batch.output_sdf}")
+    for job in batch.jobs:
+        job_poses = poses[_batch_mol_name(job.test_fake_id)]
+        if not job_poses:
+            continue
+        if sort_key is not None:
+            job_poses = sorted(job_poses, key=sort_key)
+        write_sdfs(mols=job_poses, path=job.output_sdf)
+    return missing
+
+
+def run_gnina_batch(batch: GninaBatch, backend: str = "prebuilt", pool: ContainerPool | None = None) -> List[GninaJob]:
+    """
+    Dock (or with batch.minimize, rescore) a whole chunk with one gnina process, then split the results per ligand.
+    Seed, exhaustiveness, cpu and CNN settings are the same for every job in a chunk, so take them from the first.
+    Returns the jobs gnina wrote no poses for.
+    """
+    first = batch.jobs[0]
+    with timed(
+        "gnina_batch",
+        batch=batch.name,
+        protein=batch.protein.name,
+        backend=backend,
+        test_fake_ids=[job.test_fake_id for job in batch.jobs],
+    ):
+        _get_runner(backend, pool)(
+            protein_pdb=batch.protein.ref_pdb_path,
+            ligand_sdf=batch.ligand_sdf,
+            autobox_ligand_sdf=batch.protein.ref_ligand_sdf_path,
+            output_sdf=batch.output_sdf,
+            seed=first.seed,
+            log_file=batch.log_file,
+            exhaustiveness=first.exhaustiveness,
+            cpu=first.cpu,
+            cnn_scoring=first.cnn_scoring,
+            num_modes=first.num_modes,
+            minimize=batch.minimize,
+        )
+        return split_gnina_batch_output(batch, sort_key=gnina_pose_order if batch.minimize else None)
+
+
+def run_gnina_batches(
+    jobs: List[GninaJob],
+    chunk_size: int,
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+):
+    """
+    Like run_gnina_jobs, but dock chunk_size ligands per gnina process.
+    Bigger chunks amortize gnina's startup better, smaller chunks keep more workers busy.
+    """
+    _get_runner(backend, pool)
+    log_dir_gnina().mkdir(parents=True, exist_ok=True)
+    ensure_data_dirs()
+    jobs, keys = _filter_cached(jobs, backend, cache, pool)
+    batches = make_gnina_batches(jobs, chunk_size=chunk_size)
+    logger.info(f"Docking {len(jobs)} ligands in {len(batches)} chunks of up to {chunk_size}.")
+    failed, missing = _run_batches(batches, keys, n_workers=n_workers, backend=backend, cache=cache, pool=pool)
+    if failed or missing:
+        raise RuntimeError(
+            f"{len(failed)} of {len(batches)} gnina chunks failed: {[batch.name for batch in failed]}, "
+            f"and gnina wrote no poses for test_fake_ids {[job.test_fake_id for job in missing]}"
+        )
+
+
+def _run_batches(
+    batches: List[GninaBatch],
+    keys: Dict[int, str],
+    n_workers: int,
+    backend: str,
+    cache: DockingCache | None,
+    pool: ContainerPool | None,
+) -> Tuple[List[GninaBatch], List[GninaJob]]:
+    """
+    Run batches on n_workers threads, recording each ligand that got poses in the cache as its batch finishes.
+    Returns the batches that failed outright, and the jobs in the other batches that gnina wrote no poses for.
+    """
+    missing: Dict[str, List[GninaJob]] = {}
+
+    def run_batch(batch: GninaBatch):
+        missing[batch.name] = run_gnina_batch(batch, backend=backend, pool=pool)
+
+    def on_success(batch: GninaBatch):
+        if cache is not None:
+            missing_ids = {id(job) for job in missing[batch.name]}
+            for job in batch.jobs:
+                if id(job) in keys and id(job) not in missing_ids:
+                    cache.record(job.output_sdf, keys[id(job)])
+
+    try:
+        failed = _fan_out(
+            batches,
+            run_batch,
+            n_workers=n_workers,
+            describe=lambda batch: f"{batch.name} ({len(batch.jobs)} ligands)",
+            on_success=on_success,
+        )
+    finally:
+        if cache is not None:
+            cache.flush()
+    failed_names = {batch.name for batch in failed}
+    return failed, [job for name, jobs in missing.items() if name not in failed_names for job in jobs]
+
+
+def candidate_job(job: GninaJob, n_candidates: int = DEFAULT_N_CANDIDATES) -> GninaJob:
+    """
+    Stage one of two-stage docking: the same job with CNN scoring off, writing n_candidates poses off to the side.
+    """
+    name = f"{job.output_sdf.stem}_candidates"
+    return dataclasses.replace(
+        job,
+        output_sdf=data_dir_gnina_out_candidates() / f"{name}.sdf",
+        log_file=log_dir_gnina() / f"{name}.log",
+        cnn_scoring="none",
+        num_modes=n_candidates,
+    )
+
+
+@typechecked
+def make_rescore_batches(
+    jobs: List[GninaJob], candidates: Dict[int, GninaJob], top_n: int, prefix: str = "rescore"
+) -> List[GninaBatch]:
+    """
+    Gather each job's top_n candidate poses (by affinity) into one SDF per receptor, for a single gnina --minimize.
+    candidates maps test_fake_id to a job whose output_sdf holds the poses, e.g. its stage-one job (see candidate_job).
+    Jobs with no readable candidate poses are left out with a warning, so they don't hold up the rest.
+    """
+    data_dir_gnina_out_candidates().mkdir(parents=True, exist_ok=True)
+    batches = []
+    for protein in PROTEINS:
+        protein_jobs = []
+        mols = []
+        for job in [job for job in jobs if job.protein == protein]:
+            candidates_sdf = candidates[job.test_fake_id].output_sdf
+            poses = list(iter_sdf(candidates_sdf)) if candidates_sdf.exists() else []
+            if not poses:
+                logger.warning(f"No candidate poses for test_fake_id {job.test_fake_id} in {candidates_sdf}")
+                continue
+            protein_jobs.append(job)
+            for pose in sorted(poses, key=pose_affinity)[:top_n]:
+                pose.SetProp("_Name", _batch_mol_name(job.test_fake_id))
+                pose.SetIntProp("test_fake_id", job.test_fake_id)
+                mols.append(pose)
+        if not protein_jobs:
+            continue
+        name = f"{prefix}_{protein.path_segment}"
+        ligand_sdf = data_dir_gnina_out_candidates() / f"{name}_top{top_n}.sdf"
+        write_sdfs(mols=mols, path=ligand_sdf)
+        batches.append(
+            GninaBatch(
+                name=name,
+                protein=protein,
+                jobs=protein_jobs,
+                ligand_sdf=ligand_sdf,
+                output_sdf=data_dir_gnina_out_candidates() / f"{name}.sdf",
+                log_file=log_dir_gnina() / f"{name}.log",
+                minimize=True,
+            )
+        )
+    return batches
+
+
+def get_rescore_cache_key(
+    cache: DockingCache, job: GninaJob, candidates_sdf: Path, top_n: int, gnina_version: str
+) -> str:
+    inputs = {"receptor": job.protein.ref_pdb_path, "candidates": candidates_sdf}
+    params: Dict[str, Any] = {"gnina_version": gnina_version, "minimize": True, "top_n": top_n}
+    return cache.key(inputs, params)
+
+
+def run_two_stage(
+    jobs: List[GninaJob],
+    n_candidates: int = DEFAULT_N_CANDIDATES,
+    top_n: int = DEFAULT_RESCORE_TOP_N,
+    chunk_size: int = 0,
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+    prefix: str = "rescore",
+):
+    """
+    Dock without the CNN, then CNN-rescore each ligand's top_n poses with one gnina --minimize per receptor.
+    On CPU-only machines, CNN scoring every pose gnina tries during the search is most of its run time,
+    and this only pays for it on the poses we keep.  The rescored poses, best CNNscore first, go to each
+    job's output_sdf, like plain docking.  chunk_size applies to the search, as in run_gnina_batches,
+    and prefix names the rescoring batches (see rescore).
+    """
+    data_dir_gnina_out_candidates().mkdir(parents=True, exist_ok=True)
+    candidates = {job.test_fake_id: candidate_job(job, n_candidates) for job in jobs}
+    with timed("two_stage_search", n_ligands=len(jobs), n_candidates=n_candidates):
+        if chunk_size > 0:
+            run_gnina_batches(
+                list(candidates.values()),
+                chunk_size=chunk_size,
+                n_workers=n_workers,
+                backend=backend,
+                cache=cache,
+                pool=pool,
+            )
+        else:
+            run_gnina_jobs(list(candidates.values()), n_workers=n_workers, backend=backend, cache=cache, pool=pool)
+
+    with timed("two_stage_rescore", n_ligands=len(jobs), top_n=top_n):
+        rescore(
+            jobs, candidates, top_n=top_n, n_workers=n_workers, backend=backend, cache=cache, pool=pool, prefix=prefix
+        )
+
+
+def rescore(
+    jobs: List[GninaJob],
+    candidates: Dict[int, GninaJob],
+    top_n: int,
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+    prefix: str = "rescore",
+):
+    """
+    CNN-rescore the top_n poses in each job's candidates output_sdf with one gnina --minimize per receptor,
+    writing them to the job's output_sdf, best CNNscore first.
+    Ligands are recorded in the cache as their batch finishes.  The ones in a batch that failed, or that gnina
+    wrote no poses for, are retried once, each in a batch of its own, so one bad ligand can't sink the rest.
+    """
+    log_dir_gnina().mkdir(parents=True, exist_ok=True)
+    todo, keys = jobs, {}
+    if cache is not None:
+        gnina_version = get_gnina_version(backend, pool)
+        keys = {
+            id(job): get_rescore_cache_key(cache, job, candidates[job.test_fake_id].output_sdf, top_n, gnina_version)
+            for job in jobs
+        }
+        todo = [job for job in jobs if not cache.is_valid(job.output_sdf, keys[id(job)])]
+        logger.info(f"Found {len(jobs) - len(todo)} of {len(jobs)} rescored results in the cache.")
+    batches = make_rescore_batches(todo, candidates, top_n=top_n, prefix=prefix)
+    batched = {id(job) for batch in batches for job in batch.jobs}
+    no_candidates = [job for job in todo if id(job) not in batched]
+    logger.info(f"Rescoring the top {top_n} poses of {len(batched)} ligands in {len(batches)} per-receptor batches.")
+    failed, missing = _run_batches(batches, keys, n_workers=n_workers, backend=backend, cache=cache, pool=pool)
+    retry = [job for batch in failed for job in batch.jobs] + missing
+    if retry:
+        logger.info(f"Retrying {len(retry)} ligands one at a time: test_fake_ids {[job.test_fake_id for job in retry]}")
+        batches = [
+            batch
+            for job in retry
+            for batch in make_rescore_batches([job], candidates, top_n=top_n, prefix=f"{prefix}_{job.test_fake_id}")
+        ]
+        failed, missing = _run_batches(batches, keys, n_workers=n_workers, backend=backend, cache=cache, pool=pool)
+        retry = [job for batch in failed for job in batch.jobs] + missing
+    if no_candidates or retry:
+        raise RuntimeError(
+            f"Couldn't rescore {len(no_candidates) + len(retry)} of {len(todo)} ligands: "
+            f"test_fake_ids {[job.test_fake_id for job in no_candidates]} have no candidate poses, "
+            f"and test_fake_ids {[job.test_fake_id for job in retry]} failed twice"
+        )
+
+
+def score_template_poses(
+    jobs: List[GninaJob],
+    n_workers: int = 1,
+    backend: str = "prebuilt",
+    cache: DockingCache | None = None,
+    pool: ContainerPool | None = None,
+):
+    """
+    Give template-transferred poses (see template.py) gnina's affinities and CNN scores, so they're
+    ranked and selected like docked ones.  Each job's poses are read from its template_pose_path.
+    """
+    candidates = {
+        job.test_fake_id: dataclasses.replace(job, output_sdf=template_pose_path(job.protein, job.test_fake_id))
+        for job in jobs
+    }
+    with timed("template_rescore", n_ligands=len(jobs)):
+        rescore(
+            jobs,
+            candidates,
+            top_n=DEFAULT_RESCORE_TOP_N,
+            n_workers=n_workers,
+            backend=backend,
+            cache=cache,
+            pool=pool,
+            prefix="template",
+        )
+
+
+@timed("dock")
+def run(
+    jobs: int = 1,
+    cpus_per_job: int | None = None,
+    backend: str = "prebuilt",
+    seed: int = 0,
+    use_cache: bool = True,
+    chunk_size: int = 0,
+    pool_backend: str = "docker",
+    template_threshold: float | None = None,
+    adaptive: bool = False,
+    two_stage: bool = False,
+):
+    """
+    Dock every test ligand.
+    With jobs > 1, run that many gnina processes at once, giving each cpus_per_job cores.
+    If cpus_per_job isn't set, split the machine's cores evenly across jobs.
+    With use_cache, ligands whose inputs and parameters haven't changed since the last run are skipped.
+    That needs a fixed seed, hence the default of 0; seed=-1 gives gnina a random one, and those results
+    aren't reproducible, so they're never reused.
+    With chunk_size > 0, dock that many ligands per gnina process instead of one.
+    With backend="pool", start one long-lived container per job up front and exec gnina inside them.
+    pool_backend="subprocess" swaps the containers for local processes, e.g. for testing without Docker.
+    With template_threshold, test ligands whose nearest training analog (same protein) is at least that
+    similar get poses transferred from the analog's crystal pose instead (see template.py), and skip docking:
+    gnina only minimizes and scores those poses.
+    With adaptive, dock everything cheaply first and only redo the ligands that didn't converge,
+    at higher exhaustiveness (see adaptive.py).  Can't be combined with chunk_size.
+    With two_stage, dock with CNN scoring off, then CNN-rescore the best poses in one batch per receptor
+    (see run_two_stage).  Much faster without a GPU.
+    """
+    logger.info("Start.")
+    if adaptive and chunk_size > 0:
+        raise ValueError("adaptive docking doesn't support chunk_size yet")
+    if adaptive and two_stage:
+        raise ValueError("adaptive and two_stage can't be combined")
+    if jobs > 1 and cpus_per_job is None:
+        cpus_per_job = max(1, (os.cpu_count() or 1) // jobs)
+    logger.info(f"Running {jobs} gnina job(s) at a time, --cpu {cpus_per_job}, backend {backend}.")
+    df_test = get_df_test()
+    template_jobs = []
+    if template_threshold is not None:
+        templated = write_template_poses(df_test, get_df_train(), threshold=template_threshold)
+        template_jobs = get_gnina_jobs(
+            df_test.filter(pl.col("test_fake_id").is_in(templated)), seed=seed, cpus_per_job=cpus_per_job
+        )
+        df_test = df_test.filter(~pl.col("test_fake_id").is_in(templated))
+    gnina_jobs = get_gnina_jobs(df_test, seed=seed, cpus_per_job=cpus_per_job)
+    cache = DockingCache() if use_cache else None
+    pool = ContainerPool(size=jobs, backend=POOL_BACKENDS[pool_backend]()) if backend == "pool" else None
+    if pool is not None:
+        pool.start()
+    try:
+        if template_jobs:
+            score_template_poses(template_jobs, n_workers=jobs, backend=backend, cache=cache, pool=pool)
+        if adaptive:
+            # adaptive builds on this module, so it can't be imported at the top
+            from polaris_asap_poses.adaptive import run_adaptive
+
+            run_adaptive(gnina_jobs, n_workers=jobs, backend=backend, cache=cache, pool=pool)
+        elif two_stage:
+            run_two_stage(gnina_jobs, chunk_size=chunk_size, n_workers=jobs, backend=backend, cache=cache, pool=pool)
+        elif chunk_size > 0:
+            run_gnina_batches(
+                gnina_jobs, chunk_size=chunk_size, n_workers=jobs, backend=backend, cache=cache, pool=pool
+            )
+        else:
+            run_gnina_jobs(gnina_jobs, n_workers=jobs, backend=backend, cache=cache, pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    logger.info("Done.")
@@ -1,8 +1,14 @@
 import base64
+import functools
+import gzip
 import os
-from dataclasses import dataclass
+import shutil
+from contextlib import ExitStack
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from urllib.parse import quote
+
 import polars as pl
 from rdkit import Chem
 from typeguard import typechecked
@@ -10,82 +16,415 @@ from typeguard import typechecked
 from polaris_asap_poses.logger import logger
 from polaris_asap_poses.util import print_info
 
-pl.Config(tbl_rows=500)
-pl.Config(fmt_str_lengths=500)
-
-POLARIS_ASAP_POSES_HOME = os.environ["POLARIS_ASAP_POSES_HOME"]
-DATA_DIR = Path(POLARIS_ASAP_POSES_HOME) / "data"
-DATA_DIR_RAW = DATA_DIR / "raw"
-DATA_DIR_RAW_REF_STRUCTURES = DATA_DIR_RAW / "reference_structures"
-DATA_DIR_RAW_PACKAGES = DATA_DIR_RAW / "raw_data_package"
-
-DATA_DIR_LIGAND_SDF = DATA_DIR / "ligand_sdf"
-DATA_DIR_GNINA_OUT = DATA_DIR / "gnina-out"
-DATA_DIR_CLEAN = DATA_DIR / "clean"
-DATA_DIR_DIRTY = DATA_DIR / "dirty"
-DATA_DIR_COMBINED = DATA_DIR / "combined"
-
-# yeah don't do this, but we'll live with it
-DATA_DIR_RAW.mkdir(parents=True, exist_ok=True)
-DATA_DIR_CLEAN.mkdir(parents=True, exist_ok=True)
-DATA_DIR_DIRTY.mkdir(parents=True, exist_ok=True)
-DATA_DIR_COMBINED.mkdir(parents=True, exist_ok=True)
-DATA_DIR_LIGAND_SDF.mkdir(parents=True, exist_ok=True)
-DATA_DIR_GNINA_OUT.mkdir(parents=True, exist_ok=True)
+
+@functools.cache
+def home_dir() -> Path:
+    """
+    POLARIS_ASAP_POSES_HOME, read on first use rather than at import, so importing doesn't need it set.
+    The data paths below all hang off it.
+    """
+    home = os.environ.get("POLARIS_ASAP_POSES_HOME")
+    if not home:
+        raise RuntimeError("POLARIS_ASAP_POSES_HOME isn't set, see .env.example")
+    return Path(home)
+
+
+def data_dir() -> Path:
+    return home_dir() / "data"
+
+
+def data_dir_raw() -> Path:
+    return data_dir() / "raw"
+
+
+def data_dir_raw_ref_structures() -> Path:
+    return data_dir_raw() / "reference_structures"
+
+
+def data_dir_raw_packages() -> Path:
+    return data_dir_raw() / "raw_data_package"
+
+
+def data_dir_ligand_sdf() -> Path:
+    return data_dir() / "ligand_sdf"
+
+
+def data_dir_gnina_out() -> Path:
+    return data_dir() / "gnina-out"
+
+
+def data_dir_clean() -> Path:
+    return data_dir() / "clean"
+
+
+def data_dir_dirty() -> Path:
+    return data_dir() / "dirty"
+
+
+def data_dir_combined() -> Path:
+    return data_dir() / "combined"
+
+
+MOL_PICKLE_PROPS = Chem.PropertyPickleOptions.AllProps
+# Decoded mols kept per process, for poses that get decoded over and over (e.g. the same reference in every job)
+MOL_CACHE_SIZE = 1024
+
+# What iter_sdf does with a record RDKit can't parse or sanitize
+SDF_ON_ERROR = ("skip", "warn", "raise")
+
+
+@functools.cache
+def ensure_data_dirs():
+    """
+    Create the data dirs, once per process.  Called by whatever writes into them,
+    rather than at import, so importing doesn't touch the filesystem.
+    """
+    for path in (
+        data_dir_raw(),
+        data_dir_clean(),
+        data_dir_dirty(),
+        data_dir_combined(),
+        data_dir_ligand_sdf(),
+        data_dir_gnina_out(),
+    ):
+        path.mkdir(parents=True, exist_ok=True)
+
+
+@functools.lru_cache(maxsize=MOL_CACHE_SIZE)
+def _decode_mol(mol_bytes: bytes) -> Chem.Mol:
+    return Chem.Mol(mol_bytes)
+
+
+def mol_from_binary(mol_bytes: bytes) -> Chem.Mol:
+    """
+    Decode an RDKit binary mol (with props), remembering recent results.
+    Every call gets its own copy, which is a few times cheaper than decoding, so it's safe to modify.
+    """
+    return Chem.Mol(_decode_mol(mol_bytes))
+
+
+def mol_to_binary(mol: Chem.Mol | None) -> bytes | None:
+    return None if mol is None else mol.ToBinary(MOL_PICKLE_PROPS)
+
+
+def encode_mol_column(df: pl.DataFrame, column: str) -> pl.DataFrame:
+    """
+    Turn a pl.Object column of RDKit mols into a pl.Binary column that parquet can store.
+    """
+    return df.with_columns(
+        pl.Series(name=column, values=[mol_to_binary(x) for x in df[column].to_list()], dtype=pl.Binary)
+    )
+
+
+def decode_mol_column(df: pl.DataFrame, column: str) -> pl.DataFrame:
+    """
+    Turn a pl.Binary column back into a pl.Object column of RDKit mols.
+    You usually don't need the whole column decoded, see mol_from_binary.
+    """
+    return df.with_columns(
+        pl.Series(
+            name=column,
+            values=[None if x is None else mol_from_binary(x) for x in df[column].to_list()],
+            dtype=pl.Object,
+        )
+    )
+
+
+IPC_SUFFIXES = (".arrow", ".ipc", ".feather")
+
+# What polars writes (and reads back as null) for a null hive partition value
+HIVE_NULL = "__HIVE_DEFAULT_PARTITION__"
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def write_ipc_partitioned(
+    df: pl.DataFrame, path: Path, partition_by: List[str], compression: str, record_batch_size: int | None
+):
+    """
+    Write df as hive-style partitions of Arrow IPC files, laid out the way polars' partitioned
+    parquet writer does it, since polars can scan but not write partitioned IPC.
+    The partition columns stay in the files too, which keeps scans in the original column order.
+    """
+    for keys, part in df.partition_by(partition_by, as_dict=True).items():
+        part_dir = path.joinpath(
+            *(
+                f"{column}={HIVE_NULL if key is None else quote(str(key), safe='')}"
+                for column, key in zip(partition_by, keys)
+            )
+        )
+        part_dir.mkdir(parents=True, exist_ok=True)
+        part.write_ipc(part_dir / "00000000.arrow", compression=compression, record_batch_size=record_batch_size)
+
 
 @dataclass
 class NamedDataset:
     """
     put a tags dict in here someday or something
+
+    mol_columns hold RDKit mols.  They're stored as RDKit binary (with props) and read back
+    as pl.Binary, so reading is cheap; decode single mols on demand with mol_from_binary,
+    or whole columns with decode_mol_column.
+
+    A relative filepath is relative to the data dir (see data_dir), resolved as path when the dataset is used,
+    so datasets can be defined at import.
+    The format follows filepath's suffix: .csv, .parquet, or .arrow/.ipc/.feather for Arrow IPC.
+    With partition_by, filepath is a directory of hive-style partitions, e.g.
+    gnina_poses.parquet/protein_label=MERS-CoV%20Mpro/00000000.parquet, and a filter on a partition
+    column in scan() skips the other partitions' files entirely.
+    compression defaults to zstd for parquet and none for IPC: polars memory-maps uncompressed IPC
+    files instead of reading them, so scanning them costs next to nothing until you touch the data.
+    row_group_size is rows per parquet row group, or per IPC record batch.
     """
 
     name: str
     filepath: Path | str
+    mol_columns: List[str] = field(default_factory=list)
+    partition_by: List[str] = field(default_factory=list)
+    compression: str | None = None
+    compression_level: int | None = None
+    row_group_size: int | None = None
 
-    def save(self, df: pl.DataFrame) -> None:
-        logger.info(f"Saving {self.name} to {self.filepath}...")
-        if str(self.filepath).endswith(".csv"):
-            df.write_csv(self.filepath)
-        elif str(self.filepath).endswith(".parquet"):
-            df.write_parquet(self.filepath)
+    @property
+    def path(self) -> Path:
+        return data_dir() / self.filepath
+
+    @property
+    def format(self) -> str:
+        suffix = Path(self.filepath).suffix
+        if suffix == ".csv":
+            return "csv"
+        if suffix == ".parquet":
+            return "parquet"
+        if suffix in IPC_SUFFIXES:
+            return "ipc"
+        raise ValueError(f"Unsupported file format: {self.filepath}")
+
+    def _write(self, df: pl.DataFrame, path: Path):
+        if self.format == "csv":
+            if self.partition_by:
+                raise ValueError(f"Can't partition a CSV dataset, {self.name}")
+            df.write_csv(path)
+        elif not self.partition_by:
+            self._write_file(df, path)
+        elif df.is_empty():
+            # No partitions to write, but an unpartitioned file in the dir keeps the schema scannable
+            path.mkdir()
+            self._write_file(df, path / f"00000000{Path(self.filepath).suffix}")
+        elif self.format == "parquet":
+            df.write_parquet(
+                path,
+                compression=self.compression or "zstd",
+                compression_level=self.compression_level,
+                row_group_size=self.row_group_size,
+                partition_by=self.partition_by,
+            )
+        else:
+            write_ipc_partitioned(df, path, self.partition_by, self.compression or "uncompressed", self.row_group_size)
+
+    def _write_file(self, df: pl.DataFrame, path: Path):
+        if self.format == "parquet":
+            df.write_parquet(
+                path,
+                compression=self.compression or "zstd",
+                compression_level=self.compression_level,
+                row_group_size=self.row_group_size,
+            )
         else:
-            raise ValueError(f"Unsupported file format: {self.filepath}")
+            df.write_ipc(path, compression=self.compression or "uncompressed", record_batch_size=self.row_group_size)
+
+    def save(self, df: pl.DataFrame) -> None:
+        logger.info(f"Saving {self.name} to {self.path}...")
+        ensure_data_dirs()
+        for column in self.mol_columns:
+            if df.schema[column] == pl.Object:
+                df = encode_mol_column(df, column)
+        path = self.path
+        # Write alongside and swap it in.  Overwriting in place would pull the rug out from under
+        # anything still reading the old copy, memory-mapped IPC especially
+        tmp_path = path.with_name(path.name + ".tmp")
+        _remove(tmp_path)
+        self._write(df, tmp_path)
+        if path.is_dir() or tmp_path.is_dir():
+            # os.replace can only swap a file for a file
+            _remove(path)
+        os.replace(tmp_path, path)
         logger.info("Done.")
 
+    def scan(self) -> pl.LazyFrame:
+        """
+        The dataset as a LazyFrame, so filters and column selections are pushed down into the reader:
+        only the matching partitions, row groups and columns get read.
+        e.g. gnina_poses.scan().filter(pl.col("test_fake_id") == 12).select("pose_rank", "cnn_score").collect()
+        """
+        hive = {"hive_partitioning": True} if self.partition_by else {}
+        if self.format == "csv":
+            return pl.scan_csv(self.path)
+        if self.format == "parquet":
+            return pl.scan_parquet(self.path, **hive)
+        return pl.scan_ipc(self.path, **hive)
+
     def read(
         self,
         show_columns: bool = False,
         show_unique: bool = False,
         n: int | None = None,
+        decode_mols: bool = False,
     ) -> pl.DataFrame:
-        logger.info(f"Reading {self.name} from {self.filepath}...")
-        if str(self.filepath).endswith(".csv"):
-            df = pl.read_csv(self.filepath, n_rows=n)
-        elif str(self.filepath).endswith(".parquet"):
-            df = pl.read_parquet(self.filepath, n_rows=n)
-        else:
-            raise ValueError(f"Unsupported file format: {self.filepath}")
+        logger.info(f"Reading {self.name} from {self.path}...")
+        lf = self.scan()
+        if n is not None:
+            lf = lf.head(n)
+        df = lf.collect()
+        if decode_mols:
+            for column in self.mol_columns:
+                df = decode_mol_column(df, column)
         print_info(df, show_columns=show_columns, show_unique=show_unique)
         logger.info("Done.")
         return df
 
+    def exists(self) -> bool:
+        return self.path.exists()
+
+
+asap_train_raw = NamedDataset(
+    name="asap_train_raw",
+    filepath="raw/asap_train_raw.parquet",
+    mol_columns=["ligand_pose"],
+)
+asap_test_raw = NamedDataset(
+    name="asap_test_raw",
+    filepath="raw/asap_test_raw.parquet",
+)
+
 
 @typechecked
 def write_sdf(mol: Chem.Mol, path: Path):
     """
     Write a single RDKit molecule to an SDF file at the specified path.
     """
+    ensure_data_dirs()
     with Chem.SDWriter(path) as w:
         w.write(mol=mol)
 
 
+@typechecked
+def write_sdfs(mols: List[Chem.Mol], path: Path):
+    """
+    Write several RDKit molecules to one SDF file at the specified path.
+    """
+    ensure_data_dirs()
+    with Chem.SDWriter(path) as w:
+        for mol in mols:
+            w.write(mol=mol)
+
+
+def _sdf_props(mol: Chem.Mol) -> Dict[str, Any]:
+    props = mol.GetPropsAsDict()
+    props["_Name"] = mol.GetProp("_Name") if mol.HasProp("_Name") else ""
+    return props
+
+
+def _finish_mol(mol: Chem.Mol, remove_hs: bool) -> Chem.Mol:
+    # What SDMolSupplier does when it sanitizes, incl. cleaning up the stereo it guessed from 3D coords
+    if remove_hs:
+        mol = Chem.RemoveHs(mol)
+    else:
+        Chem.SanitizeMol(mol)
+    Chem.AssignStereochemistry(mol, cleanIt=True, force=True, flagPossibleStereoCenters=True)
+    return mol
+
+
+def _sdf_records(supplier, threaded: bool) -> Iterator[Tuple[int, Chem.Mol | None]]:
+    """
+    (record number, mol or None if it couldn't be read) for each record in supplier, in file order.
+    The threaded supplier hands records out as its threads finish them, so they're put back in order here.
+    """
+    if not threaded:
+        yield from enumerate(supplier, start=1)
+        return
+    pending = {}
+    next_record = 1
+    for mol in supplier:
+        record = supplier.GetLastRecordId()
+        # It hands out one last None at the end of the file, with a record id it's already used
+        if record < next_record or record in pending:
+            continue
+        pending[record] = mol
+        while next_record in pending:
+            yield next_record, pending.pop(next_record)
+            next_record += 1
+    for record in sorted(pending):
+        yield record, pending[record]
+
+
+@typechecked
+def iter_sdf(
+    path: Path | str,
+    remove_hs: bool = False,
+    where: Callable[[Dict[str, Any]], bool] | None = None,
+    on_error: str = "warn",
+    num_threads: int = 1,
+) -> Iterator[Chem.Mol]:
+    """
+    Stream the molecules in an SDF (or .sdf.gz) one at a time, so memory stays flat however big the file is.
+    With where, each record's SD properties (numbers already converted, the title as "_Name") are checked
+    before the molecule is sanitized, and records it rejects are dropped without paying for that.
+    Records that can't be parsed or sanitized are dropped (on_error="skip"), dropped with a warning ("warn"),
+    or stop the read with a ValueError ("raise").
+    With num_threads > 1, records are decoded on that many threads (sanitized there too, unless there's a where),
+    and still come out in file order.
+    .sdf.gz files are always read on one thread.
+    """
+    if on_error not in SDF_ON_ERROR:
+        raise ValueError(f"on_error must be one of {SDF_ON_ERROR}, not {on_error!r}")
+    path = Path(path)
+    threaded = num_threads > 1 and path.suffix != ".gz"
+    # Without a filter, let RDKit sanitize as it parses, which is quicker than doing it from here
+    sanitized = where is None
+    n_bad = 0
+    with ExitStack() as stack:
+        if threaded:
+            supplier = Chem.MultithreadedSDMolSupplier(
+                str(path), sanitize=sanitized, removeHs=remove_hs and sanitized, numWriterThreads=num_threads
+            )
+        else:
+            fd = stack.enter_context(gzip.open(path) if path.suffix == ".gz" else open(path, "rb"))
+            supplier = Chem.ForwardSDMolSupplier(fd, sanitize=sanitized, removeHs=remove_hs and sanitized)
+        for record, mol in _sdf_records(supplier, threaded=threaded):
+            error = None
+            if mol is None:
+                error = "couldn't parse or sanitize it" if sanitized else "couldn't parse it"
+            elif where is not None and not where(_sdf_props(mol)):
+                continue
+            elif not sanitized:
+                try:
+                    mol = _finish_mol(mol, remove_hs=remove_hs)
+                except ValueError as e:
+                    error = f"couldn't sanitize it: {e}"
+            if error is None:
+                yield mol
+                continue
+            n_bad += 1
+            if on_error == "raise":
+                raise ValueError(f"Bad record {record} in {path}, {error}")
+            if on_error == "warn":
+                logger.warning(f"Skipping record {record} in {path}, {error}")
+    if n_bad:
+        logger.info(f"Skipped {n_bad} bad records in {path}.")
+
+
 @typechecked
 def read_sdf(path: Path) -> List[Chem.Mol]:
     """
     Read a single RDKit molecule from an SDF file at the specified path.
     """
-    supplier = Chem.SDMolSupplier(path)
-    mols = [x for x in supplier]
+    mols = list(iter_sdf(path, remove_hs=True))
     if len(mols) > 1:
         logger.warning(f"{path} contains {len(mols)} mols, which is too many mols")
     if len(mols) == 0:
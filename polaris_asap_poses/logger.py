@@ -1,5 +1,6 @@
 import atexit as _atexit
 import sys
+import threading
 
 from loguru import logger as loguru_logger
 
@@ -8,10 +9,6 @@ from polaris_asap_poses.settings import get_settings
 # LOGURU_LOG_LEVEL = os.getenv("POLARIS_ASAP_POSES_LOG_LEVEL", "INFO")
 # LOGURU_LOG_TO_FILE = bool(os.getenv("POLARIS_ASAP_POSES_LOG_TO_FILE", False))
 
-settings = get_settings()
-LOGURU_LOG_LEVEL = settings.log_level
-LOGURU_LOG_TO_FILE = settings.log_to_file
-
 __all__ = ["logger"]
 
 LOGURU_LOG_FORMAT = (
@@ -21,31 +18,79 @@ LOGURU_LOG_FORMAT = (
     "<level>{message}</level>"
 )
 
-# Maybe gonna need another handler at some point, but this is fine for now
-LOGURU_HANDLER = {
-    "sink": sys.stdout,
-    "level": LOGURU_LOG_LEVEL,
-    "colorize": True,
-    "format": LOGURU_LOG_FORMAT,
-    # The internet claims diagnose and backtrace may deadlock.  Maybe?  Don't know.
-    # But, official docs state that diagnose may leak info in prod, so beware
-    "backtrace": True,
-    "diagnose": False,
-}
-
-loguru_logger.configure(handlers=[LOGURU_HANDLER])
-
-logger = loguru_logger
-
-if LOGURU_LOG_TO_FILE:
-    logger.add(
-        settings.log_file,
-        level=LOGURU_LOG_LEVEL,
-        rotation="1 day",
-        compression="zip",
-        serialize=False,
-        format="{time} | {level} | {name}:{function}:{line} - {message}",
-    )
+
+def _is_metric(record) -> bool:
+    """
+    Metric records (see metrics.py) go to the metrics sink only, not the human-readable ones.
+    """
+    return "metric" in record["extra"]
+
+
+def _is_not_metric(record) -> bool:
+    return not _is_metric(record)
+
+
+_configure_lock = threading.Lock()
+_configured = False
+
+
+def configure_logging():
+    """
+    Set up the sinks from settings, once per process.  Happens on the first message rather than at import,
+    so importing anything that logs doesn't have to load (and validate) settings.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        settings = get_settings()
+        # Maybe gonna need another handler at some point, but this is fine for now
+        handler = {
+            "sink": sys.stdout,
+            "level": settings.log_level,
+            "colorize": True,
+            "format": LOGURU_LOG_FORMAT,
+            "filter": _is_not_metric,
+            # The internet claims diagnose and backtrace may deadlock.  Maybe?  Don't know.
+            # But, official docs state that diagnose may leak info in prod, so beware
+            "backtrace": True,
+            "diagnose": False,
+        }
+        loguru_logger.configure(handlers=[handler])
+
+        if settings.log_to_file:
+            loguru_logger.add(
+                settings.log_file,
+                level=settings.log_level,
+                rotation="1 day",
+                compression="zip",
+                serialize=False,
+                format="{time} | {level} | {name}:{function}:{line} - {message}",
+                filter=_is_not_metric,
+            )
+
+        # One JSON object per line, already serialized by metrics.emit_metric
+        if settings.metrics_to_file:
+            loguru_logger.add(
+                settings.metrics_file,
+                level="DEBUG",
+                serialize=False,
+                format="{extra[metric]}",
+                filter=_is_metric,
+            )
+        _configured = True
+
+
+def _configure_on_first_message(record):
+    # Patchers run before loguru picks the handlers to send a message to, so even the first one gets the real sinks
+    if not _configured:
+        configure_logging()
+
+
+# Until then, a sink that drops everything, at the lowest level, so messages get as far as the patcher
+loguru_logger.configure(handlers=[{"sink": lambda message: None, "level": 0}])
+
+logger = loguru_logger.patch(_configure_on_first_message)
 
 # Clean up the logger on exit
 _atexit.register(logger.remove)
@@ -0,0 +1,274 @@
+"""
+Stage-level timing and resource metrics, emitted as JSON Lines through the logger.
+
+timed() wraps a stage (as a context manager or decorator) and, when it finishes, emits one record
+with its wall time, this process's CPU time and peak RSS, and whatever child processes it ran.
+Subprocesses started with run_measured() are reaped with wait4, so each one's own CPU time and
+peak RSS get attributed to the stages open in the calling thread; that's how per-ligand gnina
+numbers come out right even with several jobs running at once.  Records go to settings.metrics_file
+(see logger.py), tagged with this process's run_id, and summarize_metrics() turns them into a report.
+"""
+
+import functools
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import ContextDecorator
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+import polars as pl
+from typeguard import typechecked
+
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.settings import get_settings
+
+
+@functools.cache
+def metrics_file() -> Path:
+    return Path(get_settings().metrics_file)
+
+
+# Tags every record from this process, so a report can pick out one run
+RUN_ID = uuid.uuid4().hex[:12]
+
+_local = threading.local()
+
+
+def _open_timers() -> List["timed"]:
+    if not hasattr(_local, "timers"):
+        _local.timers = []
+    return _local.timers
+
+
+def emit_metric(event: str, **fields: Any):
+    """
+    Write one metric record.
+    """
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "run_id": RUN_ID,
+        "pid": os.getpid(),
+        "event": event,
+        **fields,
+    }
+    logger.bind(metric=json.dumps(record, default=str)).debug(event)
+
+
+@dataclass
+class ProcessStats:
+    """
+    Resource usage of one finished child process, from wait4.
+    """
+
+    wall_s: float
+    user_s: float
+    sys_s: float
+    max_rss_kb: int
+    returncode: int
+
+
+def _record_child(stats: ProcessStats):
+    for timer in _open_timers():
+        timer.children.append(stats)
+
+
+def run_measured(
+    cmd: List[str],
+    check: bool = True,
+    capture_output: bool = False,
+    text: bool = False,
+    cwd: Path | str | None = None,
+) -> subprocess.CompletedProcess:
+    """
+    subprocess.run, but the child is reaped with os.wait4 so we get its own rusage.
+    Output is captured through temporary files rather than pipes, since we can't let
+    communicate() reap the child for us.
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            stdout=out if capture_output else None,
+            stderr=err if capture_output else None,
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stats = ProcessStats(
+            wall_s=time.perf_counter() - start,
+            user_s=usage.ru_utime,
+            sys_s=usage.ru_stime,
+            max_rss_kb=usage.ru_maxrss,
+            returncode=proc.returncode,
+        )
+        _record_child(stats)
+        stdout = stderr = None
+        if capture_output:
+            out.seek(0)
+            err.seek(0)
+            stdout, stderr = out.read(), err.read()
+            if text:
+                stdout, stderr = stdout.decode(), stderr.decode()
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+class timed(ContextDecorator):
+    """
+    Time a stage and emit a "stage" metric when it ends, whether or not it succeeded.
+
+        with timed("gnina_job", test_fake_id=12):
+            ...
+
+        @timed("load_comp")
+        def load_comp(...): ...
+
+    self_cpu_s is this whole process's CPU time over the stage (all threads), and children_cpu_s is
+    every child reaped during it, so both overlap between stages running concurrently.
+    child_* fields only count subprocesses this thread ran through run_measured.
+    """
+
+    def __init__(self, stage: str, **fields: Any):
+        self.stage = stage
+        self.fields = fields
+        self.children: List[ProcessStats] = []
+
+    def _recreate_cm(self):
+        # A fresh timer per call when used as a decorator, so concurrent calls don't share state
+        return timed(self.stage, **self.fields)
+
+    def __enter__(self) -> "timed":
+        self.start = time.time()
+        self._perf_start = time.perf_counter()
+        self._self_start = resource.getrusage(resource.RUSAGE_SELF)
+        self._children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _open_timers().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _open_timers().remove(self)
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record: Dict[str, Any] = {
+            "stage": self.stage,
+            "ok": exc_type is None,
+            "start": self.start,
+            "wall_s": time.perf_counter() - self._perf_start,
+            "self_cpu_s": (self_usage.ru_utime + self_usage.ru_stime)
+            - (self._self_start.ru_utime + self._self_start.ru_stime),
+            "max_rss_kb": self_usage.ru_maxrss,
+            "children_cpu_s": (children_usage.ru_utime + children_usage.ru_stime)
+            - (self._children_start.ru_utime + self._children_start.ru_stime),
+            **self.fields,
+        }
+        if self.children:
+            record["n_children"] = len(self.children)
+            record["child_user_s"] = sum(x.user_s for x in self.children)
+            record["child_sys_s"] = sum(x.sys_s for x in self.children)
+            record["child_max_rss_kb"] = max(x.max_rss_kb for x in self.children)
+        if exc_type is not None:
+            record["error"] = repr(exc)
+        emit_metric("stage", **record)
+        return False
+
+
+def read_metrics(path: Path | None = None, run_id: str | None = None) -> pl.DataFrame:
+    """
+    Stage records from the metrics file, for one run_id.  Defaults to the most recent run.
+    Empty if nothing has been recorded yet.
+    """
+    path = metrics_file() if path is None else path
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return pl.DataFrame()
+    df = pl.read_ndjson(path, infer_schema_length=None).filter(pl.col("event") == "stage")
+    if df.is_empty():
+        return df
+    run_id = df["run_id"][-1] if run_id is None else run_id
+    return df.filter(pl.col("run_id") == run_id)
+
+
+@typechecked
+def summarize_metrics(path: Path | None = None, run_id: str | None = None, top: int = 10) -> Dict[str, Any]:
+    """
+    Summary of one run: wall time per stage, per-ligand dock time percentiles, docking throughput
+    and the slowest ligands.  Chunked docking is spread evenly over the ligands in each chunk.
+    """
+    path = metrics_file() if path is None else path
+    df = read_metrics(path, run_id)
+    if df.is_empty():
+        return {"run_id": run_id, "stages": [], "n_ligands": 0}
+    stages = (
+        df.group_by("stage")
+        .agg(
+            pl.len().alias("count"),
+            pl.col("wall_s").sum().alias("total_wall_s"),
+            pl.col("wall_s").median().alias("p50_wall_s"),
+            pl.col("wall_s").quantile(0.95).alias("p95_wall_s"),
+            (~pl.col("ok")).sum().alias("n_failed"),
+        )
+        .sort("total_wall_s", descending=True)
+    )
+    summary: Dict[str, Any] = {"run_id": df["run_id"][0], "stages": stages.to_dicts(), "n_ligands": 0}
+
+    ligands = []
+    if "gnina_job" in df["stage"].to_list():
+        jobs = df.filter((pl.col("stage") == "gnina_job") & pl.col("ok"))
+        ligands.append(jobs.select("test_fake_id", "protein", "start", "wall_s", (pl.col("start") + pl.col("wall_s")).alias("end")))
+    if "gnina_batch" in df["stage"].to_list():
+        batches = df.filter((pl.col("stage") == "gnina_batch") & pl.col("ok"))
+        ligands.append(
+            batches.select(
+                pl.col("test_fake_ids").alias("test_fake_id"),
+                "protein",
+                "start",
+                (pl.col("wall_s") / pl.col("test_fake_ids").list.len()).alias("wall_s"),
+                (pl.col("start") + pl.col("wall_s")).alias("end"),
+            ).explode("test_fake_id")
+        )
+    if ligands:
+        df_ligands = pl.concat(ligands, how="vertical_relaxed")
+        span = df_ligands["end"].max() - df_ligands["start"].min()
+        summary.update(
+            n_ligands=len(df_ligands),
+            p50_dock_s=df_ligands["wall_s"].median(),
+            p95_dock_s=df_ligands["wall_s"].quantile(0.95),
+            ligands_per_hour=3600 * len(df_ligands) / span if span else None,
+            slowest=df_ligands.sort("wall_s", descending=True).head(top).select("test_fake_id", "protein", "wall_s").to_dicts(),
+        )
+    return summary
+
+
+def report(path: Path | None = None, run_id: str | None = None, top: int = 10) -> str:
+    """
+    summarize_metrics, formatted for a terminal.
+    """
+    path = metrics_file() if path is None else path
+    summary = summarize_metrics(path, run_id, top)
+    if not summary["stages"]:
+        return f"No metrics recorded in {path} yet."
+    lines = [f"Run {summary['run_id']}", "", "Stages:"]
+    for x in summary["stages"]:
+        lines.append(
+            f"  {x['stage']:<28} n={x['count']:<6} total {x['total_wall_s']:9.1f}s  "
+            f"p50 {x['p50_wall_s']:8.2f}s  p95 {x['p95_wall_s']:8.2f}s  failed {x['n_failed']}"
+        )
+    if summary["n_ligands"]:
+        throughput = summary["ligands_per_hour"]
+        lines += [
+            "",
+            f"Docked {summary['n_ligands']} ligands: p50 {summary['p50_dock_s']:.1f}s, p95 {summary['p95_dock_s']:.1f}s per ligand, "
+            + (f"{throughput:.0f} ligands/hour." if throughput else "throughput n/a."),
+            "",
+            "Slowest ligands:",
+        ]
+        lines += [f"  test_fake_id {x['test_fake_id']} ({x['protein']}): {x['wall_s']:.1f}s" for x in summary["slowest"]]
+    return "\n".join(lines)
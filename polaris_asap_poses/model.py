@@ -1,10 +1,12 @@
 
 
 
+import re
 from dataclasses import dataclass
 from pathlib import Path
 
-from polaris_asap_poses.io import DATA_DIR_RAW_REF_STRUCTURES
+from polaris_asap_poses.io import (data_dir_gnina_out, data_dir_ligand_sdf,
+                                   data_dir_raw_ref_structures)
 
 
 
@@ -13,20 +15,31 @@ class Protein():
     name: str
     data_label: str     # This is what you see in df_train and df_test
     path_segment: str   # This is what's actually in the filepath - fully hyphenated, no spaces
-    ref_dir: Path = Path()
-    ref_fasta_path: Path = Path()
-    ref_pdb_path: Path = Path()
-    ref_ligand_smi_path: Path = Path()
-    ref_ligand_sdf_path: Path = Path()
-    ref_complex_path: Path = Path()
-
-    def __post_init__(self):
-        self.ref_dir = DATA_DIR_RAW_REF_STRUCTURES / self.path_segment
-        self.ref_fasta_path = self.ref_dir / "protein.fasta"
-        self.ref_pdb_path = self.ref_dir / "protein.pdb"
-        self.ref_ligand_smi_path = self.ref_dir / "ligand.smi"
-        self.ref_ligand_sdf_path = self.ref_dir / "ligand.sdf"
-        self.ref_complex_path = self.ref_dir / "complex.pdb"
+
+    # Properties rather than fields, so the proteins can be defined before POLARIS_ASAP_POSES_HOME is read
+    @property
+    def ref_dir(self) -> Path:
+        return data_dir_raw_ref_structures() / self.path_segment
+
+    @property
+    def ref_fasta_path(self) -> Path:
+        return self.ref_dir / "protein.fasta"
+
+    @property
+    def ref_pdb_path(self) -> Path:
+        return self.ref_dir / "protein.pdb"
+
+    @property
+    def ref_ligand_smi_path(self) -> Path:
+        return self.ref_dir / "ligand.smi"
+
+    @property
+    def ref_ligand_sdf_path(self) -> Path:
+        return self.ref_dir / "ligand.sdf"
+
+    @property
+    def ref_complex_path(self) -> Path:
+        return self.ref_dir / "complex.pdb"
 
     def validate(self):
         assert self.ref_dir.exists() and self.ref_dir.is_dir
@@ -36,5 +49,39 @@ class Protein():
         assert self.ref_ligand_sdf_path.exists() and self.ref_ligand_sdf_path.is_file()
         assert self.ref_complex_path.exists() and self.ref_complex_path.is_file()
 
+    def test_ligand_sdf_path(self, test_fake_id: int) -> Path:
+        return data_dir_ligand_sdf() / f"test_{test_fake_id}_{self.path_segment}.sdf"
+
+    def docking_result_path(self, test_fake_id: int) -> Path:
+        return data_dir_gnina_out() / f"docked_test_{test_fake_id}_{self.path_segment}.sdf"
+
 SARS = Protein(name="SARS", data_label="SARS-CoV-2 Mpro", path_segment="SARS-CoV-2-Mpro")
 MERS = Protein(name="MERS", data_label="MERS-CoV Mpro", path_segment="MERS-CoV-Mpro")
+
+PROTEINS = [SARS, MERS]
+
+
+def get_protein(data_label: str) -> Protein:
+    """
+    Look up a Protein by the protein_label you see in df_train and df_test.
+    """
+    for protein in PROTEINS:
+        if protein.data_label == data_label:
+            return protein
+    raise ValueError(f"Invalid protein_label {data_label}")
+
+
+DOCKING_RESULT_PATTERN = re.compile(r"docked_test_(\d+)_(.+)\.sdf")
+
+
+def parse_docking_result_path(path: Path) -> tuple[int, Protein] | None:
+    """
+    The (test_fake_id, Protein) a docked_test_<id>_<protein>.sdf file belongs to, or None if it isn't one.
+    """
+    match = DOCKING_RESULT_PATTERN.fullmatch(Path(path).name)
+    if match is None:
+        return None
+    for protein in PROTEINS:
+        if protein.path_segment == match.group(2):
+            return int(match.group(1)), protein
+    return None
@@ -0,0 +1,200 @@
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.io import data_dir, data_dir_gnina_out, iter_sdf
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.model import parse_docking_result_path
+
+
+def data_dir_store() -> Path:
+    return data_dir() / "store"
+
+
+def pose_store_path() -> Path:
+    return data_dir_store() / "poses.mols"
+
+
+# (test_fake_id, protein_label, pose_rank)
+MolKey = Tuple[int, str, int]
+# (test_fake_id, protein_label)
+LigandKey = Tuple[int, str]
+
+_HEADER = struct.Struct("<I")
+
+
+class MolStore:
+    """
+    Append-only store of many molecules in one file, as RDKit binary with all props
+    (same as serialize_rdkit_mol, minus the base64).
+
+    Records are length-prefixed blobs in `<path>`, and `<path>.idx` is a tab-separated
+    offset index keyed by (test_fake_id, protein_label, pose_rank).  Reads go through a
+    memory map, so random access is a slice plus Chem.Mol(), with no text parsing.
+    Appending a key that already exists shadows the old record.
+    """
+
+    def __init__(self, path: Path | str | None = None):
+        path = pose_store_path() if path is None else path
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch(exist_ok=True)
+        self.index: Dict[MolKey, Tuple[int, int]] = {}
+        # Pose ranks stored for each ligand, so get_poses doesn't have to scan the whole index
+        self._ranks: Dict[LigandKey, Set[int]] = {}
+        self._mmap: mmap.mmap | None = None
+        self._mmap_size = 0
+        self._load_index()
+
+    def _add_to_index(self, key: MolKey, offset: int, length: int):
+        self.index[key] = (offset, length)
+        self._ranks.setdefault(key[:2], set()).add(key[2])
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return
+        data_size = self.path.stat().st_size
+        n_bytes = 0
+        with open(self.index_path, "rb") as fd:
+            for line in fd:
+                if not line.endswith(b"\n"):
+                    break  # Half-written by a crash
+                test_fake_id, protein_label, pose_rank, offset, length = line.decode().rstrip("\n").split("\t")
+                offset, length = int(offset), int(length)
+                # An index entry past the end of the data means we crashed mid-append, and so will any after it
+                if offset + length > data_size:
+                    logger.warning(f"Ignoring truncated record at offset {offset} in {self.path}")
+                    break
+                self._add_to_index((int(test_fake_id), protein_label, int(pose_rank)), offset, length)
+                n_bytes += len(line)
+        # Drop what's left, or the next append would run on from a partial line
+        if os.path.getsize(self.index_path) > n_bytes:
+            os.truncate(self.index_path, n_bytes)
+
+    def _view(self) -> mmap.mmap:
+        size = self.path.stat().st_size
+        if self._mmap is None or self._mmap_size != size:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.path, "rb") as fd:
+                self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmap_size = size
+        return self._mmap
+
+    def extend(self, items: Iterable[Tuple[MolKey, Chem.Mol]]) -> int:
+        """
+        Append many (key, mol) pairs, writing the data before the index entries that point at it.
+        """
+        props = Chem.PropertyPickleOptions.AllProps
+        n = 0
+        index_lines = []
+        with open(self.path, "ab") as fd:
+            for (test_fake_id, protein_label, pose_rank), mol in items:
+                mol_bytes = mol.ToBinary(props)
+                offset = fd.tell() + _HEADER.size
+                fd.write(_HEADER.pack(len(mol_bytes)))
+                fd.write(mol_bytes)
+                key = (int(test_fake_id), protein_label, int(pose_rank))
+                self._add_to_index(key, offset, len(mol_bytes))
+                index_lines.append(f"{key[0]}\t{key[1]}\t{key[2]}\t{offset}\t{len(mol_bytes)}\n")
+                n += 1
+            fd.flush()
+            os.fsync(fd.fileno())
+        with open(self.index_path, "a") as fd:
+            fd.writelines(index_lines)
+        return n
+
+    def append(self, mol: Chem.Mol, test_fake_id: int, protein_label: str, pose_rank: int = 0):
+        self.extend([((test_fake_id, protein_label, pose_rank), mol)])
+
+    def get_bytes(self, test_fake_id: int, protein_label: str, pose_rank: int = 0) -> bytes:
+        offset, length = self.index[(test_fake_id, protein_label, pose_rank)]
+        return self._view()[offset : offset + length]
+
+    def get(self, test_fake_id: int, protein_label: str, pose_rank: int = 0) -> Chem.Mol:
+        return Chem.Mol(self.get_bytes(test_fake_id, protein_label, pose_rank))
+
+    def get_poses(self, test_fake_id: int, protein_label: str) -> List[Chem.Mol]:
+        """
+        All poses for one ligand, best first.
+        """
+        ranks = sorted(self._ranks.get((test_fake_id, protein_label), ()))
+        return [self.get(test_fake_id, protein_label, rank) for rank in ranks]
+
+    def has_poses(self, test_fake_id: int, protein_label: str) -> bool:
+        return (test_fake_id, protein_label) in self._ranks
+
+    def keys(self) -> List[MolKey]:
+        return list(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: MolKey) -> bool:
+        return key in self.index
+
+    def __iter__(self) -> Iterator[Tuple[MolKey, Chem.Mol]]:
+        """
+        Bulk iteration in file order, which reads the memory map sequentially.
+        """
+        if not self.index:
+            return
+        view = self._view()
+        for key, (offset, length) in sorted(self.index.items(), key=lambda item: item[1][0]):
+            yield key, Chem.Mol(view[offset : offset + length])
+
+    @typechecked
+    def import_sdf(self, path: Path, test_fake_id: int, protein_label: str) -> int:
+        """
+        Import every molecule in an SDF, e.g. gnina's poses, ranked in file order.
+        """
+        return self.extend(((test_fake_id, protein_label, rank), mol) for rank, mol in enumerate(iter_sdf(path)))
+
+    @typechecked
+    def export_sdf(self, path: Path, keys: List[MolKey] | None = None):
+        """
+        Write some or all molecules out as SDF, e.g. as gnina input or for submission.
+        """
+        keys = keys if keys is not None else sorted(self.index)
+        with Chem.SDWriter(str(path)) as w:
+            for key in keys:
+                w.write(self.get(*key))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> "MolStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def import_docking_results(store: MolStore, gnina_out_dir: Path | None = None) -> int:
+    """
+    Pack every docked_test_<id>_<protein>.sdf in gnina_out_dir into the store.
+    Ligands the store already has poses for are skipped, so running it again only adds what's new.
+    """
+    gnina_out_dir = data_dir_gnina_out() if gnina_out_dir is None else gnina_out_dir
+    n = 0
+    n_skipped = 0
+    for path in sorted(gnina_out_dir.glob("docked_test_*.sdf")):
+        parsed = parse_docking_result_path(path)
+        if parsed is None:
+            logger.warning(f"Skipping {path}, doesn't look like a docking result")
+            continue
+        test_fake_id, protein = parsed
+        if store.has_poses(test_fake_id, protein.data_label):
+            n_skipped += 1
+            continue
+        n += store.import_sdf(path, test_fake_id, protein.data_label)
+    logger.info(f"Imported {n} poses into {store.path}, skipped {n_skipped} ligands already in it")
+    return n
@@ -0,0 +1,483 @@
+"""
+The whole run as a DAG of stages:
+
+    snapshot ──┐
+               ├─> prep ─> dock ─> poses ─> select ─> submit
+    structures ┘           ^
+               └───────────┘
+
+select needs the structures too, to rescore poses in process when picking by vina_score (see rescore.py).
+
+Each Stage declares the stages it needs, the files it reads and the files it writes.  A stage's key is
+a hash of its parameters and the contents of its inputs, and the stage is skipped if that key matches
+the one recorded when it last finished and its outputs are still the ones it wrote.  Stages that work per
+ligand also only redo the ligands that changed: prep keys each test row on its SMILES and prep params,
+dock goes through the DockingCache, and poses only reparses gnina outputs whose hash changed.
+Stages whose dependencies are done run concurrently.
+
+State, including a (size, mtime) memo of file hashes so unchanged inputs aren't re-read, is kept in
+data/pipeline/state.json.
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import polars as pl
+
+from polaris_asap_poses.cache import sha256_bytes, sha256_file
+from polaris_asap_poses.io import (NamedDataset, asap_test_raw, asap_train_raw,
+                                   data_dir, data_dir_gnina_out,
+                                   data_dir_ligand_sdf)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.model import PROTEINS, get_protein, parse_docking_result_path
+from polaris_asap_poses.poses import POSE_GROUP, gnina_poses, parse_gnina_outputs, selected_poses, top_k_poses
+from polaris_asap_poses.rescore import rescore_poses
+from polaris_asap_poses.snapshot import (ensure_snapshot, get_df_test,
+                                         snapshot_manifest_path)
+from polaris_asap_poses.submission import build_submission, submission_path
+
+
+def pipeline_state_path() -> Path:
+    return data_dir() / "pipeline" / "state.json"
+
+
+@dataclass
+class PipelineConfig:
+    """
+    Everything a stage's outputs can depend on besides its input files.
+    Each stage lists the fields it cares about, so e.g. changing select_by only reruns select and submit.
+    """
+
+    jobs: int = 1
+    cpus_per_job: int | None = None
+    backend: str = "prebuilt"
+    chunk_size: int = 0
+    seed: int = 0  # Fixed, so docking results can be reused; -1 for random seeds, which redock every run
+    prep: bool = True
+    n_confs: int = 10
+    template_threshold: float | None = None
+    adaptive: bool = False
+    two_stage: bool = False
+    select_by: str = "cnn_score"
+
+
+@dataclass
+class StageRecord:
+    """
+    What we remember about a stage's last successful run.
+    rows maps each unit of per-row work (e.g. a ligand SDF) to the key it was last produced from.
+    """
+
+    key: str | None = None
+    outputs_key: str | None = None
+    rows: Dict[str, str] = field(default_factory=dict)
+    finished: str | None = None
+
+
+@dataclass
+class Stage:
+    """
+    inputs and outputs are files, or glob patterns (see expand).
+    params are the PipelineConfig fields the stage's outputs depend on.
+    stale_rows, if given, returns (n_stale, n_total) rows for --dry-run.
+    """
+
+    name: str
+    run: Callable[["Pipeline", StageRecord], None]
+    deps: List[str] = field(default_factory=list)
+    inputs: List[Path] = field(default_factory=list)
+    outputs: List[Path] = field(default_factory=list)
+    params: List[str] = field(default_factory=list)
+    stale_rows: Callable[["Pipeline", StageRecord], Tuple[int, int]] | None = None
+
+
+def expand(path: Path) -> List[Path]:
+    for i, part in enumerate(path.parts):
+        if "*" in part:
+            return sorted(x for x in Path(*path.parts[:i]).glob(str(Path(*path.parts[i:]))) if x.is_file())
+    return [path]
+
+
+def dataset_files(dataset: NamedDataset) -> Path:
+    """
+    A pattern for a dataset's files, which for a partitioned one are spread over a directory tree.
+    """
+    path = dataset.path
+    return path / "**" / f"*{path.suffix}" if dataset.partition_by else path
+
+
+####################################
+# Stages
+####################################
+
+
+def _run_snapshot(pipeline: "Pipeline", record: StageRecord):
+    ensure_snapshot()
+
+
+def _run_structures(pipeline: "Pipeline", record: StageRecord):
+    # Imports polaris, so only when we actually have to download
+    from polaris_asap_poses.download import download_reference_structures
+
+    download_reference_structures()
+
+
+def _prep_rows(pipeline: "Pipeline", record: StageRecord) -> Tuple[pl.DataFrame, Dict[str, str]]:
+    """
+    Test rows whose ligand SDF is missing or was written from a different SMILES or prep params,
+    and the keys of every row, by SDF file name.
+    """
+    config = pipeline.config
+    df_test = get_df_test()
+    keys, stale = {}, []
+    for row in df_test.iter_rows(named=True):
+        path = get_protein(row["protein_label"]).test_ligand_sdf_path(row["test_fake_id"])
+        keys[path.name] = sha256_bytes(
+            json.dumps([row["CXSMILES"], row["protein_label"], config.prep, config.n_confs]).encode()
+        )
+        stale.append(record.rows.get(path.name) != keys[path.name] or not path.exists())
+    return df_test.filter(pl.Series(stale, dtype=pl.Boolean)), keys
+
+
+def _run_prep(pipeline: "Pipeline", record: StageRecord):
+    from polaris_asap_poses.dataprep import write_test_ligand_sdfs
+
+    df_stale, keys = _prep_rows(pipeline, record)
+    logger.info(f"{len(df_stale)} of {len(keys)} ligand SDFs to (re)write.")
+    if len(df_stale):
+        write_test_ligand_sdfs(prep=pipeline.config.prep, n_confs=pipeline.config.n_confs, df_test=df_stale)
+    # Rows that left the test set shouldn't get docked
+    for name in set(record.rows) - set(keys):
+        (data_dir_ligand_sdf() / name).unlink(missing_ok=True)
+    record.rows = keys
+
+
+def _stale_prep_rows(pipeline: "Pipeline", record: StageRecord) -> Tuple[int, int]:
+    df_stale, keys = _prep_rows(pipeline, record)
+    return len(df_stale), len(keys)
+
+
+def _run_dock(pipeline: "Pipeline", record: StageRecord):
+    # The docking cache already skips ligands whose inputs and parameters haven't changed
+    from polaris_asap_poses.gnina import run
+
+    config = pipeline.config
+    run(
+        jobs=config.jobs,
+        cpus_per_job=config.cpus_per_job,
+        backend=config.backend,
+        seed=config.seed,
+        use_cache=True,
+        chunk_size=config.chunk_size,
+        template_threshold=config.template_threshold,
+        adaptive=config.adaptive,
+        two_stage=config.two_stage,
+    )
+
+
+def _pose_rows(pipeline: "Pipeline", record: StageRecord) -> Tuple[List[Path], Dict[str, str]]:
+    """
+    gnina outputs that changed since the pose table was last built, and the hashes of all of them.
+    Only outputs for rows in the current test set count: ones for rows that have since left it
+    (or moved to the other protein) are still on disk, but mustn't be selected.
+    """
+    current = {
+        get_protein(row["protein_label"]).docking_result_path(row["test_fake_id"]).name
+        for row in get_df_test().select("test_fake_id", "protein_label").iter_rows(named=True)
+    }
+    paths = [path for path in expand(data_dir_gnina_out() / "docked_test_*.sdf") if path.name in current]
+    keys = {path.name: pipeline.fingerprint(path) for path in paths}
+    return [path for path in paths if record.rows.get(path.name) != keys[path.name]], keys
+
+
+def _run_poses(pipeline: "Pipeline", record: StageRecord):
+    stale, keys = _pose_rows(pipeline, record)
+    if gnina_poses.exists() and record.rows:
+        # Keep the poses of every unchanged output, drop the ones that changed or went away
+        dropped = [parse_docking_result_path(data_dir_gnina_out() / name) for name in set(record.rows) - set(keys)]
+        dropped += [parse_docking_result_path(path) for path in stale]
+        df_dropped = pl.DataFrame(
+            [(test_fake_id, protein.data_label) for test_fake_id, protein in filter(None, dropped)],
+            schema={"test_fake_id": pl.Int64, "protein_label": pl.String},
+            orient="row",
+        )
+        df_kept = gnina_poses.scan().join(df_dropped.lazy(), on=POSE_GROUP, how="anti").collect()
+    else:
+        stale, df_kept = [data_dir_gnina_out() / name for name in keys], None
+    logger.info(f"Parsing {len(stale)} of {len(keys)} gnina outputs.")
+    df = parse_gnina_outputs(stale)
+    if df_kept is not None:
+        df = pl.concat([df_kept, df]).sort(POSE_GROUP + ["pose_rank"])
+    gnina_poses.save(df)
+    record.rows = keys
+
+
+def _stale_pose_rows(pipeline: "Pipeline", record: StageRecord) -> Tuple[int, int]:
+    stale, keys = _pose_rows(pipeline, record)
+    return (len(stale) if record.rows and gnina_poses.exists() else len(keys)), len(keys)
+
+
+def _run_select(pipeline: "Pipeline", record: StageRecord):
+    by = pipeline.config.select_by
+    lf = gnina_poses.scan()
+    if by == "vina_score":
+        # Not one of gnina's scores, so score every pose here first
+        df = lf.collect()
+        lf = df.join(rescore_poses(df), on=POSE_GROUP + ["pose_rank"], how="left").lazy()
+    # minimized_affinity and vina_score are kcal/mol, lower is better; the CNN scores are higher-is-better
+    descending = by not in ("minimized_affinity", "vina_score")
+    selected_poses.save(top_k_poses(lf, k=1, by=by, descending=descending).collect())
+
+
+def _run_submit(pipeline: "Pipeline", record: StageRecord):
+    build_submission(selected_poses.read())
+
+
+def default_stages() -> List[Stage]:
+    """
+    The pipeline's stages.  A function, since their files live under POLARIS_ASAP_POSES_HOME.
+    """
+    return [
+        Stage(
+            name="snapshot",
+            run=_run_snapshot,
+            outputs=[dataset_files(asap_train_raw), dataset_files(asap_test_raw), snapshot_manifest_path()],
+        ),
+        Stage(
+            name="structures",
+            run=_run_structures,
+            outputs=[path for protein in PROTEINS for path in (protein.ref_pdb_path, protein.ref_ligand_sdf_path)],
+        ),
+        Stage(
+            name="prep",
+            run=_run_prep,
+            deps=["snapshot"],
+            inputs=[dataset_files(asap_test_raw)],
+            outputs=[data_dir_ligand_sdf() / "test_*.sdf"],
+            params=["prep", "n_confs"],
+            stale_rows=_stale_prep_rows,
+        ),
+        Stage(
+            name="dock",
+            run=_run_dock,
+            deps=["prep", "structures"],
+            # The training set too, since that's where template poses come from
+            inputs=[data_dir_ligand_sdf() / "test_*.sdf", dataset_files(asap_train_raw)]
+            + [path for protein in PROTEINS for path in (protein.ref_pdb_path, protein.ref_ligand_sdf_path)],
+            outputs=[data_dir_gnina_out() / "docked_test_*.sdf"],
+            params=["seed", "template_threshold", "adaptive", "two_stage"],
+        ),
+        Stage(
+            name="poses",
+            run=_run_poses,
+            deps=["dock"],
+            inputs=[data_dir_gnina_out() / "docked_test_*.sdf", dataset_files(asap_test_raw)],
+            outputs=[dataset_files(gnina_poses)],
+            stale_rows=_stale_pose_rows,
+        ),
+        Stage(
+            name="select",
+            run=_run_select,
+            deps=["poses", "structures"],
+            inputs=[dataset_files(gnina_poses)]
+            + [path for protein in PROTEINS for path in (protein.ref_pdb_path, protein.ref_ligand_sdf_path)],
+            outputs=[dataset_files(selected_poses)],
+            params=["select_by"],
+        ),
+        Stage(
+            name="submit",
+            run=_run_submit,
+            deps=["select"],
+            inputs=[dataset_files(selected_poses), dataset_files(asap_test_raw)],
+            outputs=[submission_path()],
+        ),
+    ]
+
+
+####################################
+# Runner
+####################################
+
+
+class Pipeline:
+    def __init__(
+        self,
+        config: PipelineConfig | None = None,
+        stages: List[Stage] | None = None,
+        state_path: Path | str | None = None,
+    ):
+        state_path = pipeline_state_path() if state_path is None else state_path
+        stages = default_stages() if stages is None else stages
+        self.config = config or PipelineConfig()
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+        self.state_path = Path(state_path)
+        self._lock = threading.Lock()
+        state = {}
+        if self.state_path.exists():
+            with open(self.state_path) as fd:
+                state = json.load(fd)
+        self.records: Dict[str, StageRecord] = {
+            name: StageRecord(**record) for name, record in state.get("stages", {}).items()
+        }
+        self._file_hashes: Dict[str, List] = state.get("files", {})
+
+    def fingerprint(self, path: Path) -> str | None:
+        """
+        sha256 of a file, or None if it's missing.  Only re-read if its size or mtime changed.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            memo = self._file_hashes.get(str(path))
+        if memo is not None and memo[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return memo[2]
+        digest = sha256_file(path)
+        with self._lock:
+            self._file_hashes[str(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def _files_key(self, patterns: List[Path]) -> Dict[str, str | None]:
+        return {str(path): self.fingerprint(path) for pattern in patterns for path in expand(pattern)}
+
+    def stage_key(self, stage: Stage) -> str:
+        params = {name: getattr(self.config, name) for name in stage.params}
+        payload = {"inputs": self._files_key(stage.inputs), "params": params}
+        return sha256_bytes(json.dumps(payload, sort_keys=True).encode())
+
+    def outputs_key(self, stage: Stage) -> str:
+        return sha256_bytes(json.dumps(self._files_key(stage.outputs), sort_keys=True).encode())
+
+    def staleness(self, stage: Stage, force: bool = False) -> str | None:
+        """
+        Why the stage needs to run, or None if it's up to date.
+        """
+        record = self.records.get(stage.name)
+        if force:
+            return "forced"
+        if record is None or record.key is None:
+            return "never run"
+        if not all(any(path.exists() for path in expand(pattern)) for pattern in stage.outputs):
+            return "outputs missing"
+        # e.g. one docked SDF deleted, out of thousands
+        if record.outputs_key != self.outputs_key(stage):
+            return "outputs changed"
+        if record.key != self.stage_key(stage):
+            return "inputs or parameters changed"
+        return None
+
+    def select(self, until: str | None = None) -> List[str]:
+        """
+        Names of the stages needed to get through until (default: all of them), in dependency order.
+        """
+        if until is None:
+            return list(self.stages)
+        if until not in self.stages:
+            raise ValueError(f"No stage {until}, expected one of {list(self.stages)}")
+        needed = set()
+        todo = [until]
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in needed]
+
+    def plan(self, until: str | None = None, force: bool = False) -> List[Tuple[str, str]]:
+        """
+        What a run would do, stage by stage, without doing it.
+        A stage downstream of one that will run may or may not run, depending on whether its inputs change.
+        """
+        plan, will_run = [], set()
+        for name in self.select(until):
+            stage = self.stages[name]
+            waiting = [dep for dep in stage.deps if dep in will_run]
+            reason = self.staleness(stage, force)
+            if reason is None and waiting:
+                plan.append((name, f"maybe, if {', '.join(waiting)} changes its outputs"))
+                will_run.add(name)
+                continue
+            if reason is None:
+                plan.append((name, "up to date"))
+                continue
+            will_run.add(name)
+            if stage.stale_rows is not None and not waiting:
+                n_stale, n_total = stage.stale_rows(self, self._fresh_record(name, force))
+                reason += f", {n_stale} of {n_total} rows stale"
+            plan.append((name, f"run ({reason})"))
+        return plan
+
+    def _fresh_record(self, name: str, force: bool) -> StageRecord:
+        if force or name not in self.records:
+            return StageRecord()
+        return StageRecord(**asdict(self.records[name]))
+
+    def _run_stage(self, stage: Stage, force: bool) -> bool:
+        reason = self.staleness(stage, force)
+        if reason is None:
+            logger.info(f"Stage {stage.name} is up to date.")
+            return False
+        logger.info(f"Running stage {stage.name} ({reason})...")
+        # Keyed on the inputs as they were when we started, so anything that changes mid-run is caught next time
+        key = self.stage_key(stage)
+        record = self._fresh_record(stage.name, force)
+        with timed(f"pipeline_{stage.name}"):
+            stage.run(self, record)
+        record.key = key
+        record.outputs_key = self.outputs_key(stage)
+        record.finished = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            self.records[stage.name] = record
+            self._write()
+        logger.info(f"Done with stage {stage.name}.")
+        return True
+
+    def _write(self):
+        # Forget hashes of files that are gone, then write-then-rename like the docking cache does
+        self._file_hashes = {path: memo for path, memo in self._file_hashes.items() if os.path.exists(path)}
+        state = {
+            "stages": {name: asdict(record) for name, record in self.records.items()},
+            "files": self._file_hashes,
+        }
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as fd:
+            json.dump(state, fd, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, until: str | None = None, force: bool = False, max_workers: int = 4) -> List[str]:
+        """
+        Run every stale stage up to until, each as soon as its dependencies are done.
+        Returns the names of the stages that actually ran.  If one fails, nothing new is started,
+        the ones already running finish, and the error is raised.
+        """
+        logger.info("Start.")
+        names = self.select(until)
+        done, ran = set(), []
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while len(done) < len(names):
+                for name in names:
+                    stage = self.stages[name]
+                    if name not in done and name not in running.values() and all(dep in done for dep in stage.deps):
+                        running[executor.submit(self._run_stage, stage, force)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.result():
+                        ran.append(name)
+                    done.add(name)
+        logger.info(f"Done. Ran {ran or 'nothing'}.")
+        return ran
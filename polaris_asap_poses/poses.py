@@ -0,0 +1,136 @@
+"""
+Docked poses as one columnar table.
+
+build_pose_table parses every gnina output in data/gnina-out, in a process pool, into a single
+DataFrame with one row per pose: test_fake_id, protein_label, pose_rank, gnina's scores and the pose
+itself as RDKit binary.  Picking poses across the whole test set is then a polars query,
+e.g. top_k_poses(df, k=1, by="cnn_score").
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+import polars as pl
+from typeguard import typechecked
+
+from polaris_asap_poses.io import (NamedDataset, data_dir_gnina_out, iter_sdf,
+                                   mol_to_binary)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.model import parse_docking_result_path
+
+# SD property gnina writes -> our column name
+GNINA_SCORE_PROPS = {
+    "minimizedAffinity": "minimized_affinity",
+    "CNNscore": "cnn_score",
+    "CNNaffinity": "cnn_affinity",
+}
+
+POSE_TABLE_SCHEMA = {
+    "test_fake_id": pl.Int64,
+    "protein_label": pl.String,
+    "pose_rank": pl.Int32,
+    "minimized_affinity": pl.Float64,
+    "cnn_score": pl.Float64,
+    "cnn_affinity": pl.Float64,
+    "n_heavy_atoms": pl.Int32,
+    "mol": pl.Binary,
+}
+
+# Group by this to get "per ligand"
+POSE_GROUP = ["test_fake_id", "protein_label"]
+
+# Partitioned by receptor, so e.g. gnina_poses.scan().filter(pl.col("protein_label") == MERS.data_label)
+# only reads the MERS poses.  Rows come back grouped by receptor; sort by POSE_GROUP if order matters
+gnina_poses = NamedDataset(
+    name="gnina_poses",
+    filepath="combined/gnina_poses.parquet",
+    mol_columns=["mol"],
+    partition_by=["protein_label"],
+)
+# The pose picked for each test row, e.g. by top_k_poses, ready for submission.build_submission
+selected_poses = NamedDataset(
+    name="selected_poses",
+    filepath="combined/selected_poses.parquet",
+    mol_columns=["mol"],
+)
+
+
+def parse_gnina_output(path: Path) -> List[Dict[str, Any]]:
+    """
+    One row per pose in a gnina output file, in gnina's order (best first).
+    """
+    parsed = parse_docking_result_path(path)
+    if parsed is None:
+        logger.warning(f"Skipping {path}, doesn't look like a docking result")
+        return []
+    test_fake_id, protein = parsed
+    rows = []
+    for pose_rank, mol in enumerate(iter_sdf(path)):
+        row = {
+            "test_fake_id": test_fake_id,
+            "protein_label": protein.data_label,
+            "pose_rank": pose_rank,
+            "n_heavy_atoms": mol.GetNumHeavyAtoms(),
+            "mol": mol_to_binary(mol),
+        }
+        for prop, column in GNINA_SCORE_PROPS.items():
+            row[column] = mol.GetDoubleProp(prop) if mol.HasProp(prop) else None
+        rows.append(row)
+    return rows
+
+
+def parse_gnina_outputs(paths: List[Path], processes: int | None = None) -> pl.DataFrame:
+    """
+    Parse gnina output files, in a process pool, into a pose table sorted by ligand and pose_rank.
+    """
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunks = executor.map(parse_gnina_output, paths, chunksize=max(1, len(paths) // 64))
+        rows = [row for chunk in chunks for row in chunk]
+    return pl.DataFrame(rows, schema=POSE_TABLE_SCHEMA).sort(POSE_GROUP + ["pose_rank"])
+
+
+@timed("build_pose_table")
+@typechecked
+def build_pose_table(
+    gnina_out_dir: Path | None = None,
+    processes: int | None = None,
+    save: bool = True,
+) -> pl.DataFrame:
+    """
+    Parse every docked_test_*.sdf in gnina_out_dir into one pose table, a file per task.
+    """
+    gnina_out_dir = data_dir_gnina_out() if gnina_out_dir is None else gnina_out_dir
+    paths = sorted(gnina_out_dir.glob("docked_test_*.sdf"))
+    logger.info(f"Parsing {len(paths)} gnina outputs from {gnina_out_dir}...")
+    df = parse_gnina_outputs(paths, processes=processes)
+    logger.info(f"Done. {len(df)} poses for {df.select(POSE_GROUP).n_unique()} ligands.")
+    if save:
+        gnina_poses.save(df)
+    return df
+
+
+def pose_rank_expr(by: str = "cnn_score", descending: bool = True) -> pl.Expr:
+    """
+    Rank of each pose within its ligand by the given column, 1 = best.
+    Ties go to whichever comes first, which is gnina's order in a table from build_pose_table.
+    """
+    return pl.col(by).rank(method="ordinal", descending=descending).over(POSE_GROUP)
+
+
+def top_k_poses(
+    df: pl.DataFrame | pl.LazyFrame,
+    k: int = 1,
+    by: str = "cnn_score",
+    descending: bool = True,
+) -> pl.DataFrame | pl.LazyFrame:
+    """
+    The k best poses per ligand by the given column, across the whole test set.
+    For minimized_affinity (kcal/mol, lower is better) use descending=False.
+    """
+    return (
+        df.with_columns(pose_rank_expr(by, descending).alias(f"rank_by_{by}"))
+        .filter(pl.col(f"rank_by_{by}") <= k)
+        .sort(POSE_GROUP + [f"rank_by_{by}"])
+    )
@@ -0,0 +1,315 @@
+"""
+In-process rescoring of poses with a Vina-like empirical scoring function, on plain CPUs.
+
+ReceptorScorer loads a receptor once, types its heavy atoms the way Vina does (XS types), and bins
+them into a coarse cell grid.  For every ligand atom type it needs, it precomputes an energy map over
+the pocket box, using the cell grid so each map point only sees receptor atoms within the cutoff.
+Scoring a batch of poses is then one trilinear interpolation over every ligand atom at once, plus a
+bincount back to poses, so tens of thousands of poses take seconds.
+
+Only the intermolecular terms are scored (poses are rigid here, so Vina's intramolecular terms
+don't change the ranking much), normalized by rotatable bonds as Vina does.  Don't expect these to
+match gnina's minimizedAffinity exactly: no hydrogens are placed and there's no local optimization.
+"""
+
+import itertools
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+import polars as pl
+from rdkit import Chem
+from rdkit.Chem import rdMolDescriptors
+from typeguard import typechecked
+
+from polaris_asap_poses.io import mol_from_binary, read_sdf
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.model import Protein, get_protein
+from polaris_asap_poses.poses import POSE_GROUP
+
+
+@dataclass(frozen=True)
+class XSType:
+    radius: float
+    hydrophobic: bool = False
+    donor: bool = False
+    acceptor: bool = False
+
+
+# Vina's XS atom types
+XS_TYPES = {
+    "C_H": XSType(1.9, hydrophobic=True),
+    "C_P": XSType(1.9),
+    "N_P": XSType(1.8),
+    "N_D": XSType(1.8, donor=True),
+    "N_A": XSType(1.8, acceptor=True),
+    "N_DA": XSType(1.8, donor=True, acceptor=True),
+    "O_A": XSType(1.7, acceptor=True),
+    "O_DA": XSType(1.7, donor=True, acceptor=True),
+    "S_P": XSType(2.0),
+    "P_P": XSType(2.1),
+    "F_H": XSType(1.5, hydrophobic=True),
+    "Cl_H": XSType(1.8, hydrophobic=True),
+    "Br_H": XSType(2.0, hydrophobic=True),
+    "I_H": XSType(2.2, hydrophobic=True),
+    "Met_D": XSType(1.2, donor=True),
+}
+
+# Vina 1.1 weights
+VINA_WEIGHTS = {
+    "gauss1": -0.035579,
+    "gauss2": -0.005156,
+    "repulsion": 0.840245,
+    "hydrophobic": -0.035069,
+    "hbond": -0.587439,
+    "rot": 0.05846,
+}
+VINA_CUTOFF = 8.0
+
+_METALS = {"Mg", "Mn", "Zn", "Ca", "Fe", "Cu", "Co", "Ni", "Na", "K"}
+_HALOGENS = {"F": "F_H", "Cl": "Cl_H", "Br": "Br_H", "I": "I_H"}
+
+
+def xs_type(atom: Chem.Atom) -> str | None:
+    """
+    XS type of a heavy atom, or None for hydrogens and anything we don't have a type for.
+    """
+    symbol = atom.GetSymbol()
+    n_hs = atom.GetTotalNumHs(includeNeighbors=True)
+    if symbol == "C":
+        bonded_to_hetero = any(x.GetSymbol() not in ("C", "H") for x in atom.GetNeighbors())
+        return "C_P" if bonded_to_hetero else "C_H"
+    if symbol == "N":
+        donor = n_hs > 0
+        # A nitrogen with a free lone pair: no H, not charged, not saturated with heavy neighbors
+        acceptor = n_hs == 0 and atom.GetFormalCharge() <= 0 and atom.GetDegree() < 3
+        return {(True, True): "N_DA", (True, False): "N_D", (False, True): "N_A"}.get((donor, acceptor), "N_P")
+    if symbol == "O":
+        return "O_DA" if n_hs > 0 else "O_A"
+    if symbol == "S":
+        return "S_P"
+    if symbol == "P":
+        return "P_P"
+    if symbol in _HALOGENS:
+        return _HALOGENS[symbol]
+    if symbol in _METALS:
+        return "Met_D"
+    return None
+
+
+def typed_heavy_atoms(mol: Chem.Mol) -> Tuple[np.ndarray, List[str]]:
+    """
+    Indices and XS types of the atoms we score, skipping hydrogens and anything untyped.
+    """
+    indices, types = [], []
+    for atom in mol.GetAtoms():
+        xs = xs_type(atom)
+        if xs is not None:
+            indices.append(atom.GetIdx())
+            types.append(xs)
+    return np.array(indices, dtype=np.intp), types
+
+
+def _pair_energy(distance: np.ndarray, receptor_types: List[str], ligand_type: str, rec_index: np.ndarray) -> np.ndarray:
+    """
+    Weighted Vina terms between one ligand type and receptor atoms, for an (..., n_receptor) distance array.
+    rec_index maps each column of distance to the receptor type arrays.
+    """
+    lig = XS_TYPES[ligand_type]
+    radii = np.array([XS_TYPES[x].radius for x in receptor_types])[rec_index]
+    hydrophobic = np.array([XS_TYPES[x].hydrophobic for x in receptor_types])[rec_index]
+    donor = np.array([XS_TYPES[x].donor for x in receptor_types])[rec_index]
+    acceptor = np.array([XS_TYPES[x].acceptor for x in receptor_types])[rec_index]
+
+    surface = distance - radii - lig.radius
+    energy = VINA_WEIGHTS["gauss1"] * np.exp(-((surface / 0.5) ** 2))
+    energy += VINA_WEIGHTS["gauss2"] * np.exp(-(((surface - 3.0) / 2.0) ** 2))
+    energy += VINA_WEIGHTS["repulsion"] * np.where(surface < 0, surface**2, 0.0)
+    if lig.hydrophobic:
+        energy += VINA_WEIGHTS["hydrophobic"] * np.where(hydrophobic, np.clip(1.5 - surface, 0.0, 1.0), 0.0)
+    hbond_partner = (lig.donor & acceptor) | (lig.acceptor & donor)
+    if hbond_partner.any():
+        energy += VINA_WEIGHTS["hbond"] * np.where(hbond_partner, np.clip(-surface / 0.7, 0.0, 1.0), 0.0)
+    return np.where(distance < VINA_CUTOFF, energy, 0.0).sum(axis=-1)
+
+
+class ReceptorScorer:
+    """
+    Vina-like scoring of poses against one receptor, within a box around its pocket.
+    Maps are built lazily, per ligand atom type, the first time a type is seen.
+    """
+
+    def __init__(
+        self,
+        receptor: Chem.Mol,
+        box_min: np.ndarray,
+        box_max: np.ndarray,
+        spacing: float = 0.375,
+        out_of_box_penalty: float = 1.0,
+    ):
+        self.spacing = spacing
+        self.out_of_box_penalty = out_of_box_penalty
+        self.origin = np.asarray(box_min, dtype=np.float64)
+        self.shape = tuple(int(x) for x in np.ceil((np.asarray(box_max) - self.origin) / spacing).astype(int) + 1)
+
+        indices, types = typed_heavy_atoms(receptor)
+        coords = receptor.GetConformer().GetPositions()[indices]
+        # Anything further than the cutoff from the box can't touch a map point
+        near = np.all((coords > self.origin - VINA_CUTOFF) & (coords < self.box_max + VINA_CUTOFF), axis=1)
+        self.receptor_coords = coords[near]
+        self.receptor_types = [t for t, keep in zip(types, near) if keep]
+        self._receptor_type_names = sorted(set(self.receptor_types))
+        self._receptor_type_index = np.array([self._receptor_type_names.index(x) for x in self.receptor_types])
+        self._cells = self._bin_receptor()
+        self.maps: Dict[str, np.ndarray] = {}
+        logger.info(f"Receptor has {len(self.receptor_coords)} typed atoms near a {self.shape} map box.")
+
+    @property
+    def box_max(self) -> np.ndarray:
+        return self.origin + (np.array(self.shape) - 1) * self.spacing
+
+    @classmethod
+    @typechecked
+    def from_protein(cls, protein: Protein, padding: float = 6.0, **kwargs) -> "ReceptorScorer":
+        """
+        Scorer for protein.ref_pdb_path, with the box around its reference ligand plus padding,
+        which covers gnina's autobox (reference ligand + 4 Å) with room to spare.
+        """
+        receptor = Chem.MolFromPDBFile(str(protein.ref_pdb_path), removeHs=False)
+        if receptor is None:
+            raise ValueError(f"Couldn't read {protein.ref_pdb_path}")
+        ligand_coords = np.concatenate([x.GetConformer().GetPositions() for x in read_sdf(protein.ref_ligand_sdf_path)])
+        return cls(receptor, ligand_coords.min(axis=0) - padding, ligand_coords.max(axis=0) + padding, **kwargs)
+
+    def _bin_receptor(self) -> Dict[Tuple[int, int, int], np.ndarray]:
+        """
+        Receptor atoms bucketed into cutoff-sized cells, keyed by cell, for neighbor lookups.
+        """
+        cells = np.floor((self.receptor_coords - self.origin) / VINA_CUTOFF).astype(int)
+        buckets: Dict[Tuple[int, int, int], List[int]] = {}
+        for i, cell in enumerate(map(tuple, cells)):
+            buckets.setdefault(cell, []).append(i)
+        return {cell: np.array(atoms) for cell, atoms in buckets.items()}
+
+    def _neighbors(self, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+        """
+        Receptor atoms that can be within the cutoff of any point in the box [lo, hi].
+        """
+        lo_cell = np.floor((lo - self.origin) / VINA_CUTOFF).astype(int) - 1
+        hi_cell = np.floor((hi - self.origin) / VINA_CUTOFF).astype(int) + 1
+        found = [
+            self._cells[cell]
+            for cell in itertools.product(*(range(a, b + 1) for a, b in zip(lo_cell, hi_cell)))
+            if cell in self._cells
+        ]
+        return np.concatenate(found) if found else np.empty(0, dtype=int)
+
+    def _build_maps(self, ligand_types: List[str]):
+        """
+        Energy maps for several ligand types in one pass, sharing the distance calculations.
+        """
+        logger.info(f"Building maps for {ligand_types}...")
+        maps = {t: np.zeros(self.shape) for t in ligand_types}
+        axes = [np.arange(n) for n in self.shape]
+        points_per_cell = int(VINA_CUTOFF // self.spacing)
+        for i0 in range(0, self.shape[0], points_per_cell):
+            for j0 in range(0, self.shape[1], points_per_cell):
+                for k0 in range(0, self.shape[2], points_per_cell):
+                    block = np.stack(
+                        np.meshgrid(
+                            axes[0][i0 : i0 + points_per_cell],
+                            axes[1][j0 : j0 + points_per_cell],
+                            axes[2][k0 : k0 + points_per_cell],
+                            indexing="ij",
+                        ),
+                        axis=-1,
+                    )
+                    points = self.origin + block * self.spacing
+                    neighbors = self._neighbors(points[0, 0, 0], points[-1, -1, -1])
+                    if not len(neighbors):
+                        continue
+                    distance = np.linalg.norm(points[..., None, :] - self.receptor_coords[neighbors], axis=-1)
+                    rec_index = self._receptor_type_index[neighbors]
+                    for t in ligand_types:
+                        maps[t][block[..., 0], block[..., 1], block[..., 2]] = _pair_energy(
+                            distance, self._receptor_type_names, t, rec_index
+                        )
+        self.maps.update(maps)
+        logger.info("Done.")
+
+    def score_atoms(self, coords: np.ndarray, types: List[str] | np.ndarray) -> np.ndarray:
+        """
+        Per-atom energy for (n_atoms, 3) coords of the given XS types, by trilinear interpolation.
+        """
+        types = np.asarray(types)
+        missing = sorted(set(types.tolist()) - set(self.maps))
+        if missing:
+            self._build_maps(missing)
+        type_names = sorted(set(types.tolist()))
+        stacked = np.stack([self.maps[t] for t in type_names])
+        type_index = np.searchsorted(type_names, types)
+
+        grid = (coords - self.origin) / self.spacing
+        upper = np.array(self.shape) - 1
+        clipped = np.clip(grid, 0, upper)
+        outside = np.linalg.norm((grid - clipped) * self.spacing, axis=1)
+        lower = np.minimum(np.floor(clipped).astype(int), upper - 1)
+        frac = clipped - lower
+
+        energy = np.zeros(len(coords))
+        for corner in np.ndindex(2, 2, 2):
+            offset = np.array(corner)
+            weight = np.prod(np.where(offset, frac, 1.0 - frac), axis=1)
+            idx = lower + offset
+            energy += weight * stacked[type_index, idx[:, 0], idx[:, 1], idx[:, 2]]
+        return energy + self.out_of_box_penalty * outside
+
+    @typechecked
+    def score(self, coords: np.ndarray, types: List[str], n_rotatable: int = 0) -> np.ndarray:
+        """
+        Vina-like score (kcal/mol-ish, lower is better) for a batch of poses of one ligand,
+        coords (n_poses, n_atoms, 3) for atoms of the given XS types.
+        """
+        n_poses, n_atoms, _ = coords.shape
+        energy = self.score_atoms(coords.reshape(-1, 3), np.tile(types, n_poses)).reshape(n_poses, n_atoms).sum(axis=1)
+        return energy / (1.0 + VINA_WEIGHTS["rot"] * n_rotatable)
+
+
+@typechecked
+def rescore_poses(
+    df: pl.DataFrame,
+    scorers: Dict[str, ReceptorScorer] | None = None,
+    column: str = "vina_score",
+) -> pl.DataFrame:
+    """
+    Rescore every pose in a pose table (see poses.build_pose_table), with one ReceptorScorer per protein.
+    Returns test_fake_id, protein_label, pose_rank and the score, to join back onto the pose table.
+    Poses of one ligand are assumed to share atom order, as gnina's do, so atoms are typed once per ligand
+    and all atoms of all poses for a protein are scored in one batch.
+    """
+    scorers = {} if scorers is None else scorers
+    key_columns = POSE_GROUP + ["pose_rank"]
+    out = [pl.DataFrame(schema={**{x: df.schema[x] for x in key_columns}, column: pl.Float64})]
+    for (protein_label,), df_protein in df.group_by("protein_label"):
+        if protein_label not in scorers:
+            scorers[protein_label] = ReceptorScorer.from_protein(get_protein(protein_label))
+        scorer = scorers[protein_label]
+        logger.info(f"Rescoring {len(df_protein)} {protein_label} poses...")
+
+        keys, coords, types, pose_of_atom, normalization = [], [], [], [], []
+        for _, df_ligand in df_protein.group_by("test_fake_id"):
+            mols = [mol_from_binary(x) for x in df_ligand["mol"]]
+            indices, ligand_types = typed_heavy_atoms(mols[0])
+            rot = 1.0 + VINA_WEIGHTS["rot"] * rdMolDescriptors.CalcNumRotatableBonds(mols[0])
+            for mol in mols:
+                pose_of_atom.append(np.full(len(indices), len(normalization)))
+                coords.append(mol.GetConformer().GetPositions()[indices])
+                types.extend(ligand_types)
+                normalization.append(rot)
+            keys.append(df_ligand.select(key_columns))
+
+        atom_energy = scorer.score_atoms(np.concatenate(coords), types)
+        energy = np.bincount(np.concatenate(pose_of_atom), weights=atom_energy, minlength=len(normalization))
+        out.append(pl.concat(keys).with_columns(pl.Series(column, energy / np.array(normalization))))
+        logger.info("Done.")
+    return pl.concat(out)
@@ -1,3 +1,5 @@
+import functools
+
 from dynaconf import Dynaconf, LazySettings
 from pydantic import BaseModel, Field, ValidationError
 from typeguard import typechecked
@@ -7,6 +9,9 @@ class SettingsSchema(BaseModel):
     log_level: str = Field(default="INFO")
     log_to_file: bool = Field(default=False)
     log_file: str = Field(default="./log/polaris-asap-poses.log")
+    metrics_to_file: bool = Field(default=True)
+    metrics_file: str = Field(default="./log/metrics.jsonl")
+    gnina_bin: str = Field(default="./bin/gnina")
     notebook_port: int = Field(..., ge=1024, le=49151)
 
 
@@ -48,10 +53,12 @@ def validate_settings(settings_obj: LazySettings):
         raise e
 
 
+@functools.cache
 @typechecked
 def get_settings() -> LazySettings:
     """
     Get the settings object and validate it before returning.
+    Loaded and validated once per process, on first use.
     """
     s = load_settings()
     validate_settings(s)
@@ -0,0 +1,143 @@
+"""
+Local snapshot of the competition's train/test split.
+
+The split is pulled from Polaris once and written to parquet (see asap_train_raw and asap_test_raw),
+along with a manifest fingerprinting what was written.  After that, get_df_train and get_df_test read
+the local files, so workers and CLI commands start fast and don't need Polaris credentials.
+
+Set POLARIS_ASAP_POSES_OFFLINE=1 (or pass offline=True) to make sure nothing ever goes to the network.
+This module doesn't import polaris at all unless it has to build a snapshot.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+import polars as pl
+
+from polaris_asap_poses.io import (asap_test_raw, asap_train_raw, data_dir_raw,
+                                   ensure_data_dirs)
+from polaris_asap_poses.logger import logger
+
+
+def snapshot_manifest_path() -> Path:
+    return data_dir_raw() / "snapshot.json"
+
+
+def is_offline() -> bool:
+    return os.environ.get("POLARIS_ASAP_POSES_OFFLINE", "").lower() in ("1", "true", "yes")
+
+
+def _sha256_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while chunk := fd.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Files we've already checked this process, by (path, mtime, size), so reading the snapshot again doesn't rehash it
+_verified = set()
+
+
+def snapshot_problem(manifest: dict | None) -> str | None:
+    """
+    What's wrong with the local snapshot, if anything: missing files, or files whose sha256 doesn't match the manifest.
+    """
+    if manifest is None:
+        return f"no manifest at {snapshot_manifest_path()}"
+    for name, dataset in (("train", asap_train_raw), ("test", asap_test_raw)):
+        path = dataset.path
+        if not os.path.exists(path):
+            return f"{path} is missing"
+        stat = os.stat(path)
+        memo_key = (str(path), stat.st_mtime_ns, stat.st_size)
+        if memo_key in _verified:
+            continue
+        expected = manifest.get("files", {}).get(name)
+        if expected != _sha256_file(path):
+            return f"{path} doesn't match the sha256 in {snapshot_manifest_path()}"
+        _verified.add(memo_key)
+    return None
+
+
+def write_snapshot(comp) -> dict:
+    """
+    Materialize the competition's train/test split locally, in a single pass over Polaris.
+    """
+    from polaris_asap_poses.download import get_dfs_for_comp
+
+    logger.info(f"Writing snapshot of comp {comp.name}...")
+    df_train, df_test = get_dfs_for_comp(comp, save=True)
+    try:
+        polaris_version = version("polaris-lib")
+    except PackageNotFoundError:
+        polaris_version = None
+    files = {
+        "train": _sha256_file(asap_train_raw.path),
+        "test": _sha256_file(asap_test_raw.path),
+    }
+    manifest = {
+        "competition": comp.name,
+        "artifact_id": getattr(comp, "artifact_id", None),
+        "polaris_version": polaris_version,
+        "n_train": len(df_train),
+        "n_test": len(df_test),
+        "files": files,
+        "fingerprint": hashlib.sha256(json.dumps([comp.name, files], sort_keys=True).encode()).hexdigest(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+    }
+    ensure_data_dirs()
+    with open(snapshot_manifest_path(), "w") as fd:
+        json.dump(manifest, fd, indent=2)
+    logger.info(f"Done. Fingerprint {manifest['fingerprint']}.")
+    return manifest
+
+
+def read_snapshot_manifest() -> dict | None:
+    if not snapshot_manifest_path().exists():
+        return None
+    with open(snapshot_manifest_path()) as fd:
+        return json.load(fd)
+
+
+def ensure_snapshot(offline: bool | None = None, refresh: bool = False) -> dict:
+    """
+    Return the snapshot manifest, building the snapshot first if there isn't one (or refresh).
+    The files are checked against the manifest's sha256s, and a truncated or stale snapshot is rebuilt.
+    Offline, a missing or bad snapshot is an error rather than a trip to Polaris.
+    """
+    offline = is_offline() if offline is None else offline
+    manifest = read_snapshot_manifest()
+    problem = "refresh requested" if refresh else snapshot_problem(manifest)
+    if problem is None:
+        return manifest
+    if offline:
+        raise RuntimeError(
+            f"Can't use the competition snapshot ({problem}), and we're offline. "
+            "Run `make download-comp-data` somewhere with Polaris credentials first."
+        )
+    logger.warning(f"Rebuilding the competition snapshot: {problem}")
+    from polaris_asap_poses.download import load_comp
+
+    return write_snapshot(load_comp())
+
+
+def get_df_train(decode_mols: bool = False, offline: bool | None = None) -> pl.DataFrame:
+    """
+    Training data from the local snapshot.
+    ligand_pose comes back as pl.Binary unless decode_mols; decode single poses with io.mol_from_binary.
+    """
+    ensure_snapshot(offline=offline)
+    return asap_train_raw.read(decode_mols=decode_mols)
+
+
+def get_df_test(offline: bool | None = None) -> pl.DataFrame:
+    """
+    Test data from the local snapshot.
+    """
+    ensure_snapshot(offline=offline)
+    return asap_test_raw.read()
@@ -0,0 +1,110 @@
+"""
+Build the submission from selected poses.
+
+build_submission takes one chosen pose per test row (e.g. top_k_poses(pose_table, k=1)), checks it
+against the test set, serializes the poses with serialize_rdkit_mol in a process pool, and streams
+them into a JSON Lines file in test-set order, a window at a time, so the base64 strings never all sit
+in memory together.
+"""
+
+import base64
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import polars as pl
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.io import data_dir, serialize_rdkit_mol
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.snapshot import get_df_test
+
+
+def data_dir_submission() -> Path:
+    return data_dir() / "submission"
+
+
+def submission_path() -> Path:
+    return data_dir_submission() / "submission.jsonl"
+
+
+def _serialize_pose(mol_bytes: bytes) -> str:
+    return serialize_rdkit_mol(Chem.Mol(mol_bytes))
+
+
+@typechecked
+def validate_selection(df_selected: pl.DataFrame, df_test: pl.DataFrame) -> pl.DataFrame:
+    """
+    Check there's exactly one pose for every test row, for the right protein,
+    and return the selection in test-set order.
+    """
+    missing_columns = {"test_fake_id", "protein_label", "mol"} - set(df_selected.columns)
+    if missing_columns:
+        raise ValueError(f"Selected poses are missing columns {sorted(missing_columns)}")
+
+    duplicated = df_selected.filter(pl.col("test_fake_id").is_duplicated())["test_fake_id"].unique().to_list()
+    if duplicated:
+        raise ValueError(f"More than one pose selected for test_fake_ids {sorted(duplicated)}")
+
+    ordered = (
+        df_test.select("test_fake_id", "protein_label", "CXSMILES")
+        .with_row_index("test_order")
+        .join(
+            df_selected.select("test_fake_id", pl.col("protein_label").alias("selected_protein_label"), "mol"),
+            on="test_fake_id",
+            how="left",
+        )
+        .sort("test_order")
+    )
+    missing = ordered.filter(pl.col("mol").is_null())["test_fake_id"].to_list()
+    if missing:
+        raise ValueError(f"No pose selected for {len(missing)} test rows, test_fake_ids {missing}")
+    mismatched = ordered.filter(pl.col("protein_label") != pl.col("selected_protein_label"))["test_fake_id"].to_list()
+    if mismatched:
+        raise ValueError(f"Selected poses are for the wrong protein for test_fake_ids {mismatched}")
+    extra = set(df_selected["test_fake_id"].to_list()) - set(df_test["test_fake_id"].to_list())
+    if extra:
+        raise ValueError(f"Selected poses for test_fake_ids that aren't in the test set: {sorted(extra)}")
+    return ordered.drop("test_order", "selected_protein_label")
+
+
+@typechecked
+def build_submission(
+    df_selected: pl.DataFrame,
+    out_path: Path | None = None,
+    df_test: pl.DataFrame | None = None,
+    processes: int | None = None,
+    window: int = 4096,
+) -> Path:
+    """
+    Serialize one selected pose per test row into a JSON Lines submission file, in test-set order.
+    Poses are serialized in a process pool, window rows at a time, and written out as each window finishes.
+    """
+    out_path = submission_path() if out_path is None else out_path
+    df_test = get_df_test() if df_test is None else df_test
+    ordered = validate_selection(df_selected, df_test)
+    logger.info(f"Writing submission with {len(ordered)} poses to {out_path}...")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with ProcessPoolExecutor(max_workers=processes) as executor, open(tmp_path, "w") as fd:
+        for df_window in ordered.iter_slices(n_rows=window):
+            serialized = executor.map(_serialize_pose, df_window["mol"].to_list(), chunksize=64)
+            for row, ligand_pose in zip(
+                df_window.select("test_fake_id", "protein_label", "CXSMILES").iter_rows(named=True), serialized
+            ):
+                fd.write(json.dumps({**row, "ligand_pose": ligand_pose}) + "\n")
+    tmp_path.replace(out_path)
+    logger.info("Done.")
+    return out_path
+
+
+def iter_submission_poses(path: Path | None = None) -> Iterator[Chem.Mol]:
+    """
+    Read the poses back out of a submission file, in order, e.g. to hand to Polaris.
+    """
+    path = submission_path() if path is None else path
+    with open(path) as fd:
+        for line in fd:
+            yield Chem.Mol(base64.b64decode(json.loads(line)["ligand_pose"]))
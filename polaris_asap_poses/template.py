@@ -0,0 +1,176 @@
+"""
+Template-based pose transfer, a fast path around docking for close analogs of training ligands.
+
+For each test ligand, find the most similar training ligands for the same protein.  If the best one
+is similar enough, take the maximum common substructure (MCS) with its crystal pose, pin the shared
+core to the template's coordinates, embed the remaining atoms around it, and relax them with MMFF
+while the core stays fixed.  Ligands handled this way don't need docking at all: gnina.run only has
+gnina minimize and score their poses (see gnina.score_template_poses), so they're ranked like docked ones.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import polars as pl
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem, rdFingerprintGenerator, rdFMCS, rdMolAlign
+from typeguard import typechecked
+
+from polaris_asap_poses.io import (data_dir_gnina_out, mol_from_binary,
+                                   mol_to_binary, write_sdfs)
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.model import Protein, get_protein
+
+
+def data_dir_template_poses() -> Path:
+    return data_dir_gnina_out() / "templates"
+
+
+_MORGAN = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=2048)
+
+
+def template_pose_path(protein: Protein, test_fake_id: int) -> Path:
+    """
+    Unscored template poses go off to the side, named like the docking result they'll become.
+    """
+    return data_dir_template_poses() / protein.docking_result_path(test_fake_id).name
+
+
+def morgan_fp(smiles: str):
+    return _MORGAN.GetFingerprint(Chem.MolFromSmiles(smiles))
+
+
+@typechecked
+def transfer_pose(
+    smiles: str,
+    template: Chem.Mol,
+    seed: int = 0,
+    mcs_timeout: int = 10,
+    min_core_fraction: float = 0.5,
+) -> Chem.Mol | None:
+    """
+    Build a pose for smiles by copying the coordinates of its MCS with the template pose and
+    embedding the rest.  Returns None if the common core is too small or embedding fails.
+    """
+    template = Chem.RemoveHs(template)
+    probe = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    mcs = rdFMCS.FindMCS(
+        [template, Chem.RemoveHs(probe)],
+        timeout=mcs_timeout,
+        ringMatchesRingOnly=True,
+        completeRingsOnly=True,
+        atomCompare=rdFMCS.AtomCompare.CompareElements,
+        bondCompare=rdFMCS.BondCompare.CompareOrder,
+    )
+    if mcs.numAtoms < min_core_fraction * probe.GetNumHeavyAtoms():
+        return None
+    core = Chem.MolFromSmarts(mcs.smartsString)
+    template_match = template.GetSubstructMatch(core)
+    probe_match = probe.GetSubstructMatch(core)
+    if not template_match or not probe_match:
+        return None
+
+    template_conf = template.GetConformer()
+    coord_map = {p: template_conf.GetAtomPosition(t) for p, t in zip(probe_match, template_match)}
+    if AllChem.EmbedMolecule(probe, coordMap=coord_map, randomSeed=seed, useRandomCoords=True) < 0:
+        return None
+    # Embedding keeps the core's shape but not where it sits, so put it back onto the template
+    atom_map = list(zip(probe_match, template_match))
+    rdMolAlign.AlignMol(probe, template, atomMap=atom_map)
+    probe_conf = probe.GetConformer()
+    for p, t in atom_map:
+        probe_conf.SetAtomPosition(p, template_conf.GetAtomPosition(t))
+
+    if AllChem.MMFFHasAllMoleculeParams(probe):
+        ff = AllChem.MMFFGetMoleculeForceField(probe, AllChem.MMFFGetMoleculeProperties(probe))
+        for p in probe_match:
+            ff.AddFixedPoint(p)
+        ff.Minimize(maxIts=500)
+
+    probe.SetProp("pose_source", "template")
+    probe.SetIntProp("mcs_n_atoms", mcs.numAtoms)
+    return probe
+
+
+def _transfer_from_templates(
+    smiles: str, templates: List[Tuple[int, float, bytes]], seed: int
+) -> List[bytes]:
+    """
+    Worker: try each (train_fake_id, similarity, pose) template in turn, best first.
+    """
+    poses = []
+    for train_fake_id, similarity, template_bytes in templates:
+        pose = transfer_pose(smiles, Chem.Mol(template_bytes), seed=seed)
+        if pose is None:
+            continue
+        pose.SetIntProp("template_train_fake_id", train_fake_id)
+        pose.SetDoubleProp("template_similarity", similarity)
+        poses.append(mol_to_binary(pose))
+    return poses
+
+
+@typechecked
+def find_templates(
+    df_test: pl.DataFrame,
+    df_train: pl.DataFrame,
+    threshold: float = 0.7,
+    k: int = 3,
+) -> dict[int, List[Tuple[int, float, bytes]]]:
+    """
+    For every test row, the (up to k) most similar training ligands for the same protein with
+    Tanimoto similarity >= threshold, best first, as (train_fake_id, similarity, pose bytes).
+    Test rows with no such training ligand are left out.
+    """
+    templates = {}
+    for protein_label, df_test_protein in df_test.group_by("protein_label"):
+        protein_label = protein_label[0]
+        df_train_protein = df_train.filter(pl.col("protein_label") == protein_label)
+        if df_train_protein.is_empty():
+            continue
+        train_fps = [morgan_fp(x) for x in df_train_protein["CXSMILES"]]
+        train_ids = df_train_protein["train_fake_id"].to_list()
+        train_poses = df_train_protein["ligand_pose"].to_list()
+        for row in df_test_protein.iter_rows(named=True):
+            similarities = DataStructs.BulkTanimotoSimilarity(morgan_fp(row["CXSMILES"]), train_fps)
+            best = sorted(range(len(similarities)), key=lambda i: -similarities[i])[:k]
+            hits = [(train_ids[i], similarities[i], train_poses[i]) for i in best if similarities[i] >= threshold]
+            if hits:
+                templates[row["test_fake_id"]] = hits
+    return templates
+
+
+@typechecked
+def write_template_poses(
+    df_test: pl.DataFrame,
+    df_train: pl.DataFrame,
+    threshold: float = 0.7,
+    k: int = 3,
+    seed: int = 0,
+    processes: int | None = None,
+) -> List[int]:
+    """
+    Write template-transferred poses for every test ligand with a close enough training analog,
+    to its template_pose_path.  Returns the test_fake_ids that got poses, i.e. the ones that can skip docking.
+    df_train's ligand_pose should be RDKit binary, as from snapshot.get_df_train().
+    """
+    templates = find_templates(df_test, df_train, threshold=threshold, k=k)
+    logger.info(f"{len(templates)} of {len(df_test)} test ligands have a training analog with similarity >= {threshold}.")
+    rows = {row["test_fake_id"]: row for row in df_test.iter_rows(named=True) if row["test_fake_id"] in templates}
+    done = []
+    data_dir_template_poses().mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            test_fake_id: executor.submit(_transfer_from_templates, rows[test_fake_id]["CXSMILES"], hits, seed)
+            for test_fake_id, hits in templates.items()
+        }
+        for test_fake_id, future in futures.items():
+            poses = [mol_from_binary(x) for x in future.result()]
+            if not poses:
+                logger.info(f"Template transfer failed for test_fake_id {test_fake_id}, it'll be docked instead")
+                continue
+            protein = get_protein(rows[test_fake_id]["protein_label"])
+            write_sdfs(mols=poses, path=template_pose_path(protein, test_fake_id))
+            done.append(test_fake_id)
+    logger.info(f"Wrote template poses for {len(done)} test ligands.")
+    return done
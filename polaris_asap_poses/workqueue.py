@@ -0,0 +1,345 @@
+"""
+A durable docking work queue, so several hosts sharing the data dir can drain one run.
+
+The queue is a SQLite file with one row per test ligand.  Workers claim jobs one at a time in a
+write transaction (BEGIN IMMEDIATE), so two workers never get the same job, and hold a lease on it
+that a background thread keeps renewing while gnina runs.  A failed job goes back in the queue until
+it's used up max_attempts, and a job whose lease runs out (its worker died, or its host did) is
+re-queued by whichever worker next looks for work.
+
+SQLite over NFS needs working POSIX locks (NFSv4, or v3 with lockd), and WAL mode doesn't work there
+at all, so the queue sticks to the default rollback journal and short transactions.  Leases use wall-clock
+time, so hosts' clocks need to agree to well within lease_s.
+"""
+
+import dataclasses
+import multiprocessing
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import polars as pl
+from typeguard import typechecked
+
+from polaris_asap_poses.gnina import DEFAULT_EXHAUSTIVENESS, get_gnina_jobs, run_gnina_jobs
+from polaris_asap_poses.io import data_dir
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.metrics import timed
+from polaris_asap_poses.snapshot import get_df_test
+
+
+def queue_path() -> Path:
+    return data_dir() / "queue" / "dock.sqlite"
+
+
+DEFAULT_LEASE_S = 600.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    test_fake_id INTEGER NOT NULL,
+    protein_label TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued' CHECK (state IN ('queued', 'running', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    PRIMARY KEY (test_fake_id, protein_label)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, test_fake_id);
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass(frozen=True)
+class QueuedJob:
+    test_fake_id: int
+    protein_label: str
+    attempts: int
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        path: Path | str | None = None,
+        lease_s: float = DEFAULT_LEASE_S,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        busy_timeout_s: float = 60.0,
+    ):
+        path = queue_path() if path is None else path
+        self.path = Path(path)
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.busy_timeout_s = busy_timeout_s
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # A connection per operation: nothing is held open between jobs, and threads don't share one
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_s, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @typechecked
+    def populate(self, df_test: pl.DataFrame) -> int:
+        """
+        Queue a job per test row that isn't in the queue yet.  Returns how many were added.
+        """
+        rows = df_test.select("test_fake_id", "protein_label").rows()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO jobs (test_fake_id, protein_label) VALUES (?, ?)", rows)
+            added = conn.total_changes - before
+        logger.info(f"Queued {added} new jobs ({len(rows) - added} already in {self.path}).")
+        return added
+
+    def _expire_leases(self, conn: sqlite3.Connection, now: float):
+        expired = conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "worker = NULL, lease_expires = NULL, error = 'lease expired (worker ' || worker || ')' "
+            "WHERE state = 'running' AND lease_expires < ?",
+            (self.max_attempts, now),
+        ).rowcount
+        if expired:
+            logger.warning(f"Re-queued {expired} jobs whose workers stopped heartbeating.")
+
+    def claim(self, worker: str) -> QueuedJob | None:
+        """
+        Atomically take the next queued job, or None if there isn't one right now.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            row = conn.execute(
+                "SELECT test_fake_id, protein_label, attempts FROM jobs WHERE state = 'queued' "
+                "ORDER BY attempts, test_fake_id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, "
+                "started = ?, error = NULL WHERE test_fake_id = ? AND protein_label = ?",
+                (worker, now + self.lease_s, now, row[0], row[1]),
+            )
+        return QueuedJob(test_fake_id=row[0], protein_label=row[1], attempts=row[2] + 1)
+
+    def heartbeat(self, job: QueuedJob, worker: str) -> bool:
+        """
+        Extend the lease on a running job.  False means we don't hold it anymore.
+        """
+        with self._transaction() as conn:
+            return (
+                conn.execute(
+                    "UPDATE jobs SET lease_expires = ? WHERE test_fake_id = ? AND protein_label = ? "
+                    "AND worker = ? AND state = 'running'",
+                    (time.time() + self.lease_s, job.test_fake_id, job.protein_label, worker),
+                ).rowcount
+                == 1
+            )
+
+    def complete(self, job: QueuedJob, worker: str) -> bool:
+        """
+        Mark a job done.  False if its lease had already run out and someone else may have it.
+        """
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET state = 'done', lease_expires = NULL, finished = ? "
+                "WHERE test_fake_id = ? AND protein_label = ? AND worker = ? AND state = 'running'",
+                (time.time(), job.test_fake_id, job.protein_label, worker),
+            ).rowcount
+        return updated == 1
+
+    def release(self, job: QueuedJob, worker: str, error: str):
+        """
+        Give a failed job back, to be retried elsewhere, or fail it for good after max_attempts.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "worker = NULL, lease_expires = NULL, error = ? "
+                "WHERE test_fake_id = ? AND protein_label = ? AND worker = ? AND state = 'running'",
+                (self.max_attempts, error, job.test_fake_id, job.protein_label, worker),
+            )
+
+    def retry_failed(self) -> int:
+        """
+        Put failed jobs back in the queue with a clean slate.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET state = 'queued', attempts = 0, error = NULL WHERE state = 'failed'"
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ("queued", "running", "done", "failed")}
+
+    def jobs(self) -> pl.DataFrame:
+        with self._connect() as conn:
+            cursor = conn.execute("SELECT * FROM jobs ORDER BY test_fake_id, protein_label")
+            columns = [x[0] for x in cursor.description]
+            return pl.DataFrame(cursor.fetchall(), schema=columns, orient="row")
+
+
+class Heartbeat:
+    """
+    Renew a job's lease in the background while the worker is busy with it.
+    """
+
+    def __init__(self, queue: WorkQueue, job: QueuedJob, worker: str, interval_s: float | None = None):
+        self.queue = queue
+        self.job = job
+        self.worker = worker
+        self.interval_s = interval_s or queue.lease_s / 3
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                if not self.queue.heartbeat(self.job, self.worker):
+                    self.lost = True
+                    logger.warning(f"Lost the lease on test_fake_id {self.job.test_fake_id}.")
+                    return
+            except sqlite3.Error as e:
+                # The queue being busy for a bit isn't fatal, the lease has slack for a missed beat or two
+                logger.warning(f"Heartbeat failed: {e!r}")
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def populate_queue(path: Path | str | None = None) -> WorkQueue:
+    """
+    Queue every test ligand from the snapshot (see snapshot.get_df_test).
+    """
+    path = queue_path() if path is None else path
+    queue = WorkQueue(path)
+    queue.populate(get_df_test())
+    return queue
+
+
+def _worker_output_path(output_sdf: Path, worker: str) -> Path:
+    """
+    Where a worker docks before moving the result into place.  Hidden, so globs for docking results skip it.
+    """
+    return output_sdf.with_name(f".{output_sdf.stem}.{re.sub(r'[^\w.-]', '_', worker)}.sdf")
+
+
+def run_worker(
+    path: Path | str | None = None,
+    backend: str = "prebuilt",
+    cpus: int | None = None,
+    seed: int = 0,
+    exhaustiveness: int = DEFAULT_EXHAUSTIVENESS,
+    lease_s: float = DEFAULT_LEASE_S,
+    poll_s: float = 10.0,
+    worker: str | None = None,
+) -> int:
+    """
+    Claim and dock jobs until the queue is drained.  Returns how many this worker finished.
+    While other workers still hold jobs, keep polling, in case their leases run out.
+    No docking cache here: its manifest isn't safe to write from several hosts, and the queue
+    already knows what's done.
+    """
+    path = queue_path() if path is None else path
+    worker = worker or default_worker_id()
+    queue = WorkQueue(path, lease_s=lease_s)
+    gnina_jobs = {
+        (job.test_fake_id, job.protein.data_label): job
+        for job in get_gnina_jobs(get_df_test(), seed=seed, exhaustiveness=exhaustiveness, cpus_per_job=cpus)
+    }
+    logger.info(f"Worker {worker} starting on {queue.path}.")
+    n_done = 0
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            counts = queue.counts()
+            if counts["running"] == 0:
+                break
+            logger.info(f"Nothing to claim, {counts['running']} jobs running elsewhere. Waiting {poll_s}s...")
+            time.sleep(poll_s)
+            continue
+
+        logger.info(f"Worker {worker} claimed test_fake_id {claimed.test_fake_id} (attempt {claimed.attempts}).")
+        # Dock into a file of our own, so if our lease runs out and someone else takes the job over,
+        # we don't both write to the same output
+        worker_output_sdf = None
+        try:
+            job = gnina_jobs[(claimed.test_fake_id, claimed.protein_label)]
+            worker_output_sdf = _worker_output_path(job.output_sdf, worker)
+            with (
+                Heartbeat(queue, claimed, worker) as heartbeat,
+                timed("queue_job", test_fake_id=job.test_fake_id, worker=worker),
+            ):
+                run_gnina_jobs([dataclasses.replace(job, output_sdf=worker_output_sdf)], n_workers=1, backend=backend)
+        except Exception as e:
+            logger.error(f"test_fake_id {claimed.test_fake_id} failed: {e!r}")
+            if worker_output_sdf is not None:
+                worker_output_sdf.unlink(missing_ok=True)
+            queue.release(claimed, worker, error=repr(e))
+            continue
+        if heartbeat.lost:
+            logger.warning(f"Discarding test_fake_id {job.test_fake_id}, whose lease ran out while docking it.")
+            worker_output_sdf.unlink(missing_ok=True)
+            continue
+        os.replace(worker_output_sdf, job.output_sdf)
+        if queue.complete(claimed, worker):
+            n_done += 1
+        else:
+            logger.warning(f"Finished test_fake_id {job.test_fake_id} after losing its lease, it may be docked twice.")
+    logger.info(f"Worker {worker} done, finished {n_done} jobs. Queue: {queue.counts()}")
+    return n_done
+
+
+def run_workers(n_workers: int, path: Path | str | None = None, **kwargs) -> List[int]:
+    """
+    Start n_workers local worker processes on the same queue and wait for them.
+    Returns their exit codes.
+    """
+    path = queue_path() if path is None else path
+    # Spawn rather than fork, since forking with polars' thread pool running can deadlock the children
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, kwargs={"path": path, **kwargs}, name=f"worker-{i}")
+        for i in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
@@ -0,0 +1,221 @@
+"""
+Random access into the raw data package zip, without extracting it.
+
+ZipIndex reads the zip's central directory once, classifies every member by target (SARS/MERS)
+and type (PDB, SDF, FASTA), and saves that next to the zip.  Single members are then read straight
+out of a memory-mapped archive: seek to the member's local header, inflate just that member.
+"""
+
+import json
+import mmap
+import re
+import struct
+import zipfile
+import zlib
+from dataclasses import asdict, dataclass
+from io import StringIO
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from rdkit import Chem
+from typeguard import typechecked
+
+from polaris_asap_poses.cache import sha256_file
+from polaris_asap_poses.fetch import data_dir_downloads
+from polaris_asap_poses.logger import logger
+from polaris_asap_poses.model import MERS, SARS
+
+
+def raw_data_package_zip() -> Path:
+    return data_dir_downloads() / "raw_data_package.zip"
+
+
+MEMBER_KINDS = {
+    ".pdb": "pdb",
+    ".ent": "pdb",
+    ".sdf": "sdf",
+    ".mol": "sdf",
+    ".fasta": "fasta",
+    ".fa": "fasta",
+    ".fas": "fasta",
+}
+
+# Local file header: signature, version, flags, method, time, date, crc, sizes, name length, extra length
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def classify_target(name: str) -> str | None:
+    """
+    Which protein a member belongs to, judging by its path, as a protein_label.
+    """
+    if re.search(r"MERS", name, re.IGNORECASE):
+        return MERS.data_label
+    if re.search(r"SARS", name, re.IGNORECASE):
+        return SARS.data_label
+    return None
+
+
+@dataclass
+class ZipMember:
+    name: str
+    kind: str
+    target: str | None
+    header_offset: int
+    compress_type: int
+    compress_size: int
+    file_size: int
+
+
+class ZipIndex:
+    def __init__(self, zip_path: Path | str, members: Dict[str, ZipMember]):
+        self.zip_path = Path(zip_path)
+        self.members = members
+        self._fd = None
+        self._mmap: mmap.mmap | None = None
+
+    @staticmethod
+    def index_path_for(zip_path: Path) -> Path:
+        return zip_path.with_name(zip_path.name + ".index.json")
+
+    @classmethod
+    def build(cls, zip_path: Path | str) -> "ZipIndex":
+        """
+        Index a zip from its central directory, which doesn't touch any member data.
+        """
+        zip_path = Path(zip_path)
+        members = {}
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                members[info.filename] = ZipMember(
+                    name=info.filename,
+                    kind=MEMBER_KINDS.get(Path(info.filename).suffix.lower(), "other"),
+                    target=classify_target(info.filename),
+                    header_offset=info.header_offset,
+                    compress_type=info.compress_type,
+                    compress_size=info.compress_size,
+                    file_size=info.file_size,
+                )
+        logger.info(f"Indexed {len(members)} members of {zip_path}")
+        return cls(zip_path, members)
+
+    def save(self, checksum: str):
+        with open(self.index_path_for(self.zip_path), "w") as fd:
+            json.dump({"sha256": checksum, "members": [asdict(x) for x in self.members.values()]}, fd)
+
+    @classmethod
+    def open(cls, zip_path: Path | str | None = None) -> "ZipIndex":
+        """
+        Load the saved index for zip_path, or build and save one if it's missing or stale.
+        """
+        zip_path = raw_data_package_zip() if zip_path is None else zip_path
+        zip_path = Path(zip_path)
+        checksum_path = zip_path.with_name(zip_path.name + ".sha256")
+        checksum = checksum_path.read_text().strip() if checksum_path.exists() else sha256_file(zip_path)
+        index_path = cls.index_path_for(zip_path)
+        if index_path.exists():
+            with open(index_path) as fd:
+                saved = json.load(fd)
+            if saved["sha256"] == checksum:
+                return cls(zip_path, {x["name"]: ZipMember(**x) for x in saved["members"]})
+        index = cls.build(zip_path)
+        index.save(checksum)
+        return index
+
+    @typechecked
+    def filter(self, kind: str | None = None, target: str | None = None) -> List[ZipMember]:
+        """
+        Members of one kind ("pdb", "sdf", "fasta", "other") and/or for one protein_label.
+        """
+        return [
+            x
+            for x in self.members.values()
+            if (kind is None or x.kind == kind) and (target is None or x.target == target)
+        ]
+
+    def _view(self) -> mmap.mmap:
+        if self._mmap is None:
+            self._fd = open(self.zip_path, "rb")
+            self._mmap = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read_bytes(self, name: str) -> bytes:
+        """
+        Read one member straight out of the memory-mapped zip.
+        """
+        member = self.members[name]
+        view = self._view()
+        header = _LOCAL_HEADER.unpack_from(view, member.header_offset)
+        if header[0] != _LOCAL_HEADER_SIGNATURE:
+            raise ValueError(f"Bad local header for {name} in {self.zip_path}")
+        name_length, extra_length = header[-2], header[-1]
+        start = member.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+        data = view[start : start + member.compress_size]
+        if member.compress_type == zipfile.ZIP_STORED:
+            return data
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS, member.file_size or zlib.DEF_BUF_SIZE)
+        # Anything more exotic, let zipfile deal with it
+        with zipfile.ZipFile(view) as zip_ref:
+            return zip_ref.read(name)
+
+    def read_text(self, name: str) -> str:
+        return self.read_bytes(name).decode()
+
+    def read_mols(self, name: str, remove_hs: bool = False) -> List[Chem.Mol]:
+        """
+        RDKit mols from an SDF or PDB member.
+        """
+        kind = self.members[name].kind
+        if kind == "sdf":
+            supplier = Chem.SDMolSupplier()
+            supplier.SetData(self.read_text(name), removeHs=remove_hs)
+            return [x for x in supplier if x is not None]
+        if kind == "pdb":
+            mol = Chem.MolFromPDBBlock(self.read_text(name), removeHs=remove_hs)
+            return [] if mol is None else [mol]
+        raise ValueError(f"Can't make mols from {kind} member {name}")
+
+    def read_coords(self, name: str) -> np.ndarray:
+        """
+        (n_atoms, 3) coordinates from a PDB member's ATOM/HETATM records, or an SDF member's first mol.
+        Parsed directly for PDBs, since that's much faster than building a whole protein Mol.
+        """
+        kind = self.members[name].kind
+        if kind == "pdb":
+            lines = [x for x in StringIO(self.read_text(name)) if x.startswith(("ATOM", "HETATM"))]
+            return np.array(
+                [(float(x[30:38]), float(x[38:46]), float(x[46:54])) for x in lines], dtype=np.float64
+            ).reshape(-1, 3)
+        mols = self.read_mols(name)
+        if not mols:
+            raise ValueError(f"No mols in {name}")
+        return mols[0].GetConformer().GetPositions()
+
+    def read_fasta(self, name: str) -> Dict[str, str]:
+        sequences: Dict[str, str] = {}
+        header = None
+        for line in StringIO(self.read_text(name)):
+            line = line.strip()
+            if line.startswith(">"):
+                header = line[1:]
+                sequences[header] = ""
+            elif header is not None:
+                sequences[header] += line
+        return sequences
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._fd.close()
+            self._mmap = None
+            self._fd = None
+
+    def __enter__(self) -> "ZipIndex":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,51 @@
+"""
+Tests run in a throwaway POLARIS_ASAP_POSES_HOME with synthetic data and benchmarks/fake_gnina.py
+standing in for gnina, like the benchmarks, so they need no GPU, network or competition data.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = REPO_DIR / "benchmarks"
+
+# Set before anything reads settings or the data dir: both are cached on first use
+TEST_HOME = Path(tempfile.mkdtemp(prefix="polaris-asap-poses-test-"))
+os.environ["POLARIS_ASAP_POSES_HOME"] = str(TEST_HOME)
+os.environ["POLARIS_ASAP_POSES_OFFLINE"] = "1"
+os.environ["DYNACONF_GNINA_BIN"] = "./bin/fake-gnina"
+os.environ["DYNACONF_LOG_LEVEL"] = "WARNING"
+os.environ.setdefault("FAKE_GNINA_DELAY", "0")
+shutil.copy(REPO_DIR / "settings.toml", TEST_HOME / "settings.toml")
+sys.path.insert(0, str(BENCH_DIR))
+
+
+def pytest_sessionstart(session):
+    # settings.toml and ./bin/fake-gnina are found relative to the working directory
+    os.chdir(TEST_HOME)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    os.chdir(REPO_DIR)
+    shutil.rmtree(TEST_HOME, ignore_errors=True)
+
+
+@pytest.fixture
+def competition():
+    """
+    A fresh data dir with an 8-ligand synthetic competition and ./bin/fake-gnina.  Returns the test set.
+    """
+    from fake_competition import write_fake_competition
+
+    from polaris_asap_poses.io import asap_test_raw, data_dir, ensure_data_dirs
+
+    shutil.rmtree(data_dir(), ignore_errors=True)
+    ensure_data_dirs.cache_clear()
+    ensure_data_dirs()
+    write_fake_competition(8)
+    return asap_test_raw.read()
@@ -0,0 +1,26 @@
+import polars as pl
+import pytest
+
+from polaris_asap_poses import gnina
+from polaris_asap_poses.adaptive import (DEFAULT_FIDELITIES,
+                                         adaptive_fidelity, run_adaptive)
+
+
+def test_failed_runs_are_recorded_and_the_rest_carry_on(competition, monkeypatch):
+    jobs = gnina.get_gnina_jobs(competition)
+    monkeypatch.setenv("FAKE_GNINA_FAIL", "test_3")
+    with pytest.raises(RuntimeError, match=r"No poses for 1 ligands whose gnina runs failed, test_fake_ids: \[3\]"):
+        run_adaptive(jobs)
+
+    # Saved before raising, with a row for every ligand
+    df = adaptive_fidelity.read()
+    assert sorted(df["test_fake_id"].to_list()) == sorted(competition["test_fake_id"].to_list())
+    failed = df.filter(pl.col("test_fake_id") == 3).row(0, named=True)
+    assert failed["failed_runs"] == DEFAULT_FIDELITIES[0].n_seeds
+    assert failed["level"] == 0
+    assert failed["n_poses"] == 0
+    assert not failed["converged"]
+    assert (df.filter(pl.col("test_fake_id") != 3)["failed_runs"] == 0).all()
+    assert (df.filter(pl.col("test_fake_id") != 3)["n_poses"] > 0).all()
+    for job in jobs:
+        assert job.output_sdf.exists() == (job.test_fake_id != 3)
@@ -0,0 +1,42 @@
+import json
+
+from polaris_asap_poses import gnina
+from polaris_asap_poses.cache import DockingCache
+
+
+def test_record_batches_manifest_writes(tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    cache = DockingCache(manifest_path, flush_every=3, flush_interval_s=3600)
+    outputs = [tmp_path / f"{i}.sdf" for i in range(4)]
+    for i, path in enumerate(outputs):
+        path.write_text(f"pose {i}\n")
+
+    cache.record(outputs[0], "key0")
+    cache.record(outputs[1], "key1")
+    assert not manifest_path.exists()
+    cache.record(outputs[2], "key2")
+    assert len(json.loads(manifest_path.read_text())) == 3
+    cache.record(outputs[3], "key3")
+    assert len(json.loads(manifest_path.read_text())) == 3
+    cache.flush()
+    assert len(json.loads(manifest_path.read_text())) == 4
+
+    reloaded = DockingCache(manifest_path)
+    assert reloaded.is_valid(outputs[3], "key3")
+    assert not reloaded.is_valid(outputs[3], "key0")
+    outputs[3].write_text("changed\n")
+    assert not reloaded.is_valid(outputs[3], "key3")
+
+
+def test_random_seed_results_are_not_reused(competition, tmp_path):
+    cache = DockingCache(tmp_path / "manifest.json")
+    fixed = gnina.get_gnina_jobs(competition, seed=0)
+    gnina.run_gnina_jobs(fixed, cache=cache)
+    todo, keys = gnina._filter_cached(fixed, "prebuilt", cache, None)
+    assert todo == [] and len(keys) == len(fixed)
+
+    random = gnina.get_gnina_jobs(competition, seed=-1)
+    todo, keys = gnina._filter_cached(random, "prebuilt", cache, None)
+    assert todo == random and keys == {}
+    gnina.run_gnina_jobs(random, cache=cache)
+    assert len(json.loads((tmp_path / "manifest.json").read_text())) == len(fixed)
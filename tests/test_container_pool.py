@@ -0,0 +1,65 @@
+import pytest
+
+from polaris_asap_poses.container_pool import ContainerPool, SubprocessBackend
+
+
+class FlakyBackend(SubprocessBackend):
+    """
+    Fails to start containers while fail_starts is set.
+    """
+
+    fail_starts = False
+
+    def start(self):
+        if self.fail_starts:
+            raise RuntimeError("Can't start a container")
+        return super().start()
+
+
+def test_unhealthy_container_is_replaced(tmp_path):
+    backend = SubprocessBackend(root=tmp_path)
+    with ContainerPool(1, backend) as pool:
+        with pool.acquire() as handle:
+            first = handle
+        backend.stop(first)
+        with pool.acquire() as handle:
+            assert handle is not first and handle.alive
+
+
+def test_failed_job_recycles_its_container(tmp_path):
+    backend = SubprocessBackend(root=tmp_path)
+    with ContainerPool(1, backend) as pool:
+        with pool.acquire() as handle:
+            first = handle
+        with pytest.raises(Exception):
+            pool.exec(["false"])
+        assert not first.alive
+        with pool.acquire() as handle:
+            assert handle is not first and handle.alive
+        assert pool.exec(["echo", "hi"]) == "hi\n"
+
+
+def test_container_is_recycled_after_max_jobs(tmp_path):
+    backend = SubprocessBackend(root=tmp_path)
+    with ContainerPool(1, backend, max_jobs_per_container=2) as pool:
+        handles = []
+        for _ in range(5):
+            with pool.acquire() as handle:
+                handles.append(handle)
+        assert [x.id for x in handles] == [0, 0, 1, 1, 2]
+        assert not handles[0].alive and not handles[2].alive
+
+
+def test_stopped_container_isnt_reused_when_recycling_fails(tmp_path):
+    backend = FlakyBackend(root=tmp_path)
+    with ContainerPool(1, backend) as pool:
+        with pool.acquire() as handle:
+            first = handle
+        backend.stop(first)
+        backend.fail_starts = True
+        with pytest.raises(RuntimeError, match="Can't start"):
+            with pool.acquire():
+                pass
+        backend.fail_starts = False
+        with pool.acquire() as handle:
+            assert handle is not first and handle.alive
@@ -0,0 +1,46 @@
+from rdkit import Chem
+
+from polaris_asap_poses import dataprep
+from polaris_asap_poses.dataprep import (canonical_smiles, prepare_ligand,
+                                         prepare_ligands)
+
+
+def test_duplicates_are_prepared_once_and_then_cached(monkeypatch):
+    # The same two ligands, written differently
+    smiles = ["CCO", "OCC", "C(O)C", "c1ccccc1O", "Oc1ccccc1"]
+    for path in dataprep.data_dir_ligprep_cache().glob("*.bin"):
+        path.unlink()
+
+    prepared = prepare_ligands(smiles, n_confs=2, processes=1)
+    assert sorted(prepared) == sorted({canonical_smiles("CCO"), canonical_smiles("Oc1ccccc1")})
+    assert len(list(dataprep.data_dir_ligprep_cache().glob("*.bin"))) == 2
+
+    # Workers are forked, so they see this too: any ligand not served from the cache fails
+    def not_cached(*args, **kwargs):
+        raise AssertionError("prepared a cached ligand again")
+
+    monkeypatch.setattr(dataprep, "prepare_ligand", not_cached)
+    cached = prepare_ligands(smiles, n_confs=2, processes=1)
+    assert {k: Chem.MolToMolBlock(v) for k, v in cached.items()} == {
+        k: Chem.MolToMolBlock(v) for k, v in prepared.items()
+    }
+
+
+def test_falls_back_to_uff_without_mmff_parameters(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(dataprep.logger, "warning", warnings.append)
+
+    # MMFF94 has no boron
+    mol = prepare_ligand("OB(O)c1ccccc1", n_confs=3)
+    assert warnings == ["No MMFF parameters for OB(O)c1ccccc1, using UFF"]
+    assert mol.GetNumConformers() == 1
+    assert mol.GetDoubleProp("prep_energy") != 0.0
+
+    prepare_ligand("CCO", n_confs=3)
+    assert len(warnings) == 1
+
+
+def test_cache_key_includes_the_rdkit_version(monkeypatch):
+    before = dataprep._ligprep_cache_path("CCO", 2, 0, True)
+    monkeypatch.setattr(dataprep.rdkit, "__version__", "2019.03.1")
+    assert dataprep._ligprep_cache_path("CCO", 2, 0, True) != before
@@ -0,0 +1,31 @@
+import json
+
+import polars as pl
+import pytest
+
+from polaris_asap_poses.adaptive import adaptive_fidelity
+from polaris_asap_poses.evaluate import (evaluate_mode, evaluation_report,
+                                         evaluation_summary_path,
+                                         mode_evaluation)
+from polaris_asap_poses.gnina import data_dir_gnina_out_candidates
+
+
+@pytest.mark.parametrize("mode", ["adaptive", "two_stage"])
+def test_evaluation_compares_default_and_mode_against_the_reference(competition, mode):
+    summary = evaluate_mode(mode, n_ligands=4, seed=0)
+
+    assert summary["n_ligands"] == 4
+    assert json.loads(evaluation_summary_path(mode).read_text()) == summary
+    for arm in ["reference", "default", mode]:
+        assert summary["arms"][arm]["cpu_s"] > 0
+    df = mode_evaluation(mode).read()
+    assert df.group_by("arm").len().sort("arm").rows() == sorted([(mode, 4), ("default", 4)])
+    assert df["rmsd_to_reference"].null_count() == 0
+    assert set(df["test_fake_id"]) <= set(competition["test_fake_id"])
+    for arm in ["default", mode]:
+        kept = df.filter((pl.col("arm") == arm) & (pl.col("rmsd_to_reference") <= 2.0)).height
+        assert summary["arms"][arm]["n_top_pose_kept"] == kept
+    # Evaluating doesn't touch the pipeline's own results
+    assert not adaptive_fidelity.path.exists()
+    assert not list(data_dir_gnina_out_candidates().glob("rescore_*"))
+    assert f"{mode} saved" in evaluation_report(summary)
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from polaris_asap_poses.fetch import Artifact, extract_zip, fetch_artifact
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD, honoring Range requests unless ranges=False.  The first `truncate` responses
+    announce the full length but hang up halfway through the body, like a dropped connection.
+    """
+
+    ranges = True
+    truncate = 0
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("Range"))
+        start = 0
+        if self.ranges and self.headers.get("Range"):
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(PAYLOAD)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if type(self).truncate > 0:
+            type(self).truncate -= 1
+            body = body[: len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    handler = type("TestHandler", (Handler,), {"requests": []})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _artifact(server, tmp_path, sha256=None):
+    url = f"http://127.0.0.1:{server.server_address[1]}/artifact.zip"
+    return Artifact(name="artifact", url=url, extract_dir=tmp_path / "extracted", sha256=sha256)
+
+
+def test_truncated_download_is_resumed(server, tmp_path):
+    server.RequestHandlerClass.truncate = 2
+    dest = fetch_artifact(_artifact(server, tmp_path), download_dir=tmp_path, retries=3)
+    assert dest.read_bytes() == PAYLOAD
+    requests = server.RequestHandlerClass.requests
+    assert requests[0] is None
+    assert requests[1] == f"bytes={len(PAYLOAD) // 2}-"
+    assert len(requests) == 3
+    assert (tmp_path / "artifact.zip.sha256").read_text() == hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def test_download_starts_over_when_ranges_are_ignored(server, tmp_path):
+    server.RequestHandlerClass.ranges = False
+    server.RequestHandlerClass.truncate = 1
+    dest = fetch_artifact(_artifact(server, tmp_path), download_dir=tmp_path, retries=2)
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_truncated_download_is_never_accepted(server, tmp_path):
+    server.RequestHandlerClass.ranges = False
+    server.RequestHandlerClass.truncate = 3
+    with pytest.raises(ConnectionError, match="bytes"):
+        fetch_artifact(_artifact(server, tmp_path), download_dir=tmp_path, retries=3)
+    assert not (tmp_path / "artifact.zip").exists()
+    assert not (tmp_path / "artifact.zip.sha256").exists()
+
+
+def test_pinned_checksum(server, tmp_path):
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        fetch_artifact(_artifact(server, tmp_path, sha256="0" * 64), download_dir=tmp_path)
+    assert not (tmp_path / "artifact.zip").exists()
+
+    artifact = _artifact(server, tmp_path, sha256=hashlib.sha256(PAYLOAD).hexdigest())
+    fetch_artifact(artifact, download_dir=tmp_path)
+    n_requests = len(server.RequestHandlerClass.requests)
+    fetch_artifact(artifact, download_dir=tmp_path)
+    assert len(server.RequestHandlerClass.requests) == n_requests
+
+
+def test_unverifiable_download_is_fetched_again(server, tmp_path):
+    (tmp_path / "artifact.zip").write_bytes(PAYLOAD[:100])
+    dest = fetch_artifact(_artifact(server, tmp_path), download_dir=tmp_path)
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_extract_zip_in_parallel(tmp_path):
+    zip_path = tmp_path / "artifact.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        for i in range(40):
+            zip_ref.writestr(f"top/sub_{i % 3}/deeper/file_{i}.txt", f"file {i}")
+    extract_zip(zip_path, tmp_path / "extracted", processes=4)
+    for i in range(40):
+        assert (tmp_path / "extracted" / f"top/sub_{i % 3}/deeper/file_{i}.txt").read_text() == f"file {i}"
@@ -0,0 +1,52 @@
+import numpy as np
+import polars as pl
+
+from fake_competition import SMILES
+from polaris_asap_poses.fpindex import FingerprintIndex, search_fps
+
+
+def test_reopening_after_a_crash_between_appends(tmp_path):
+    index = FingerprintIndex(tmp_path)
+    index.add("train", [0, 1, 2], SMILES[:3])
+    # Crash after writing fingerprints but before their keys, the second half-way through a line
+    with open(index.fps_path, "ab") as fd:
+        fd.write(index.fingerprint(SMILES[3:5]).tobytes())
+    with open(index.keys_path, "a") as fd:
+        fd.write("train\t3\tCC")
+
+    index = FingerprintIndex(tmp_path)
+    assert len(index) == 3
+    index.add("test", [0, 1], SMILES[5:7])
+
+    index = FingerprintIndex(tmp_path)
+    assert index.keys == [("train", 0), ("train", 1), ("train", 2), ("test", 0), ("test", 1)]
+    np.testing.assert_array_equal(index.get(index.keys), index.fingerprint(SMILES[:3] + SMILES[5:7]))
+
+
+def test_changed_smiles_are_fingerprinted_again(tmp_path):
+    index = FingerprintIndex(tmp_path)
+    index.add("train", [0, 1, 2], SMILES[:3])
+    # A new snapshot puts another ligand under train_fake_id 1
+    assert index.add("train", [0, 1, 2], [SMILES[0], SMILES[5], SMILES[2]]) == 1
+    assert index.add("train", [0, 1, 2], [SMILES[0], SMILES[5], SMILES[2]]) == 0
+
+    for index in [index, FingerprintIndex(tmp_path)]:
+        assert len(index) == 3
+        np.testing.assert_array_equal(index.get([("train", 1)]), index.fingerprint([SMILES[5]]))
+        # The old fingerprint is never a neighbor
+        df = index.query([SMILES[1]], k=3)
+        assert sorted(df["fake_id"].to_list()) == [0, 1, 2]
+        assert df.filter(pl.col("fake_id") == 1)["similarity"][0] < 1.0
+        assert index.nearest(query_split="train", target_split="train", k=1)["query"].to_list() == [0, 2, 1]
+
+
+def test_search_matches_brute_force():
+    rng = np.random.default_rng(0)
+    fps = rng.integers(0, 2**63, (500, 4), dtype=np.uint64) & rng.integers(0, 2**63, (500, 4), dtype=np.uint64)
+    queries = fps[rng.choice(len(fps), 20)] ^ (rng.integers(0, 2**63, (20, 4), dtype=np.uint64) >> np.uint64(60))
+
+    similarities, rows = search_fps(queries, fps, k=3, block_size=64, query_block_size=8, n_threads=2)
+    counts = lambda x: np.bitwise_count(x).sum(axis=-1)
+    expected = counts(queries[:, None] & fps[None]) / counts(queries[:, None] | fps[None])
+    np.testing.assert_allclose(similarities, -np.sort(-expected, axis=1)[:, :3])
+    np.testing.assert_allclose(np.take_along_axis(expected, rows, axis=1), similarities)
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from polaris_asap_poses import gnina
+from polaris_asap_poses.cache import DockingCache
+from polaris_asap_poses.io import home_dir, iter_sdf
+
+
+def test_batch_with_a_missing_ligand_keeps_the_others(competition, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_GNINA_SKIP", "test_2")
+    cache = DockingCache(tmp_path / "manifest.json")
+    jobs = gnina.get_gnina_jobs(competition, seed=0)
+    batch = next(b for b in gnina.make_gnina_batches(jobs, chunk_size=8) if 2 in [job.test_fake_id for job in b.jobs])
+    assert len(batch.jobs) > 1
+    with pytest.raises(RuntimeError, match=r"no poses for test_fake_ids \[2\]"):
+        gnina.run_gnina_batches(jobs, chunk_size=8, cache=cache)
+
+    # The rest of test_2's batch still gets written and cached
+    recorded = json.loads((tmp_path / "manifest.json").read_text())
+    assert len(recorded) == len(jobs) - 1
+    for job in jobs:
+        assert job.output_sdf.exists() == (job.test_fake_id != 2)
+        if job.test_fake_id != 2:
+            assert [mol.GetProp("_Name") for mol in iter_sdf(job.output_sdf)] == [f"test_{job.test_fake_id}"] * 9
+
+    monkeypatch.delenv("FAKE_GNINA_SKIP")
+    todo, _ = gnina._filter_cached(jobs, "prebuilt", cache, None)
+    assert [job.test_fake_id for job in todo] == [2]
+
+
+def test_rescore_retries_failed_ligands_on_their_own(competition, tmp_path, monkeypatch):
+    cache = DockingCache(tmp_path / "manifest.json")
+    jobs = gnina.get_gnina_jobs(competition, seed=0)
+    candidates = {job.test_fake_id: gnina.candidate_job(job) for job in jobs}
+    gnina.data_dir_gnina_out_candidates().mkdir(parents=True, exist_ok=True)
+    gnina.run_gnina_jobs(list(candidates.values()))
+    # test_2's search found nothing, and gnina crashes on test_3's poses, failing its receptor's whole batch
+    candidates[2].output_sdf.write_text("")
+    monkeypatch.setenv("FAKE_GNINA_FAIL", "test_3")
+    with pytest.raises(RuntimeError, match=r"\[2\] have no candidate poses, and test_fake_ids \[3\] failed twice"):
+        gnina.rescore(jobs, candidates, top_n=3, cache=cache)
+
+    for job in jobs:
+        assert job.output_sdf.exists() == (job.test_fake_id not in (2, 3))
+    recorded = json.loads((tmp_path / "manifest.json").read_text())
+    assert len(recorded) == len(jobs) - 2
+
+
+def test_run_twice_with_defaults_docks_once(competition, monkeypatch):
+    gnina.run()
+    jobs = gnina.get_gnina_jobs(competition)
+    assert all(job.output_sdf.exists() for job in jobs)
+
+    # Any docking on the second run would fail, so it has to come entirely from the cache
+    monkeypatch.setenv("FAKE_GNINA_FAIL", "test_")
+    gnina.run()
+
+
+def test_parallel_run_gives_each_job_its_cpus_and_log_file(competition, tmp_path, monkeypatch):
+    argv_log = tmp_path / "argv.jsonl"
+    monkeypatch.setenv("FAKE_GNINA_ARGV_LOG", str(argv_log))
+    monkeypatch.setattr(gnina.os, "cpu_count", lambda: 8)
+    gnina.run(jobs=3, use_cache=False)
+
+    jobs = gnina.get_gnina_jobs(competition)
+    runs = [json.loads(line) for line in argv_log.read_text().splitlines()]
+    assert len(runs) == len(jobs)
+    # 8 cores split evenly over 3 jobs, so 3 gnina processes at once never ask for more than 8
+    cpus = [int(argv[argv.index("--cpu") + 1]) for argv in runs]
+    assert set(cpus) == {2}
+    assert 3 * max(cpus) <= 8
+    logs = [argv[argv.index("--log") + 1] for argv in runs]
+    assert sorted(logs) == sorted(str(job.log_file.relative_to(home_dir())) for job in jobs)
+    assert all(job.log_file.exists() for job in jobs)
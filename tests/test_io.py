@@ -0,0 +1,175 @@
+import gzip
+
+import polars as pl
+import pytest
+from rdkit import Chem
+
+from fake_competition import embedded_mols
+from polaris_asap_poses import io
+from polaris_asap_poses.io import (HIVE_NULL, SDF_ON_ERROR, NamedDataset,
+                                   iter_sdf, mol_from_binary, mol_to_binary,
+                                   write_sdfs)
+
+# Pentavalent carbon: parses, but won't sanitize
+BAD_RECORD = Chem.MolToMolBlock(Chem.MolFromSmiles("C(C)(C)(C)(C)C", sanitize=False)) + "$$$$\n"
+
+# A null key, and keys that have to be quoted to make a directory name
+PARTITION_KEYS = ["MERS-CoV Mpro", None, "SARS/2 50%", "a=b"]
+
+
+def _partitioned_frame() -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "test_fake_id": list(range(12)),
+            "protein_label": [PARTITION_KEYS[i % len(PARTITION_KEYS)] for i in range(12)],
+            "score": [i / 2 for i in range(12)],
+        }
+    )
+
+
+def _names(mols):
+    return [mol.GetProp("_Name") for mol in mols]
+
+
+def _write_bad_sdf(path, mols, bad):
+    """
+    mols as an SDF with one bad record: BAD_RECORD in the middle, or the last record cut off halfway.
+    """
+    write_sdfs(mols, path)
+    records = [x + "$$$$\n" for x in path.read_text().split("$$$$\n")[:-1]]
+    if bad == "middle":
+        records.insert(len(records) // 2, BAD_RECORD)
+    else:
+        records[-1] = records[-1][: len(records[-1]) // 2]
+    path.write_text("".join(records))
+
+
+def test_mol_from_binary_returns_independent_copies():
+    mol_bytes = mol_to_binary(embedded_mols(1)[0])
+    first = mol_from_binary(mol_bytes)
+    first.SetProp("_Name", "changed")
+    first.GetConformer().SetAtomPosition(0, (100.0, 0.0, 0.0))
+
+    second = mol_from_binary(mol_bytes)
+    assert second is not first
+    assert second.GetProp("_Name") == "test_0"
+    assert second.GetConformer().GetAtomPosition(0).x != 100.0
+    assert Chem.MolToSmiles(second) == Chem.MolToSmiles(Chem.Mol(mol_bytes))
+
+
+def test_iter_sdf_reads_gzipped(tmp_path):
+    mols = embedded_mols(5)
+    write_sdfs(mols, tmp_path / "poses.sdf")
+    with gzip.open(tmp_path / "poses.sdf.gz", "wb") as f:
+        f.write((tmp_path / "poses.sdf").read_bytes())
+
+    read = list(iter_sdf(tmp_path / "poses.sdf.gz", num_threads=4))
+    assert _names(read) == _names(mols)
+    assert [Chem.MolToSmiles(x) for x in read] == [Chem.MolToSmiles(x) for x in mols]
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+@pytest.mark.parametrize("where", [None, lambda props: True])
+@pytest.mark.parametrize("bad", ["middle", "last"])
+@pytest.mark.parametrize("on_error", SDF_ON_ERROR)
+def test_iter_sdf_bad_records(tmp_path, monkeypatch, on_error, bad, where, num_threads):
+    mols = embedded_mols(6)
+    path = tmp_path / "poses.sdf"
+    _write_bad_sdf(path, mols, bad)
+    warnings = []
+    monkeypatch.setattr(io.logger, "warning", warnings.append)
+    good = _names(mols) if bad == "middle" else _names(mols[:-1])
+    bad_record = 4 if bad == "middle" else 6
+
+    read = iter_sdf(path, where=where, on_error=on_error, num_threads=num_threads)
+    if on_error == "raise":
+        with pytest.raises(ValueError, match=f"Bad record {bad_record} in"):
+            list(read)
+        return
+    assert _names(read) == good
+    if on_error == "warn":
+        assert len(warnings) == 1 and warnings[0].startswith(f"Skipping record {bad_record} in")
+    else:
+        assert warnings == []
+
+
+def test_iter_sdf_where_filters_on_props(tmp_path):
+    mols = embedded_mols(10)
+    write_sdfs(mols, tmp_path / "poses.sdf")
+
+    read = list(iter_sdf(tmp_path / "poses.sdf", where=lambda props: props["test_fake_id"] % 3 == 0))
+    assert _names(read) == ["test_0", "test_3", "test_6", "test_9"]
+    assert all(x.GetNumAtoms() == y.GetNumAtoms() for x, y in zip(read, mols[::3]))
+    read = list(iter_sdf(tmp_path / "poses.sdf", where=lambda props: props["_Name"] == "test_4", remove_hs=True))
+    assert _names(read) == ["test_4"]
+    assert read[0].GetNumAtoms() == Chem.RemoveHs(mols[4]).GetNumAtoms()
+
+
+def test_iter_sdf_threaded_matches_serial(tmp_path):
+    mols = embedded_mols(2_000)
+    write_sdfs(mols, tmp_path / "poses.sdf")
+
+    serial = list(iter_sdf(tmp_path / "poses.sdf"))
+    threaded = list(iter_sdf(tmp_path / "poses.sdf", num_threads=4))
+    assert _names(threaded) == _names(serial) == _names(mols)
+    assert [Chem.MolToMolBlock(x) for x in threaded] == [Chem.MolToMolBlock(x) for x in serial]
+
+
+@pytest.mark.parametrize("suffix", ["parquet", "arrow"])
+def test_partitioned_dataset_round_trip(tmp_path, suffix):
+    dataset = NamedDataset(name="poses", filepath=tmp_path / f"poses.{suffix}", partition_by=["protein_label"])
+    df = _partitioned_frame()
+    dataset.save(df)
+
+    parts = sorted(x.name for x in dataset.path.iterdir())
+    assert parts == sorted(f"protein_label={x}" for x in ["MERS-CoV%20Mpro", HIVE_NULL, "SARS%2F2%2050%25", "a%3Db"])
+    assert dataset.read().sort("test_fake_id").equals(df)
+    nulls = dataset.scan().filter(pl.col("protein_label").is_null()).collect()
+    assert nulls["test_fake_id"].sort().to_list() == [1, 5, 9]
+
+    # A filter on the partition column only reads that partition's files
+    lf = dataset.scan().filter(pl.col("protein_label") == "SARS/2 50%")
+    plan = lf.explain()
+    assert "protein_label=SARS%2F2%2050%25" in plan
+    assert not any(f"protein_label={x}" in plan for x in ["MERS-CoV%20Mpro", HIVE_NULL, "a%3Db"])
+    assert lf.collect().sort("test_fake_id").equals(df.filter(pl.col("protein_label") == "SARS/2 50%"))
+
+    # Saving again replaces every partition, including ones the new frame doesn't have
+    dataset.save(df.filter(pl.col("protein_label") == "a=b"))
+    assert [x.name for x in dataset.path.iterdir()] == ["protein_label=a%3Db"]
+    assert dataset.read()["test_fake_id"].sort().to_list() == [3, 7, 11]
+
+
+@pytest.mark.parametrize("suffix", ["parquet", "arrow"])
+def test_scan_pushes_filters_into_the_reader(tmp_path, suffix):
+    dataset = NamedDataset(name="poses", filepath=tmp_path / f"poses.{suffix}", row_group_size=4)
+    df = _partitioned_frame()
+    dataset.save(df)
+
+    lf = dataset.scan().filter(pl.col("test_fake_id") >= 6).select("test_fake_id", "score")
+    assert "SELECTION" in lf.explain().split("SCAN", 1)[1]
+    assert lf.collect().equals(df.filter(pl.col("test_fake_id") >= 6).select("test_fake_id", "score"))
+
+
+@pytest.mark.parametrize("partition_by", [[], ["protein_label"]])
+def test_failed_save_leaves_the_old_copy(tmp_path, monkeypatch, partition_by):
+    dataset = NamedDataset(name="poses", filepath=tmp_path / "poses.parquet", partition_by=partition_by)
+    df = _partitioned_frame()
+    dataset.save(df)
+
+    def write_half_then_fail(self, path, **kwargs):
+        out = path / "protein_label=a%3Db" / "00000000.parquet" if kwargs.get("partition_by") else path
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_bytes(b"PAR1 not really")
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(pl.DataFrame, "write_parquet", write_half_then_fail)
+        with pytest.raises(OSError, match="disk full"):
+            dataset.save(df.head(2))
+    assert dataset.read().sort("test_fake_id").equals(df)
+
+    # The next save clears out what the failed one left behind
+    dataset.save(df.head(2))
+    assert dataset.read().sort("test_fake_id").equals(df.head(2))
+    assert [x.name for x in tmp_path.iterdir()] == ["poses.parquet"]
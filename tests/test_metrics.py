@@ -0,0 +1,35 @@
+import json
+
+from polaris_asap_poses.metrics import read_metrics, report, summarize_metrics
+
+
+def test_no_metrics_yet(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    assert read_metrics(path).is_empty()
+    assert summarize_metrics(path)["stages"] == []
+    assert report(path) == f"No metrics recorded in {path} yet."
+    path.touch()
+    assert read_metrics(path).is_empty()
+
+
+def test_report_on_the_latest_run(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    records = [
+        {
+            "run_id": run_id,
+            "event": "stage",
+            "stage": "gnina_job",
+            "start": start + 2.0 * i,
+            "wall_s": wall_s,
+            "ok": True,
+            "test_fake_id": i,
+            "protein": "MERS-CoV-Mpro",
+        }
+        for run_id, start, wall_s in (("old", 0.0, 100.0), ("new", 1000.0, 2.0))
+        for i in range(3)
+    ]
+    path.write_text("".join(json.dumps(x) + "\n" for x in records))
+    assert read_metrics(path)["wall_s"].to_list() == [2.0] * 3
+    summary = summarize_metrics(path)
+    assert summary["n_ligands"] == 3 and summary["ligands_per_hour"] == 3600 * 3 / 6
+    assert report(path).startswith("Run new")
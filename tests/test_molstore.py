@@ -0,0 +1,88 @@
+from rdkit import Chem
+
+from fake_competition import embedded_mols
+from polaris_asap_poses.io import write_sdfs
+from polaris_asap_poses.model import MERS, SARS
+from polaris_asap_poses.molstore import MolStore, import_docking_results
+
+
+def _same(x: Chem.Mol, y: Chem.Mol) -> bool:
+    return Chem.MolToMolBlock(x) == Chem.MolToMolBlock(y) and x.GetPropsAsDict() == y.GetPropsAsDict()
+
+
+def test_append_get_and_reopen(tmp_path):
+    mols = embedded_mols(4)
+    with MolStore(tmp_path / "poses.mols") as store:
+        store.append(mols[0], 1, MERS.data_label)
+        store.extend(
+            [
+                ((1, MERS.data_label, 2), mols[2]),
+                ((1, MERS.data_label, 1), mols[1]),
+                ((2, SARS.data_label, 0), mols[3]),
+            ]
+        )
+        assert _same(store.get(1, MERS.data_label), mols[0])
+        assert len(store) == 4
+
+    with MolStore(tmp_path / "poses.mols") as store:
+        assert len(store) == 4
+        assert (2, SARS.data_label, 0) in store
+        assert all(_same(x, y) for x, y in zip(store.get_poses(1, MERS.data_label), mols[:3]))
+        assert store.get_poses(2, MERS.data_label) == []
+        # Appending an existing key shadows the old record
+        store.append(mols[3], 1, MERS.data_label, 1)
+        assert _same(store.get(1, MERS.data_label, 1), mols[3])
+        # Iteration is in file order
+        assert [key for key, _ in store] == [
+            (1, MERS.data_label, 0),
+            (1, MERS.data_label, 2),
+            (2, SARS.data_label, 0),
+            (1, MERS.data_label, 1),
+        ]
+
+    with MolStore(tmp_path / "poses.mols") as store:
+        assert _same(store.get(1, MERS.data_label, 1), mols[3])
+
+
+def test_recovers_from_a_crash_mid_append(tmp_path):
+    mols = embedded_mols(4)
+    path = tmp_path / "poses.mols"
+    with MolStore(path) as store:
+        store.extend(((0, MERS.data_label, rank), mol) for rank, mol in enumerate(mols[:3]))
+    # The last record's data was cut short, and the process died halfway through writing an index line
+    data_size = path.stat().st_size
+    with open(path, "r+b") as fd:
+        fd.truncate(data_size - 10)
+    index_path = tmp_path / "poses.mols.idx"
+    with open(index_path, "a") as fd:
+        fd.write("0\tMERS-CoV-Mpro\t3\t12")
+
+    with MolStore(path) as store:
+        assert len(store) == 2
+        assert all(_same(x, y) for x, y in zip(store.get_poses(0, MERS.data_label), mols[:2]))
+        assert len(index_path.read_text().splitlines()) == 2
+        store.append(mols[3], 0, MERS.data_label, 2)
+
+    with MolStore(path) as store:
+        assert len(store) == 3
+        assert _same(store.get(0, MERS.data_label, 2), mols[3])
+
+
+def test_import_docking_results_skips_ligands_already_stored(tmp_path):
+    mols = embedded_mols(6)
+    gnina_out_dir = tmp_path / "gnina_out"
+    gnina_out_dir.mkdir()
+    write_sdfs(mols[:3], gnina_out_dir / f"docked_test_0_{MERS.path_segment}.sdf")
+    write_sdfs(mols[3:5], gnina_out_dir / f"docked_test_1_{SARS.path_segment}.sdf")
+    (gnina_out_dir / "notes.sdf").write_text("")
+
+    with MolStore(tmp_path / "poses.mols") as store:
+        assert import_docking_results(store, gnina_out_dir) == 5
+        size = store.path.stat().st_size
+        assert import_docking_results(store, gnina_out_dir) == 0
+        assert store.path.stat().st_size == size
+
+        write_sdfs(mols[5:], gnina_out_dir / f"docked_test_2_{MERS.path_segment}.sdf")
+        assert import_docking_results(store, gnina_out_dir) == 1
+        assert len(store) == 6
+        assert all(_same(x, y) for x, y in zip(store.get_poses(0, MERS.data_label), mols[:3]))
@@ -0,0 +1,111 @@
+import dataclasses
+import json
+
+import polars as pl
+
+from fake_competition import write_snapshot_manifest
+from polaris_asap_poses.io import asap_test_raw
+from polaris_asap_poses.model import get_protein
+from polaris_asap_poses.pipeline import Pipeline, PipelineConfig, Stage, default_stages
+from polaris_asap_poses.poses import gnina_poses, selected_poses
+from polaris_asap_poses.submission import submission_path
+
+
+def _stub_stages(tmp_path, calls):
+    """
+    a reads in.txt and writes a.txt; b reads a.txt and writes b.txt.  Only b depends on select_by.
+    """
+
+    def run_a(pipeline, record):
+        calls.append("a")
+        (tmp_path / "a.txt").write_text((tmp_path / "in.txt").read_text().upper())
+
+    def run_b(pipeline, record):
+        calls.append("b")
+        (tmp_path / "b.txt").write_text((tmp_path / "a.txt").read_text() + pipeline.config.select_by)
+
+    return [
+        Stage(name="a", run=run_a, inputs=[tmp_path / "in.txt"], outputs=[tmp_path / "a.txt"]),
+        Stage(
+            name="b",
+            run=run_b,
+            deps=["a"],
+            inputs=[tmp_path / "a.txt"],
+            outputs=[tmp_path / "b.txt"],
+            params=["select_by"],
+        ),
+    ]
+
+
+def test_stages_only_run_when_stale(tmp_path):
+    calls = []
+    stages = _stub_stages(tmp_path, calls)
+    state_path = tmp_path / "state.json"
+    (tmp_path / "in.txt").write_text("x")
+
+    def run(**config):
+        calls.clear()
+        Pipeline(PipelineConfig(**config), stages=stages, state_path=state_path).run()
+        return calls
+
+    assert run() == ["a", "b"]
+    assert run() == []
+    # a reruns, but writes the same a.txt, so b doesn't need to
+    (tmp_path / "in.txt").write_text("X")
+    assert run() == ["a"]
+    (tmp_path / "in.txt").write_text("y")
+    assert run() == ["a", "b"]
+    assert run(select_by="minimized_affinity") == ["b"]
+    (tmp_path / "b.txt").unlink()
+    assert run(select_by="minimized_affinity") == ["b"]
+    (tmp_path / "a.txt").write_text("tampered")
+    assert run(select_by="minimized_affinity") == ["a"]
+
+    pipeline = Pipeline(PipelineConfig(), stages=stages, state_path=state_path)
+    assert pipeline.plan() == [("a", "up to date"), ("b", "run (inputs or parameters changed)")]
+
+
+def test_rows_that_leave_the_test_set_are_dropped(competition, tmp_path):
+    stages = [
+        dataclasses.replace(x, run=lambda pipeline, record: None) if x.name == "structures" else x
+        for x in default_stages()
+    ]
+    state_path = tmp_path / "state.json"
+    Pipeline(PipelineConfig(), stages=stages, state_path=state_path).run()
+    assert len(submission_path().read_text().splitlines()) == len(competition)
+
+    # Drop a row and move another to the other protein
+    moved = competition["test_fake_id"][1]
+    labels = competition["protein_label"].unique().sort().to_list()
+    df_test = competition.filter(pl.col("test_fake_id") != competition["test_fake_id"][0]).with_columns(
+        pl.when(pl.col("test_fake_id") == moved)
+        .then(pl.lit(labels[0]) if competition["protein_label"][1] == labels[1] else pl.lit(labels[1]))
+        .otherwise(pl.col("protein_label"))
+        .alias("protein_label")
+    )
+    asap_test_raw.save(df_test)
+    write_snapshot_manifest()
+    ran = Pipeline(PipelineConfig(), stages=stages, state_path=state_path).run()
+    assert {"prep", "dock", "poses", "select", "submit"} <= set(ran)
+
+    submission = [json.loads(x) for x in submission_path().read_text().splitlines()]
+    assert [x["test_fake_id"] for x in submission] == df_test["test_fake_id"].to_list()
+    df_poses = gnina_poses.read()
+    assert sorted(df_poses["test_fake_id"].unique().to_list()) == sorted(df_test["test_fake_id"].to_list())
+    moved_label = df_test.filter(pl.col("test_fake_id") == moved)["protein_label"][0]
+    assert df_poses.filter(pl.col("test_fake_id") == moved)["protein_label"].unique().to_list() == [moved_label]
+    assert get_protein(moved_label).docking_result_path(moved).exists()
+
+
+def test_select_by_vina_score(competition, tmp_path):
+    stages = [
+        dataclasses.replace(x, run=lambda pipeline, record: None) if x.name == "structures" else x
+        for x in default_stages()
+    ]
+    Pipeline(PipelineConfig(select_by="vina_score"), stages=stages, state_path=tmp_path / "state.json").run()
+
+    df_selected = selected_poses.read()
+    assert sorted(df_selected["test_fake_id"].to_list()) == sorted(competition["test_fake_id"].to_list())
+    assert df_selected["vina_score"].null_count() == 0
+    assert (df_selected["rank_by_vina_score"] == 1).all()
+    assert len(submission_path().read_text().splitlines()) == len(competition)
@@ -0,0 +1,45 @@
+import polars as pl
+
+from polaris_asap_poses.model import MERS, SARS
+from polaris_asap_poses.poses import POSE_GROUP, pose_rank_expr, top_k_poses
+
+
+def _pose_table() -> pl.DataFrame:
+    """
+    Two ligands in gnina's order, with tied scores, and a third docked against both receptors.
+    """
+    return pl.DataFrame(
+        {
+            "test_fake_id": [1, 1, 1, 1, 0, 0, 0, 2, 2],
+            "protein_label": [MERS.data_label] * 7 + [MERS.data_label, SARS.data_label],
+            "pose_rank": [0, 1, 2, 3, 0, 1, 2, 0, 0],
+            "cnn_score": [0.5, 0.9, 0.9, 0.5, 0.7, 0.7, 0.7, 0.1, 0.2],
+            "minimized_affinity": [-7.0, -8.0, -6.0, -8.0, -5.0, -5.0, -6.0, -9.0, -4.0],
+        }
+    )
+
+
+def test_pose_rank_breaks_ties_in_table_order():
+    df = _pose_table().with_columns(
+        pose_rank_expr().alias("by_cnn"),
+        pose_rank_expr("minimized_affinity", descending=False).alias("by_affinity"),
+    )
+    assert df["by_cnn"].to_list() == [3, 1, 2, 4, 1, 2, 3, 1, 1]
+    assert df["by_affinity"].to_list() == [3, 1, 4, 2, 2, 3, 1, 1, 1]
+
+
+def test_top_k_poses_per_ligand():
+    df = _pose_table()
+    top = top_k_poses(df, k=1)
+    assert top.select(POSE_GROUP + ["pose_rank"]).rows() == [
+        (0, MERS.data_label, 0),
+        (1, MERS.data_label, 1),
+        (2, MERS.data_label, 0),
+        (2, SARS.data_label, 0),
+    ]
+    assert top["rank_by_cnn_score"].to_list() == [1, 1, 1, 1]
+
+    top = top_k_poses(df.lazy(), k=2, by="minimized_affinity", descending=False).collect()
+    assert top.filter(pl.col("test_fake_id") == 1)["pose_rank"].to_list() == [1, 3]
+    assert top.filter(pl.col("test_fake_id") == 0)["pose_rank"].to_list() == [2, 0]
+    assert len(top) == 6
@@ -0,0 +1,87 @@
+import numpy as np
+import polars as pl
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from polaris_asap_poses import gnina
+from polaris_asap_poses.model import PROTEINS
+from polaris_asap_poses.poses import POSE_GROUP, build_pose_table
+from polaris_asap_poses.rescore import (VINA_WEIGHTS, ReceptorScorer,
+                                        _pair_energy, rescore_poses,
+                                        typed_heavy_atoms)
+
+
+def _embedded(smiles: str, center, seed: int = 0) -> Chem.Mol:
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.EmbedMolecule(mol, randomSeed=seed)
+    conformer = mol.GetConformer()
+    positions = conformer.GetPositions()
+    for i, position in enumerate(positions - positions.mean(axis=0) + center):
+        conformer.SetAtomPosition(i, position.tolist())
+    return mol
+
+
+def _pocket() -> Chem.Mol:
+    """
+    A few small molecules around the origin, with carbons, donors and acceptors, standing in for a receptor.
+    """
+    receptor = Chem.Mol()
+    for i, (smiles, center) in enumerate(
+        [
+            ("c1ccccc1O", (6.5, 0, 0)),
+            ("CC(=O)NC", (-6.5, 0, 0)),
+            ("OCCN", (0, 6.5, 0)),
+            ("c1ccncc1", (0, -6.5, 0)),
+            ("CCSC", (0, 0, 6.5)),
+        ]
+    ):
+        receptor = Chem.CombineMols(receptor, _embedded(smiles, center, seed=i))
+    return receptor
+
+
+def _brute_force(receptor: Chem.Mol, coords: np.ndarray, types) -> np.ndarray:
+    """
+    Per-atom energy straight from _pair_energy, against every receptor atom.
+    """
+    indices, receptor_types = typed_heavy_atoms(receptor)
+    receptor_coords = receptor.GetConformer().GetPositions()[indices]
+    names = sorted(set(receptor_types))
+    rec_index = np.array([names.index(x) for x in receptor_types])
+    return np.array(
+        [_pair_energy(np.linalg.norm(receptor_coords - x, axis=1), names, t, rec_index) for x, t in zip(coords, types)]
+    )
+
+
+def test_grid_matches_brute_force():
+    receptor = _pocket()
+    ligand = _embedded("OC(=O)c1ccccc1N", (0, 0, 0), seed=7)
+    indices, types = typed_heavy_atoms(ligand)
+    coords = ligand.GetConformer().GetPositions()[indices]
+    scorer = ReceptorScorer(receptor, coords.min(axis=0) - 3.0, coords.max(axis=0) + 3.0, spacing=0.2)
+
+    expected = _brute_force(receptor, coords, types)
+    assert np.abs(expected).max() > 0.1
+    np.testing.assert_allclose(scorer.score_atoms(coords, types), expected, atol=0.05)
+
+    # A batch of poses: the same one, shifted, scored together, normalized by rotatable bonds
+    shifts = np.array([[0.0, 0.0, 0.0], [0.3, -0.2, 0.1], [-0.4, 0.1, 0.5]])
+    poses = coords[None] + shifts[:, None]
+    expected = [_brute_force(receptor, x, types).sum() / (1.0 + VINA_WEIGHTS["rot"] * 2) for x in poses]
+    np.testing.assert_allclose(scorer.score(poses, types, n_rotatable=2), expected, atol=0.05 * len(types))
+
+
+def test_rescore_poses_joins_onto_the_pose_table(competition):
+    gnina.run()
+    df = build_pose_table(save=False)
+    scorers = {protein.data_label: ReceptorScorer.from_protein(protein) for protein in PROTEINS}
+
+    scores = rescore_poses(df, scorers=scorers)
+    assert scores.columns == POSE_GROUP + ["pose_rank", "vina_score"]
+    assert len(scores) == len(df)
+    df_scored = df.join(scores, on=POSE_GROUP + ["pose_rank"], how="left")
+    assert len(df_scored) == len(df)
+    assert df_scored["vina_score"].null_count() == 0
+    assert df_scored["vina_score"].is_finite().all()
+    # Poses of a ligand differ, so they should score differently
+    assert (df_scored.group_by(POSE_GROUP).agg(pl.col("vina_score").n_unique())["vina_score"] > 1).all()
+
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from rdkit import Chem
+from rdkit.Chem import AllChem, rdMolAlign
+
+from fake_competition import SMILES
+from polaris_asap_poses.rmsd import PoseRMSD, pairwise_pose_rmsd, pose_rmsd
+
+
+def _conformers(smiles: str, n: int) -> list:
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    conf_ids = AllChem.EmbedMultipleConfs(mol, numConfs=n, randomSeed=0)
+    return [Chem.RemoveHs(Chem.Mol(mol, confId=x)) for x in conf_ids]
+
+
+@pytest.mark.parametrize("smiles", SMILES[:6])
+def test_matches_rdkit(smiles):
+    reference, *poses = _conformers(smiles, 6)
+    expected_in_place = [rdMolAlign.CalcRMS(pose, reference) for pose in poses]
+    expected_aligned = [rdMolAlign.GetBestRMS(Chem.Mol(pose), reference) for pose in poses]
+    np.testing.assert_allclose(pose_rmsd(reference, poses), expected_in_place, atol=1e-6)
+    np.testing.assert_allclose(pose_rmsd(reference, poses, aligned=True), expected_aligned, atol=1e-4)
+
+
+def test_batches_sized_by_mappings():
+    # Two tert-butyls and a para-phenylene: 2 * 6 * 6 * 2 = 144 mappings
+    reference, *poses = _conformers("CC(C)(C)c1ccc(C(C)(C)C)cc1", 8)
+    scorer = PoseRMSD(reference)
+    assert len(scorer.mappings) == 144
+    expected = scorer.rmsd(poses)
+    # Room for one pose's worth of mappings at a time, and less than that
+    np.testing.assert_allclose(scorer.rmsd(poses, max_floats=144 * scorer.n_atoms * 3), expected)
+    np.testing.assert_allclose(scorer.rmsd(poses, max_floats=1), expected)
+    np.testing.assert_allclose(np.diag(pairwise_pose_rmsd(poses)), 0.0, atol=1e-6)
@@ -0,0 +1,20 @@
+import pytest
+
+from polaris_asap_poses.io import asap_test_raw
+from polaris_asap_poses.snapshot import ensure_snapshot, get_df_test
+
+
+def test_snapshot_is_checked_against_the_manifest(competition):
+    assert ensure_snapshot(offline=True)["files"]
+    assert len(get_df_test(offline=True)) == len(competition)
+
+    with open(asap_test_raw.path, "r+b") as fd:
+        fd.truncate(100)
+    with pytest.raises(RuntimeError, match="doesn't match the sha256"):
+        get_df_test(offline=True)
+
+
+def test_missing_snapshot_file_is_an_error_offline(competition):
+    asap_test_raw.path.unlink()
+    with pytest.raises(RuntimeError, match="is missing"):
+        ensure_snapshot(offline=True)
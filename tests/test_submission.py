@@ -0,0 +1,56 @@
+import json
+
+import polars as pl
+import pytest
+
+from fake_competition import SMILES, embedded_mols
+from polaris_asap_poses.io import mol_to_binary
+from polaris_asap_poses.model import MERS, SARS
+from polaris_asap_poses.submission import (build_submission,
+                                           iter_submission_poses,
+                                           validate_selection)
+
+
+def _test_set(n: int) -> pl.DataFrame:
+    # Not sorted by test_fake_id, so test-set order is something to get right
+    ids = list(range(n))[::-1]
+    return pl.DataFrame(
+        {
+            "test_fake_id": ids,
+            "protein_label": [MERS.data_label if i % 2 else SARS.data_label for i in ids],
+            "CXSMILES": [SMILES[i % len(SMILES)] for i in ids],
+        }
+    )
+
+
+def _selection(df_test: pl.DataFrame) -> pl.DataFrame:
+    mols = embedded_mols(len(df_test))
+    return df_test.select("test_fake_id", "protein_label").with_columns(
+        pl.Series("mol", [mol_to_binary(mols[i]) for i in df_test["test_fake_id"]], dtype=pl.Binary)
+    )
+
+
+def test_validate_selection_rejects_missing_and_duplicate_ids():
+    df_test = _test_set(6)
+    df_selected = _selection(df_test)
+    ordered = validate_selection(df_selected.sample(fraction=1.0, shuffle=True, seed=0), df_test)
+    assert ordered["test_fake_id"].to_list() == [5, 4, 3, 2, 1, 0]
+
+    with pytest.raises(ValueError, match=r"No pose selected for 2 test rows, test_fake_ids \[4, 1\]"):
+        validate_selection(df_selected.filter(~pl.col("test_fake_id").is_in([1, 4])), df_test)
+    with pytest.raises(ValueError, match=r"More than one pose selected for test_fake_ids \[0, 3\]"):
+        validate_selection(pl.concat([df_selected, df_selected.filter(pl.col("test_fake_id").is_in([3, 0]))]), df_test)
+
+
+def test_build_submission_keeps_test_set_order_across_windows(tmp_path):
+    df_test = _test_set(11)
+    df_selected = _selection(df_test).sample(fraction=1.0, shuffle=True, seed=1)
+
+    path = build_submission(df_selected, out_path=tmp_path / "submission.jsonl", df_test=df_test, window=3)
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [row["test_fake_id"] for row in rows] == df_test["test_fake_id"].to_list()
+    assert [(row["protein_label"], row["CXSMILES"]) for row in rows] == df_test.select(
+        "protein_label", "CXSMILES"
+    ).rows()
+    assert [mol.GetProp("_Name") for mol in iter_submission_poses(path)] == [f"test_{i}" for i in range(10, -1, -1)]
+    assert [x.name for x in tmp_path.iterdir()] == ["submission.jsonl"]
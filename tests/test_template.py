@@ -0,0 +1,34 @@
+import dataclasses
+import json
+
+import polars as pl
+
+from polaris_asap_poses.model import get_protein
+from polaris_asap_poses.pipeline import Pipeline, PipelineConfig, default_stages
+from polaris_asap_poses.poses import gnina_poses, selected_poses
+from polaris_asap_poses.submission import submission_path
+from polaris_asap_poses.template import template_pose_path
+
+
+def test_templated_ligands_are_scored_selected_and_submitted(competition, tmp_path):
+    # The reference structures are already there, so don't try to download them
+    stages = [
+        dataclasses.replace(x, run=lambda pipeline, record: None) if x.name == "structures" else x
+        for x in default_stages()
+    ]
+    pipeline = Pipeline(PipelineConfig(template_threshold=0.7), stages=stages, state_path=tmp_path / "state.json")
+    pipeline.run()
+
+    # The synthetic training set has the same ligands, so they all get template poses
+    templated = [
+        row["test_fake_id"]
+        for row in competition.iter_rows(named=True)
+        if template_pose_path(get_protein(row["protein_label"]), row["test_fake_id"]).exists()
+    ]
+    assert templated
+
+    df_poses = gnina_poses.read()
+    assert df_poses.filter(pl.col("test_fake_id").is_in(templated))["cnn_score"].null_count() == 0
+    assert sorted(selected_poses.read()["test_fake_id"].to_list()) == sorted(competition["test_fake_id"].to_list())
+    lines = submission_path().read_text().splitlines()
+    assert [json.loads(x)["test_fake_id"] for x in lines] == competition["test_fake_id"].to_list()
@@ -0,0 +1,64 @@
+import time
+
+import polars as pl
+
+from polaris_asap_poses import workqueue
+from polaris_asap_poses.io import data_dir_gnina_out, iter_sdf
+from polaris_asap_poses.model import get_protein
+from polaris_asap_poses.workqueue import WorkQueue, run_worker, run_workers
+
+
+def _output(row) -> object:
+    return get_protein(row["protein_label"]).docking_result_path(row["test_fake_id"])
+
+
+def test_workers_drain_the_queue(competition, tmp_path, monkeypatch):
+    path = tmp_path / "dock.sqlite"
+    queue = WorkQueue(path)
+    queue.populate(competition)
+    # A job the workers can't find in the test set, and one that always fails
+    queue.populate(pl.DataFrame({"test_fake_id": [999], "protein_label": [competition["protein_label"][0]]}))
+    monkeypatch.setenv("FAKE_GNINA_FAIL", "test_3")
+    # A worker that died holding a job: its lease runs out and someone else picks it up
+    dead = WorkQueue(path, lease_s=0.01).claim("dead-host:1")
+    time.sleep(0.05)
+
+    exit_codes = run_workers(3, path=path, seed=0, lease_s=30.0, poll_s=0.1)
+    assert exit_codes == [0, 0, 0]
+
+    df = queue.jobs()
+    assert queue.counts() == {"queued": 0, "running": 0, "done": 7, "failed": 2}
+    failed = df.filter(pl.col("state") == "failed")
+    assert failed["test_fake_id"].to_list() == [3, 999]
+    assert failed["attempts"].to_list() == [3, 3]
+    assert "KeyError" in failed.filter(pl.col("test_fake_id") == 999)["error"][0]
+    assert df.filter(pl.col("test_fake_id") == dead.test_fake_id)["state"][0] == "done"
+    assert df.filter(pl.col("test_fake_id") == dead.test_fake_id)["attempts"][0] == 2
+    for row in competition.iter_rows(named=True):
+        assert _output(row).exists() == (row["test_fake_id"] != 3)
+    assert not list(data_dir_gnina_out().glob(".*.sdf"))
+
+
+def test_worker_discards_a_job_whose_lease_it_lost(competition, tmp_path, monkeypatch):
+    path = tmp_path / "dock.sqlite"
+    queue = WorkQueue(path)
+    queue.populate(competition.head(1))
+    row = next(competition.head(1).iter_rows(named=True))
+    run_gnina_jobs = workqueue.run_gnina_jobs
+    stolen = []
+
+    def slow_run_gnina_jobs(jobs, **kwargs):
+        run_gnina_jobs(jobs, **kwargs)
+        if not stolen:
+            # Another worker takes the job over, briefly, while this one is still docking it
+            with queue._transaction() as conn:
+                conn.execute("UPDATE jobs SET worker = 'thief', lease_expires = ?", (time.time() + 0.5,))
+            stolen.append(jobs[0].output_sdf)
+            time.sleep(0.4)
+            assert not _output(row).exists()
+
+    monkeypatch.setattr(workqueue, "run_gnina_jobs", slow_run_gnina_jobs)
+    assert run_worker(path, seed=0, lease_s=0.3, poll_s=0.1, worker="me") == 1
+    assert not stolen[0].exists()
+    assert len(list(iter_sdf(_output(row)))) == 9
+    assert queue.jobs()["attempts"].to_list() == [2]
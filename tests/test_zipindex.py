@@ -0,0 +1,88 @@
+import zipfile
+
+import numpy as np
+import pytest
+from rdkit import Chem
+
+from fake_competition import embedded_mols
+from polaris_asap_poses.model import MERS, SARS
+from polaris_asap_poses.zipindex import ZipIndex
+
+PDB = (
+    "ATOM      1  N   GLY A   1       1.000   2.000   3.000  1.00  0.00           N\n"
+    "ATOM      2  CA  GLY A   1       2.500   2.000   3.000  1.00  0.00           C\n"
+    "HETATM    3  O   HOH A   2      -1.250   0.500  10.000  1.00  0.00           O\n"
+    "END\n"
+)
+FASTA = ">SARS-CoV-2 Mpro\nSGFRKMAF\nPSGKVEGC\n>MERS-CoV Mpro\nSGLVKMSH\n"
+
+
+def _write_zip(path, ligand: Chem.Mol):
+    """
+    A small package with stored and deflated members, one of them with an extra field in its local header.
+    """
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.mkdir("SARS-CoV-2")
+        zip_ref.writestr("SARS-CoV-2/protein.pdb", PDB, compress_type=zipfile.ZIP_DEFLATED)
+        info = zipfile.ZipInfo("MERS-CoV/ligand.sdf")
+        info.extra = b"\xfe\xca\x04\x00abcd"
+        zip_ref.writestr(info, Chem.MolToMolBlock(ligand) + "$$$$\n", compress_type=zipfile.ZIP_STORED)
+        zip_ref.writestr("sequences.fasta", FASTA, compress_type=zipfile.ZIP_DEFLATED)
+        zip_ref.writestr("README.txt", "hello " * 100, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def test_reads_members_straight_from_the_zip(tmp_path):
+    ligand = embedded_mols(1)[0]
+    _write_zip(tmp_path / "package.zip", ligand)
+
+    with ZipIndex.open(tmp_path / "package.zip") as index, zipfile.ZipFile(tmp_path / "package.zip") as zip_ref:
+        assert sorted(index.members) == [
+            "MERS-CoV/ligand.sdf",
+            "README.txt",
+            "SARS-CoV-2/protein.pdb",
+            "sequences.fasta",
+        ]
+        for name in index.members:
+            assert index.read_bytes(name) == zip_ref.read(name)
+
+        assert [x.name for x in index.filter(kind="pdb")] == ["SARS-CoV-2/protein.pdb"]
+        assert [x.name for x in index.filter(target=MERS.data_label)] == ["MERS-CoV/ligand.sdf"]
+        assert index.filter(kind="sdf", target=SARS.data_label) == []
+        assert [x.name for x in index.filter(kind="other")] == ["README.txt"]
+
+        (mol,) = index.read_mols("MERS-CoV/ligand.sdf")
+        assert Chem.MolToSmiles(mol) == Chem.MolToSmiles(ligand)
+        # Mol blocks have 4 decimals
+        np.testing.assert_allclose(
+            index.read_coords("MERS-CoV/ligand.sdf"), ligand.GetConformer().GetPositions(), atol=1e-4
+        )
+        assert len(index.read_mols("SARS-CoV-2/protein.pdb")) == 1
+        np.testing.assert_allclose(
+            index.read_coords("SARS-CoV-2/protein.pdb"), [[1.0, 2.0, 3.0], [2.5, 2.0, 3.0], [-1.25, 0.5, 10.0]]
+        )
+        with pytest.raises(ValueError, match="Can't make mols"):
+            index.read_mols("sequences.fasta")
+        assert index.read_fasta("sequences.fasta") == {
+            "SARS-CoV-2 Mpro": "SGFRKMAFPSGKVEGC",
+            "MERS-CoV Mpro": "SGLVKMSH",
+        }
+
+
+def test_open_reuses_the_saved_index_until_the_zip_changes(tmp_path, monkeypatch):
+    zip_path = tmp_path / "package.zip"
+    _write_zip(zip_path, embedded_mols(1)[0])
+    ZipIndex.open(zip_path).close()
+    assert ZipIndex.index_path_for(zip_path).exists()
+
+    with monkeypatch.context() as m:
+        m.setattr(ZipIndex, "build", classmethod(lambda cls, zip_path: pytest.fail("rebuilt a fresh index")))
+        with ZipIndex.open(zip_path) as index:
+            assert len(index.members) == 4
+
+    # A different zip at the same path: the old offsets would point at the wrong bytes
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        zip_ref.writestr("padding.bin", bytes(1000), compress_type=zipfile.ZIP_STORED)
+        zip_ref.writestr("SARS-CoV-2/protein.pdb", PDB, compress_type=zipfile.ZIP_DEFLATED)
+    with ZipIndex.open(zip_path) as index:
+        assert sorted(index.members) == ["SARS-CoV-2/protein.pdb", "padding.bin"]
+        assert index.read_text("SARS-CoV-2/protein.pdb") == PDB